@@ -0,0 +1,322 @@
+"""
+In-process adjacency index over the uop_related collection.
+
+Related rows are (subject_id, assoc_id, object_id) triples.  The index keeps
+forward sets keyed by (assoc_id, subject_id) and reverse sets keyed by
+(assoc_id, object_id) so rolesets and per object relationships are answered
+in O(degree) without going to the backend.  It is filled by one scan on first
+use and thereafter kept current by the database as it applies changes.
+
+Only changes applied through this process are seen.  Related rows written by
+other processes sharing the backend are not picked up until reset() drops the
+index, which the database does when it is opened, and the next use reloads it.
+
+For roles that nest, such as contains_group, a RoleClosure materializes what
+is reachable through any number of steps.  It is built on first use of the
+role and then maintained edge by edge along with the index.
+
+Roleset bitmaps are over an IdMap owned by the index.  Ids of deleted nodes
+keep their ints until the map is replaced: on reset and once the map holds
+more than twice as many ids as there are live nodes.  IdSets handed out
+earlier keep the map they were made with.
+"""
+
+__author__ = "samantha"
+
+from collections import defaultdict
+from uop.meta import oid
+from uop.core.idsets import Bitmap, IdMap
+
+
+def edge_parts(related):
+    """(subject_id, assoc_id, object_id) of a Related instance or related dict."""
+    if isinstance(related, dict):
+        return related["subject_id"], related["assoc_id"], related["object_id"]
+    return related.subject_id, related.assoc_id, related.object_id
+
+
+class RoleClosure:
+    """
+    Transitive closure of one role of an AdjacencyIndex.  _down maps each id
+    to everything reachable from it as subject and _up to everything it is
+    reachable from.
+    """
+
+    def __init__(self, index, role):
+        self.role = role
+        self._index = index
+        self._down = {}
+        self._up = {}
+        for r, subject in list(index._forward):
+            if r == role:
+                self._down[subject] = self._walk(subject, index._forward)
+        for r, object in list(index._reverse):
+            if r == role:
+                self._up[object] = self._walk(object, index._reverse)
+
+    def _walk(self, start, adjacent):
+        seen = set()
+        stack = [start]
+        while stack:
+            for nxt in adjacent.get((self.role, stack.pop()), ()):
+                if nxt not in seen:
+                    seen.add(nxt)
+                    stack.append(nxt)
+        return seen
+
+    def _rewalk(self, ids, closure, adjacent):
+        for an_id in ids:
+            reached = self._walk(an_id, adjacent)
+            if reached:
+                closure[an_id] = reached
+            else:
+                closure.pop(an_id, None)
+
+    def add(self, subject, object):
+        above = self._up.get(subject, set()) | {subject}
+        below = self._down.get(object, set()) | {object}
+        for an_id in above:
+            self._down.setdefault(an_id, set()).update(below)
+        for an_id in below:
+            self._up.setdefault(an_id, set()).update(above)
+
+    def discard(self, subject, object):
+        """Only ids above subject can lose descendants and below object ancestors."""
+        above = self._up.get(subject, set()) | {subject}
+        below = self._down.get(object, set()) | {object}
+        self._rewalk(above, self._down, self._index._forward)
+        self._rewalk(below, self._up, self._index._reverse)
+
+    def reachable(self, uuids, reverse=False):
+        closure = self._up if reverse else self._down
+        res = set()
+        for uuid in uuids:
+            res.update(closure.get(uuid, ()))
+        return res
+
+    def contains(self, ancestor, descendant):
+        return descendant in self._down.get(ancestor, ())
+
+
+renumber_floor = 4096  # id maps smaller than this are never replaced
+
+
+class AdjacencyIndex:
+    def __init__(self, id_map: IdMap = None):
+        self.loaded = False
+        self.id_map = id_map or IdMap()
+        self._bits = {}  # (reverse, assoc_id, id) -> Bitmap of the roleset
+        self._forward = defaultdict(set)  # (assoc_id, subject_id) -> object_ids
+        self._reverse = defaultdict(set)  # (assoc_id, object_id) -> subject_ids
+        self._subject_roles = defaultdict(set)  # subject_id -> assoc_ids
+        self._object_roles = defaultdict(set)  # object_id -> assoc_ids
+        self._role_subjects = defaultdict(set)  # assoc_id -> subject_ids
+        self._class_nodes = defaultdict(set)  # cls_id -> subject and object ids
+        self._closures = {}  # assoc_id -> RoleClosure
+
+    def reset(self):
+        """Forget everything. The next use reloads from the backend."""
+        self.__init__()
+
+    def _renumber(self):
+        """Start a fresh id map once most ids in the current one are dead."""
+        mapped = len(self.id_map)
+        if mapped > renumber_floor:
+            live = sum(len(nodes) for nodes in self._class_nodes.values())
+            if mapped > 2 * live:
+                self.id_map = IdMap()
+                self._bits.clear()
+
+    def load(self, records):
+        self.reset()
+        for rec in records:
+            self._add(*edge_parts(rec))
+        self.loaded = True
+
+    async def load_async(self, records):
+        """load from an async iterator of related records"""
+        self.reset()
+        async for rec in records:
+            self._add(*edge_parts(rec))
+        self.loaded = True
+
+    def _add(self, subject, role, object):
+        self._bits.pop((False, role, subject), None)
+        self._bits.pop((True, role, object), None)
+        self._forward[(role, subject)].add(object)
+        self._reverse[(role, object)].add(subject)
+        self._subject_roles[subject].add(role)
+        self._object_roles[object].add(role)
+        self._role_subjects[role].add(subject)
+        self._class_nodes[oid.oid_class(subject)].add(subject)
+        self._class_nodes[oid.oid_class(object)].add(object)
+        closure = self._closures.get(role)
+        if closure is not None:
+            closure.add(subject, object)
+
+    def _discard(self, subject, role, object):
+        objects = self._forward.get((role, subject))
+        if objects is None or object not in objects:
+            return
+        objects.discard(object)
+        self._bits.pop((False, role, subject), None)
+        self._bits.pop((True, role, object), None)
+        if not objects:
+            del self._forward[(role, subject)]
+            self._drop_role(self._subject_roles, subject, role)
+            self._drop_role(self._role_subjects, role, subject)
+        subjects = self._reverse[(role, object)]
+        subjects.discard(subject)
+        if not subjects:
+            del self._reverse[(role, object)]
+            self._drop_role(self._object_roles, object, role)
+        for node in (subject, object):
+            if node not in self._subject_roles and node not in self._object_roles:
+                self._drop_role(self._class_nodes, oid.oid_class(node), node)
+        closure = self._closures.get(role)
+        if closure is not None:
+            closure.discard(subject, object)
+
+    @staticmethod
+    def _drop_role(mapping, key, value):
+        values = mapping.get(key)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del mapping[key]
+
+    # maintenance, all no-ops until loaded as the load will see the backend state
+
+    def add(self, related):
+        if self.loaded:
+            self._add(*edge_parts(related))
+
+    def discard(self, related):
+        if self.loaded:
+            self._discard(*edge_parts(related))
+
+    def apply_changes(self, changes):
+        """Apply the inserted and deleted rows of a RelatedChanges."""
+        for related in changes.inserted:
+            self.add(related)
+        for related in changes.deleted:
+            self.discard(related)
+
+    def remove_subject_edges(self, subject, role):
+        if self.loaded:
+            for object in list(self._forward.get((role, subject), ())):
+                self._discard(subject, role, object)
+
+    def remove_object_edges(self, object, role):
+        if self.loaded:
+            for subject in list(self._reverse.get((role, object), ())):
+                self._discard(subject, role, object)
+
+    def remove_role(self, role):
+        if self.loaded:
+            for subject in list(self._role_subjects.get(role, ())):
+                self.remove_subject_edges(subject, role)
+
+    def remove_node(self, uuid):
+        """Remove all edges where uuid is subject or object."""
+        if self.loaded:
+            for role in list(self._subject_roles.get(uuid, ())):
+                self.remove_subject_edges(uuid, role)
+            for role in list(self._object_roles.get(uuid, ())):
+                self.remove_object_edges(uuid, role)
+            self._renumber()
+
+    def remove_class(self, cls_id):
+        """Remove all edges touching an id of class cls_id."""
+        if self.loaded:
+            for node in list(self._class_nodes.get(cls_id, ())):
+                self.remove_node(node)
+
+    # queries
+
+    def contains(self, related):
+        subject, role, object = edge_parts(related)
+        return object in self._forward.get((role, subject), ())
+
+    def roleset(self, uuid, role, reverse=False):
+        adjacent = self._reverse if reverse else self._forward
+        return set(adjacent.get((role, uuid), ()))
+
+    def roleset_size(self, uuid, role, reverse=False):
+        adjacent = self._reverse if reverse else self._forward
+        return len(adjacent.get((role, uuid), ()))
+
+    def degree(self, uuid):
+        """Number of edges uuid is subject or object of."""
+        forward = sum(
+            len(self._forward[(r, uuid)]) for r in self._subject_roles.get(uuid, ())
+        )
+        reverse = sum(
+            len(self._reverse[(r, uuid)]) for r in self._object_roles.get(uuid, ())
+        )
+        return forward + reverse
+
+    def roleset_bits(self, uuid, role, reverse=False):
+        """Bitmap over id_map of roleset(uuid, role, reverse), cached until it changes."""
+        key = (reverse, role, uuid)
+        bits = self._bits.get(key)
+        if bits is None:
+            adjacent = self._reverse if reverse else self._forward
+            bits = self._bits[key] = self.id_map.bitmap(adjacent.get((role, uuid), ()))
+        return bits
+
+    def union_bits(self, uuids, role, reverse=False):
+        return Bitmap.union(self.roleset_bits(u, role, reverse) for u in uuids)
+
+    def rolesets(self, uuids, role, reverse=False):
+        return {uuid: self.roleset(uuid, role, reverse=reverse) for uuid in uuids}
+
+    def closure(self, role):
+        closure = self._closures.get(role)
+        if closure is None:
+            closure = self._closures[role] = RoleClosure(self, role)
+        return closure
+
+    def reachable(self, uuids, role, reverse=False):
+        """Ids reachable from uuids by one or more role steps (backwards if reverse)."""
+        return self.closure(role).reachable(uuids, reverse=reverse)
+
+    def object_roles(self, uuid):
+        """(roles uuid is subject of, roles uuid is object of)"""
+        return (
+            set(self._subject_roles.get(uuid, ())),
+            set(self._object_roles.get(uuid, ())),
+        )
+
+    def relationships(self, uuid):
+        """(role -> objects of uuid, role -> subjects of uuid)"""
+        forward = {
+            r: set(self._forward[(r, uuid)]) for r in self._subject_roles.get(uuid, ())
+        }
+        reverse = {
+            r: set(self._reverse[(r, uuid)]) for r in self._object_roles.get(uuid, ())
+        }
+        return forward, reverse
+
+    def related(self, uuid):
+        """All ids adjacent to uuid by any role in either direction."""
+        res = set()
+        for role in self._subject_roles.get(uuid, ()):
+            res.update(self._forward[(role, uuid)])
+        for role in self._object_roles.get(uuid, ()):
+            res.update(self._reverse[(role, uuid)])
+        return res
+
+    def role_subjects(self, role):
+        return set(self._role_subjects.get(role, ()))
+
+    def role_related(self, role):
+        """(subject -> objects, object -> subjects) for all edges with the role"""
+        forward = defaultdict(set)
+        reverse = defaultdict(set)
+        for subject in self._role_subjects.get(role, ()):
+            objects = self._forward[(role, subject)]
+            forward[subject].update(objects)
+            for object in objects:
+                reverse[object].add(subject)
+        return forward, reverse
@@ -4,9 +4,12 @@ from contextlib import asynccontextmanager
 comment = defaultdict(set)
 from sjasoft.utils.decorations import abstract
 import time
-from sjasoft.utils.data import async_recurse_set
 from sjasoft.utils import decorations
 from uop.core import changeset
+from uop.core import change_log
+from uop.core import meta_snapshot
+from uop.core import bulk_load as bulk
+from uop.core.concurrency import apply_staged, gather_bounded
 from uop.meta import oid
 from uop.meta.schemas import meta
 from uop.core import async_db_collection as db_coll
@@ -16,12 +19,35 @@ logger = base.logger
 
 
 class Database(base.Database):
+    # When set apply_changes overlaps independent writes, at most
+    # apply_concurrency at a time.
+    concurrent_apply = False
+    apply_concurrency = 8
+    # bulk_load batches are coroutines on the event loop, not threads
+    bulk_load_concurrency = 8
+
     async def get_metadata(self):
         return await self.collections.metadata()
 
     async def reload_metacontext(self):
         coll_meta = await self.get_metadata()
         self._context = meta.MetaContext.from_data(coll_meta)
+        self._tag_trie = None
+
+    async def update_metacontext(self, delta):
+        if not delta.has_changes():
+            return
+        self.forget_class_extensions(delta)
+        if self._context is None:
+            await self.reload_metacontext()
+            return
+        try:
+            delta.apply_to(self._context)
+            if self._tag_trie is not None:
+                self._tag_trie.apply_delta(delta)
+        except (KeyError, ValueError) as e:
+            logger.warning("reloading metacontext after failed delta: %s", e)
+            await self.reload_metacontext()
 
     async def open_db(self, setup=None):
         self._collections = db_coll.DatabaseCollections(self)
@@ -31,13 +57,81 @@ class Database(base.Database):
             if self._tenant:
                 colmap.update(self._tenant.base_collections)
         await self._collections.ensure_collections(colmap)
-        await self._collections.ensure_class_extensions()
         self._collections_complete = True
+        self._adjacency.reset()
+        self._query_cache.clear()
+        self._object_cache.clear()
 
-        await self.reload_metacontext()
-        self._known_schemas = await self.db_schema_names()
+        generation = await self.meta_generation()
+        if not await self.load_meta_snapshot(generation):
+            await self.reload_metacontext()
+            self._known_schemas = await self.db_schema_names()
+            generation = generation or await self.stamp_meta_generation()
+            await self.save_meta_snapshot(generation)
         for schema in self._mandatory_schemas:
             await self.ensure_schema(schema)
+        if self._known_schemas != self._snapshot_schemas:
+            await self.save_meta_snapshot(await self.meta_generation())
+
+    @staticmethod
+    async def _store_record(coll, record):
+        if await coll.contains_id(record["id"]):
+            await coll.replace_one(record["id"], record)
+        else:
+            await coll.insert(**record)
+
+    async def meta_generation(self):
+        if not self.use_meta_snapshot:
+            return None
+        stamp = await self.collections.meta_snapshots.get(meta_snapshot.stamp_id)
+        return stamp and stamp.get("generation")
+
+    async def stamp_meta_generation(self):
+        if not self.use_meta_snapshot:
+            return None
+        generation = meta_snapshot.new_generation()
+        stamp = dict(id=meta_snapshot.stamp_id, generation=generation)
+        await self._store_record(self.collections.meta_snapshots, stamp)
+        return generation
+
+    async def stored_snapshot(self, generation):
+        if not (self.use_meta_snapshot and generation):
+            return None
+        coll = self.collections.meta_snapshots
+        snapshot = await coll.get(meta_snapshot.snapshot_id)
+        if not snapshot or snapshot.get("generation") != generation:
+            return None
+        return snapshot
+
+    async def load_meta_snapshot(self, generation):
+        snapshot = await self.stored_snapshot(generation)
+        if snapshot is None:
+            return False
+        self._context = meta_snapshot.decode_context(snapshot["context"])
+        self._tag_trie = None
+        self._known_schemas = set(snapshot["schemas"])
+        self._snapshot_schemas = set(self._known_schemas)
+        self._context_generation = generation
+        return True
+
+    async def save_meta_snapshot(self, generation):
+        if not (self.use_meta_snapshot and generation) or self._context is None:
+            return
+        record = meta_snapshot.snapshot_record(
+            self._context, generation, self._known_schemas
+        )
+        await self._store_record(self.collections.meta_snapshots, record)
+        self._snapshot_schemas = set(self._known_schemas)
+        self._context_generation = generation
+
+    async def snapshot_metacontext(self):
+        snapshot = await self.stored_snapshot(await self.meta_generation())
+        return snapshot and meta_snapshot.decode_context(snapshot["context"])
+
+    async def get_adjacency(self):
+        if not self._adjacency.loaded:
+            await self._adjacency.load_async(self.collections.related.iter_find())
+        return self._adjacency
 
     async def get_tenant(self, tenant_id):
         tenants = await self.tenants()
@@ -115,13 +209,45 @@ class Database(base.Database):
         We could log external to the main database but here we will presume that
         logging is local.
         """
-        changes = meta.MetaChanges(
-            timestamp=time.time(),
-            tenant_id=tenant_id or "",
-            changes=changeset.to_dict(),
+        entry = change_log.log_entry(
+            changeset, tenant_id or "", time.time(), self.packed_change_log
         )
         coll = self.collections.changes
-        await coll.insert(**changes.dict())
+        await coll.insert(**entry)
+        if self.compaction_due(entry["timestamp"]):
+            await self.compact_change_log(entry["timestamp"])
+
+    async def compact_change_log(self, now=None):
+        if self.change_retention is None:
+            return 0
+        now = now or time.time()
+        self._last_compaction = now
+        window = self.checkpoint_window
+        cutoff = change_log.window_start(now - self.change_retention, window)
+        log = self.collections.changes
+        checkpoints = self.collections.change_checkpoints
+        compactor = change_log.LogCompactor(window, self.packed_change_log)
+        compacted = 0
+
+        async def store(done):
+            nonlocal compacted
+            for checkpoint in done:
+                existing = await checkpoints.get(checkpoint["id"])
+                if existing:
+                    checkpoint = change_log.merged(existing, checkpoint)
+                    await checkpoints.remove(checkpoint["id"])
+                await checkpoints.insert(**checkpoint)
+                await log.remove(compactor.window_criteria(checkpoint))
+                compacted += checkpoint["count"] - (
+                    existing.get("count", 0) if existing else 0
+                )
+
+        async for entry in log.iter_find(
+            change_log.compactable_criteria(cutoff), order_by=("timestamp",)
+        ):
+            await store(compactor.add(entry))
+        await store(compactor.finish())
+        return compacted
 
     @asynccontextmanager
     async def changes(self):
@@ -130,28 +256,49 @@ class Database(base.Database):
         if not self._changeset:
             await self.apply_changes(changes)
 
-    async def changes_since(self, epochtime, tenant_id, client_id=None):
+    async def changes_since(self, epochtime, tenant_id, device_id=None):
         tenant_id = tenant_id or 0
-        client_id = client_id or 0
-        criteria = changeset.changes.criteria(epochtime, tenant_id, client_id)
-        changesets = await self.collections.changes.find(
-            criteria, order_by=("timestamp",), only_cols=("changes",)
+        device_id = device_id or 0
+        criteria = base.Q.all(
+            base.Q.gt("timestamp", epochtime), base.Q.neq("device_id", device_id)
+        )
+        combined = None
+        checkpoints = self.collections.change_checkpoints.iter_find(
+            change_log.chain_criteria(epochtime),
+            order_by=("start",),
+            only_cols=change_log.entry_columns,
+        )
+        tail = self.collections.changes.iter_find(
+            criteria, order_by=("timestamp",), only_cols=change_log.entry_columns
         )
-        return changeset.ChangeSet.combine_changes(*changesets)
+        for source in (checkpoints, tail):
+            async for entry in source:
+                if combined is None:
+                    combined = change_log.entry_changes(entry)
+                else:
+                    combined.add_changes(change_log.entry_delta(entry))
+        return combined
 
     async def apply_changes(self, changeset):
         extensions_to_remove = []
+        meta_delta = changeset.meta_delta()
+        touched = base.changed_ids(changeset, self.metacontext)
 
         async def delete_class(cls_id):
             cls = self.metacontext.classes.by_id.get(cls_id)
             if cls:
                 coll_name = getattr(cls, base.cls_extension_field)
                 if coll_name:
-                    coll = self.collections.get(coll_name)
-                    if coll:
-                        await coll.drop()
+                    coll = self.collections.routed_extension(cls_id)
+                    if coll is None:
+                        coll = await self.get_managed_collection(
+                            coll_name, cls.dict()
+                        )
+                    await coll.drop()
+                    self.collections.forget_extensions([cls_id])
             criteria = changeset.classes.deletion_criteria(cls_id)
             await self.collections.related.remove(criteria)
+            self._adjacency.remove_class(cls_id)
 
         async def delete_attribute(attr_id):
             pass
@@ -159,12 +306,13 @@ class Database(base.Database):
         async def delete_role(role_id):
             criteria = changeset.roles.deletion_criteria(role_id)
             await self.collections.related.remove(criteria)
+            self._adjacency.remove_role(role_id)
 
         async def delete_tag(tag_id):
-            criteria = changeset.tags.deletion_criteria(
-                tag_id, self.role_id("tag_applies")
-            )
+            role_id = self.role_id("tag_applies")
+            criteria = changeset.tags.deletion_criteria(tag_id, role_id)
             await self.collections.related.remove(criteria)
+            self._adjacency.remove_subject_edges(tag_id, role_id)
 
         async def delete_group(group_id):
             containing_role_id = self.role_id("group_contains")
@@ -172,15 +320,18 @@ class Database(base.Database):
                 group_id, containing_role_id
             )
             await self.collections.related.remove(contains_criteria)
+            self._adjacency.remove_subject_edges(group_id, containing_role_id)
             contained_role_id = self.role_id("contains_group")
             contained_criteria = changeset.groups.contained_criteria(
                 group_id, contained_role_id
             )
             await self.collections.related.remove(contained_criteria)
+            self._adjacency.remove_object_edges(group_id, contained_role_id)
 
         async def delete_object(object_id):
             criteria = changeset.objects.deletion_criteria(object_id)
             await self.collections.related.remove(criteria)
+            self._adjacency.remove_node(object_id)
 
         async def delete_query(query_id):
             pass
@@ -195,45 +346,84 @@ class Database(base.Database):
             queries=delete_query,
         )
 
+        async def by_collection(object_ids):
+            "(containing collection, ids) pairs for object_ids grouped by class"
+            by_class = defaultdict(list)
+            for object_id in object_ids:
+                by_class[oid.oid_class(object_id)].append(object_id)
+            return [
+                (await self.containing_collection(ids[0]), ids)
+                for ids in by_class.values()
+            ]
+
         async def apply_object_changes(changes):
-            for k, v in changes.inserted.items():
-                coll = await self.containing_collection(k)
-                await coll.insert(**v)
-            for k, v in changes.modified.items():
-                coll = await self.containing_collection(k)
-                await coll.update_one(k, v)
-            for k in changes.deleted:
-                coll = await self.containing_collection(k)
-                await coll.remove(k)
-                await delete_completions[changes.kind](k)
+            for coll, ids in await by_collection(changes.inserted):
+                await coll.insert_many([changes.inserted[k] for k in ids])
+            for coll, ids in await by_collection(changes.modified):
+                await coll.update_many({k: changes.modified[k] for k in ids})
+            for coll, ids in await by_collection(changes.deleted):
+                await coll.remove_many(ids)
+                for k in ids:
+                    await delete_completions[changes.kind](k)
 
         async def apply_meta_changes(changes):
             coll = getattr(self.collections, changes.kind)
-            for k, v in changes.inserted.items():
-                await coll.insert(**v)
-            for k, v in changes.modified.items():
-                await coll.update_one(k, v)
-            for k in changes.deleted:
-                await coll.remove(k)
-                await delete_completions[changes.kind](k)
+            if changes.inserted:
+                await coll.insert_many(list(changes.inserted.values()))
+            if changes.modified:
+                await coll.update_many(changes.modified)
+            if changes.deleted:
+                await coll.remove_many(list(changes.deleted))
+                for k in changes.deleted:
+                    await delete_completions[changes.kind](k)
+
+        async def cascade(kind, an_id):
+            await delete_completions[kind](an_id)
+
+        async def apply_concurrently():
+            await apply_staged(
+                changeset,
+                base.crud_kinds,
+                lambda kind: getattr(self.collections, kind),
+                by_collection,
+                cascade,
+                self.apply_concurrency,
+            )
 
         async def apply_related_changes(changes):
-            for related in changes.inserted:
-                await self.collections.related.insert(**related.without_kind())
-            for related in changes.deleted:
-                await self.collections.related.remove(related.without_kind())
+            related = self.collections.related
+            if changes.inserted:
+                await related.insert_many(
+                    [r.without_kind() for r in changes.inserted]
+                )
+            if changes.deleted:
+                await related.remove_many([r.without_kind() for r in changes.deleted])
+            self._adjacency.apply_changes(changes)
 
         await self.begin_transaction()
-        for kind in base.crud_kinds:
-            fn = apply_object_changes if kind == "objects" else apply_meta_changes
-            await fn(getattr(changeset, kind))
+        if self.concurrent_apply:
+            await apply_concurrently()
+        else:
+            for kind in base.crud_kinds:
+                fn = apply_object_changes if kind == "objects" else apply_meta_changes
+                await fn(getattr(changeset, kind))
         await apply_related_changes(changeset.related)
 
         for extension_name in extensions_to_remove:
             self.collections.drop_extension(extension_name)
         await self.log_changes(changeset, tenant_id=self._tenant_id)
+        generation = None
+        if meta_delta.has_changes():
+            current = await self.meta_generation() == self._context_generation
+            generation = await self.stamp_meta_generation()
         await self.commit()
-        await self.reload_metacontext()
+        await self.update_metacontext(meta_delta)
+        if generation:
+            if not current:
+                await self.reload_metacontext()
+            await self.save_meta_snapshot(generation)
+        self._query_cache.invalidate(touched)
+        self._object_cache.apply_changes(changeset)
 
     async def commit(self):
         await self._db.commit()
@@ -265,7 +455,6 @@ class Database(base.Database):
         has_changes = changes.has_changes()
         if has_changes:
             await self.apply_changes(changes)
-            await self.reload_metacontext()
         self._known_schemas.add(a_schema.name)
         return has_changes, changes
 
@@ -339,6 +528,9 @@ class Database(base.Database):
             await self.start_long_transaction()
 
     async def abort(self):
+        self._adjacency.reset()
+        self._query_cache.clear()
+        self._object_cache.clear()
         await self.end_transaction()
 
     async def really_commit(self):
@@ -449,6 +641,19 @@ class Database(base.Database):
         cls = self.metaclass_named(name)
         return await self.extension(cls.id)
 
+    async def class_instances(self, name, only_cols=None):
+        """Async generator over the instances of the named class, read in batches."""
+        coll = await self.class_collection(name)
+        cols = bulk.projection(only_cols)
+        async for value in coll.iter_find(only_cols=cols):
+            yield bulk.as_record(value, cols)
+
+    async def instances_satisfying(self, name, criteria, only_cols=None):
+        coll = await self.class_collection(name)
+        cols = bulk.projection(only_cols)
+        found = await coll.find(criteria, only_cols=cols)
+        return list(bulk.as_records(found, cols))
+
     async def create_instance_of(
         self, clsName, use_defaults=False, record=True, **data
     ):
@@ -473,21 +678,34 @@ class Database(base.Database):
 
     # objects and their relationships
 
-    async def get_object(self, uuid):
-        coll = await self.containing_collection(uuid)
-        obj = await coll.get(uuid)
-        return obj
-
-    async def bulk_load(self, uuids, preserve_order=True):
-        by_cls = base.partition(uuids, oid.oid_class)
-        res = []
-        for cls_id, ids in by_cls.items():
+    async def get_object(self, uuid, only_cols=None):
+        obj = self._object_cache.lookup(uuid)
+        if obj is base.absent:
+            return None
+        if obj is None:
+            coll = await self.containing_collection(uuid)
+            obj = await coll.get(uuid, only_cols=only_cols)
+            if obj is None or not only_cols:
+                self._object_cache.set(uuid, obj)
+            return obj
+        return bulk.projected(obj, only_cols)
+
+    async def bulk_load(self, uuids, preserve_order=True, only_cols=None):
+        uuids = list(uuids)
+        found, wanted = self.cached_projections(uuids, only_cols)
+        batches = bulk.batches(wanted, self.bulk_load_batch_size)
+        cols = bulk.projection(only_cols)
+
+        async def load(cls_id, ids):
             coll = await self.extension(cls_id)
-            res.extend(await coll.bulk_load(ids))
-        if preserve_order:
-            by_id = {x["_id"]: x for x in res}
-            res = [by_id[i] for i in uuids]
-        return res
+            return await coll.bulk_load(ids, only_cols=cols)
+
+        loaded = await gather_bounded(
+            self.bulk_load_concurrency, (load(*batch) for batch in batches)
+        )
+        for (_, ids), records in zip(batches, loaded):
+            self.add_loaded(found, ids, records, only_cols)
+        return bulk.ordered(uuids, found, preserve_order)
 
     async def oid_short_form(self, oid):
         obj = await self.get_object(oid)
@@ -496,17 +714,9 @@ class Database(base.Database):
 
     async def get_object_roles(self, uuid):
         "returns all role_ids that the object is subject in"
-        data = set(
-            await self.collections.related.distinct(
-                "assoc_id", criteria=dict(subject_id=uuid)
-            )
-        )
-        data_rev = set(
-            await self.collections.related.distinct(
-                "assoc_id", criteria=dict(object_id=uuid)
-            )
-        )
-        return data, data_rev  # return both forward and reverse applicable roles
+        # return both forward and reverse applicable roles
+        adjacency = await self.get_adjacency()
+        return adjacency.object_roles(uuid)
 
     async def object_for_url(self, url, record=False, **other_fields):
         """
@@ -571,12 +781,8 @@ class Database(base.Database):
 
     async def get_object_relationships(self, uuid):
         """dictionary of role_id to object_id set"""
-        roles, reverse_roles = await self.get_object_roles(uuid)
-        forward = dict([(r, await self.get_roleset(uuid, r)) for r in roles])
-        reverse = dict(
-            [(r, await self.get_roleset(uuid, r, True)) for r in reverse_roles]
-        )
-        return forward, reverse
+        adjacency = await self.get_adjacency()
+        return adjacency.relationships(uuid)
 
     async def get_related_objects(self, uuid):
         related, rev_related = await self.get_object_relationships(uuid)
@@ -598,16 +804,16 @@ class Database(base.Database):
         :param recursive:
         :return:
         """
-        role_id = self.roles.by_name["group_contains"]
-        res = await self.get_roleset(uuid, role_id, reverse=True)
+        role_id = self.role_id("group_contains")
+        adjacency = await self.get_adjacency()
+        res = adjacency.roleset(uuid, role_id, reverse=True)
         if recursive:
-            return await async_recurse_set(
-                res, lambda gid: self.groups_containing_group(gid)
-            )
+            contained_role_id = self.role_id("contains_group")
+            res |= adjacency.reachable(res, contained_role_id, reverse=True)
         return res
 
-    async def get_object_data(self, uid):
-        obj = await self.get_object(uid)
+    async def get_object_data(self, uid, only_cols=None):
+        obj = await self.get_object(uid, only_cols=only_cols)
         if not obj:
             raise base.NoSuchObject(uid)
         return obj
@@ -631,12 +837,21 @@ class Database(base.Database):
     # Tags
 
     async def get_tagset(self, tag_id, recursive=False):
-        role_id = self.roles.by_name["tag_applies"]
-        tags = set(tag_id)
-        if recursive:
-            tags.update(self.metacontext.subtags(tag_id))
-        sets = [await self.get_roleset(tid, role_id) for tid in tags]
-        return base.reduce(lambda a, b: a | b, sets, set())
+        role_id = self.role_id("tag_applies")
+        tags = self.tag_trie().with_subtags(tag_id) if recursive else {tag_id}
+        rolesets = await self.get_rolesets(tags, role_id)
+        return set().union(*rolesets.values())
+
+    async def get_tagset_bits(self, tag_id, recursive=False):
+        adjacency = await self.get_adjacency()
+        tags = self.tag_trie().with_subtags(tag_id) if recursive else {tag_id}
+        bits = adjacency.union_bits(tags, self.role_id("tag_applies"))
+        return base.IdSet(adjacency.id_map, bits)
+
+    async def get_tagset_under(self, prefix):
+        role_id = self.role_id("tag_applies")
+        rolesets = await self.get_rolesets(self.tag_trie().under(prefix), role_id)
+        return set().union(*rolesets.values())
 
     async def modify_tag_objects(
         self, tag_id, object_ids, do_replace=False, reverse=True
@@ -651,9 +866,9 @@ class Database(base.Database):
         Returns dict with tag_ids as keys and list objects having
         tag as value.
         """
-        tagsets = [await self.get_tagset(t) for t in tags]
-        res = base.zip(tags, [list(ts) for ts in tagsets])
-        return dict(res)
+        role_id = self.role_id("tag_applies")
+        tagsets = await self.get_rolesets(tags, role_id)
+        return {t: list(ts) for t, ts in tagsets.items()}
 
     async def tag_neighbors(self, uuid):
         """
@@ -677,11 +892,19 @@ class Database(base.Database):
 
     async def get_groupset(self, group_id, recursive=False):
         role_id = self.role_id("group_contains")
-        groups = set(group_id)
+        groups = {group_id}
         if recursive:
             groups.update(await self.groups_in_group(group_id))
-        sets = [await self.get_roleset(gid, role_id) for gid in groups]
-        return base.reduce(lambda a, b: a | b, sets, set())
+        rolesets = await self.get_rolesets(groups, role_id)
+        return set().union(*rolesets.values())
+
+    async def get_groupset_bits(self, group_id, recursive=False):
+        adjacency = await self.get_adjacency()
+        groups = {group_id}
+        if recursive:
+            groups.update(adjacency.reachable(groups, self.role_id("contains_group")))
+        bits = adjacency.union_bits(groups, self.role_id("group_contains"))
+        return base.IdSet(adjacency.id_map, bits)
 
     async def modify_group_objects(
         self, group_id, object_ids, do_replace=False, reverse=True
@@ -693,29 +916,36 @@ class Database(base.Database):
 
     async def groups_in_group(self, group_id):
         """get groups contained in group using relations instead of directly"""
-        role_id = self.roles.by_name["contains_group"]
-
-        async def func(gid):
-            return await self.get_roleset(gid, role_id)
-
-        return await async_recurse_set(set(group_id), func)
+        role_id = self.role_id("contains_group")
+        adjacency = await self.get_adjacency()
+        return adjacency.reachable([group_id], role_id)
 
     async def groups_containing_group(self, group_id):
         """get groups containing group using relations instead of directly"""
-        role_id = self.roles.by_name["contains_group"]
-
-        async def func(gid):
-            return await self.get_roleset(gid, role_id, reverse=True)
-
-        return await async_recurse_set(set(group_id), func)
+        role_id = self.role_id("contains_group")
+        adjacency = await self.get_adjacency()
+        return adjacency.reachable([group_id], role_id, reverse=True)
+
+    async def group_contains(self, group_id, item, recursive=False):
+        adjacency = await self.get_adjacency()
+        group_role = self.role_id("contains_group")
+        if self.group_ok(item):
+            if recursive:
+                return adjacency.closure(group_role).contains(group_id, item)
+            return item in adjacency.roleset(group_id, group_role)
+        direct = adjacency.roleset(item, self.role_id("group_contains"), reverse=True)
+        if group_id in direct:
+            return True
+        closure = adjacency.closure(group_role)
+        return recursive and any(closure.contains(group_id, g) for g in direct)
 
     async def groupsets(self, groups):
         """
         Returns dict with group_ids as keys and list objects directly in group as value.
         """
-        sets = [await self.get_groupset(t) for t in groups]
-        res = zip(groups, [list(items) for items in sets])
-        return dict(res)
+        role_id = self.role_id("group_contains")
+        sets = await self.get_rolesets(groups, role_id)
+        return {g: list(items) for g, items in sets.items()}
 
     async def group_neighbors(self, uuid):
         """
@@ -728,12 +958,12 @@ class Database(base.Database):
         return {}
 
     async def objects_in_group(self, group_id, transitive=False):
-        role_id = self.name_to_id("roles", "group_contains")
-        groups = set(group_id)
+        role_id = self.role_id("group_contains")
+        groups = {group_id}
         if transitive:
             groups.update(await self.groups_in_group(group_id))
-        sets = [await self.get_roleset(gid, role_id) for gid in groups]
-        return base.reduce(lambda a, b: a | b, sets, set())
+        rolesets = await self.get_rolesets(groups, role_id)
+        return set().union(*rolesets.values())
 
     async def group(self, oid, group_id):
         role_name = "group_contains" if await self.object_ok(oid) else "contains_group"
@@ -747,13 +977,8 @@ class Database(base.Database):
 
     # Roles
     async def get_role_related(self, role_id):
-        forward = defaultdict(set)
-        reversed = defaultdict(set)
-        async for data in self.collections.related.find(dict(assoc_id=role_id)):
-            subject, object = data["subject_id"], data["object_id"]
-            forward[subject].add(object)
-            reversed[object].add(subject)
-        return forward, reversed
+        adjacency = await self.get_adjacency()
+        return adjacency.role_related(role_id)
 
     async def get_related_by_name(self, uuid):
         related, rev_related = await self.get_object_relationships(uuid)
@@ -768,18 +993,29 @@ class Database(base.Database):
         return res
 
     async def get_roleset(self, subject, role_id, reverse=False):
-        key = role_id + ":" + subject
-        res = None
-        if not res:
-            criteria = {"subject_id": subject, "assoc_id": role_id}
-            col = "object_id"
-            if reverse:
-                criteria = {"object_id": subject, "assoc_id": role_id}
-                col = "subject_id"
-            res = set(
-                await self.collections.related.find(criteria=criteria, only_cols=[col])
-            )
-        return res
+        adjacency = await self.get_adjacency()
+        return adjacency.roleset(subject, role_id, reverse=reverse)
+
+    async def get_roleset_size(self, subject, role_id, reverse=False):
+        adjacency = await self.get_adjacency()
+        return adjacency.roleset_size(subject, role_id, reverse=reverse)
+
+    async def get_degree(self, uuid):
+        adjacency = await self.get_adjacency()
+        return adjacency.degree(uuid)
+
+    async def get_rolesets(self, subject_ids, role_id, reverse=False):
+        adjacency = await self.get_adjacency()
+        return adjacency.rolesets(subject_ids, role_id, reverse=reverse)
+
+    async def get_roleset_closure(self, subject_ids, role_id, reverse=False):
+        found = set()
+        frontier = set(subject_ids)
+        while frontier:
+            rolesets = await self.get_rolesets(frontier, role_id, reverse=reverse)
+            frontier = set().union(*rolesets.values()) - found
+            found.update(frontier)
+        return found
 
     async def modify_object_related(
         self, fixed_id, role_id, object_ids, do_replace=False, reverse=False
@@ -817,24 +1053,16 @@ class Database(base.Database):
         :param role_id: the role id
         :return: the mapping
         """
-        res = defaultdict(set)
-        key, v_key = ["subject", "object"]
-        if reverse:
-            key, v_key = v_key, key
-
-        async for rec in self.collections.related.find({"role": role_id}):
-            res[rec[key]].add(rec[v_key])
-        return res
+        adjacency = await self.get_adjacency()
+        forward, reverse_map = adjacency.role_related(role_id)
+        return reverse_map if reverse else forward
 
     async def get_subjects_related(self, role_id):
         """
         Return just the subjects related by role_id
         """
-        return set(
-            await self.collections.related.find(
-                {"role": role_id}, only_cols=["subject"]
-            )
-        )
+        adjacency = await self.get_adjacency()
+        return adjacency.role_subjects(role_id)
 
     async def get_all_related(self, uuid):
         """
@@ -842,23 +1070,15 @@ class Database(base.Database):
         :param uuid:  the object to find related objects for
         :return: set of object ids of related objects
         """
-        res = set(
-            await self.collections.related.find(
-                {"subject": uuid}, only_cols=["object_id"]
-            )
-        )
-        res.update(
-            await self.collections.related.find(
-                {"object_id": uuid}, only_cols=["subject"]
-            )
-        )
-        return {r for r in res if oid.has_uuid_form(r)}
+        adjacency = await self.get_adjacency()
+        return {r for r in adjacency.related(uuid) if oid.has_uuid_form(r)}
 
     async def relate(self, subject_oid, roleid, object_oid):
         data = meta.Related(
             subject_id=subject_oid, assoc_id=roleid, object_id=object_oid
         )
-        if not await self.collections.related.exists(data.without_kind()):
+        adjacency = await self.get_adjacency()
+        if not adjacency.contains(data):
             return await self.meta_insert(data)
         return data
 
@@ -924,7 +1144,6 @@ class Database(base.Database):
             else:
                 return q
 
-        evaluator = base.QueryEvaluator2(
+        return await self._query_cache.evaluate(
             normalized_query(query), self, self.metacontext
         )
-        return await evaluator()
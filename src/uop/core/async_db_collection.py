@@ -9,15 +9,22 @@ class DatabaseCollections(base.DatabaseCollections):
         super().__init__(db)
 
     async def metadata(self):
-        return {k: await self._collections[k].find() for k in base.shared_collections}
+        """kind -> list of the records of that meta kind, each read by a cursor"""
+        return {
+            k: [r async for r in self._collections[k].iter_find()]
+            for k in base.shared_collections
+        }
 
     async def drop_collections(self, collections):
         for col in collections:
             await col.drop()
 
     async def class_extension(self, cls_id):
-        cls = await self.classes.get(cls_id)
-        return await self.get_class_extension(cls)
+        coll = self.routed_extension(cls_id)
+        if coll is None:
+            cls = await self.classes.get(cls_id)
+            coll = await self.get_class_extension(cls)
+        return coll
 
     async def extension(self, cls):
         name = cls.get(base.cls_extension_field)
@@ -28,12 +35,12 @@ class DatabaseCollections(base.DatabaseCollections):
         return name
 
     async def get_class_extension(self, cls):
-        name = await self.extension(cls)
         cid = cls["id"]
-        coll = self._extensions.get(cid)
+        coll = self.routed_extension(cid)
         if not coll:
+            name = await self.extension(cls)
             coll = await self._db.get_managed_collection(name, schema=cls)
-            self._extensions[cid] = coll
+            self.route_extension(cid, coll)
         return coll
 
     async def ensure_class_extensions(self):
@@ -45,9 +52,10 @@ class DatabaseCollections(base.DatabaseCollections):
         for name in col_map:
             if not self._collections.get(name):
                 schema = base.kind_map.get(name)
-                self._collections[name] = await self._db.get_managed_collection(
-                    col_map[name], schema
-                )
+                coll = await self._db.get_managed_collection(col_map[name], schema)
+                if name in base.unkeyed_kinds:
+                    coll.keyed = False
+                self._collections[name] = coll
 
     def get(self, name):
         return self._collections.get(name)
@@ -79,12 +87,26 @@ class DBCollection(base.DBCollection):
     async def insert(self, **fields):
         pass
 
-    async def bulk_load(self, *ids):
-        pass
+    async def bulk_load(self, ids, only_cols=None):
+        cols = base.bulk.projection(only_cols)
+        found = await self.find({self.ID_Field: {"$in": list(ids)}}, only_cols=cols)
+        return self._page_records(found, cols)
 
     async def remove(self, dict_or_key):
         pass
 
+    async def insert_many(self, records):
+        for record in records:
+            await self.insert(**record)
+
+    async def update_many(self, modifications):
+        for an_id, mods in modifications.items():
+            await self.update_one(an_id, mods)
+
+    async def remove_many(self, dicts_or_keys):
+        for dict_or_key in dicts_or_keys:
+            await self.remove(dict_or_key)
+
     async def remove_all(self):
         return await self.remove({})
 
@@ -97,6 +119,41 @@ class DBCollection(base.DBCollection):
         return []
 
 
+    async def iter_find(
+        self, criteria=None, only_cols=None, order_by=None, batch_size=None
+    ):
+        """
+        Async generator over what find(criteria, only_cols, order_by) returns,
+        fetching batch_size records per round trip, or the rest in one find
+        once a page ends on a record without the ordering field.
+        """
+        paging = self._paging(criteria, only_cols, order_by)
+        if paging is None:
+            for record in await self.find(
+                criteria, only_cols=only_cols, order_by=order_by
+            ):
+                yield record
+            return
+        order_field, cols = paging
+        batch_size = batch_size or self.find_batch_size
+        key_order = list(dict.fromkeys([order_field, self.ID_Field]))
+        page_criteria, limit, read, skip = criteria, batch_size, 0, 0
+        while True:
+            page = await self.find(
+                page_criteria, only_cols=cols, order_by=key_order, limit=limit
+            )
+            records = self._page_records(page, cols)
+            for record in records[skip:]:
+                value = self._projected(record, only_cols)
+                if value is not base._missing:
+                    yield value
+            read += len(page)
+            if limit is None or len(page) < batch_size:
+                return
+            page_criteria = self._page_after(criteria, order_field, records[-1])
+            if page_criteria is None:
+                page_criteria, limit, skip = criteria, None, read
+
     async def ids_only(self, criteria=None):
         return await self.find(criteria=criteria, only_cols=[self.ID_Field])
 
@@ -110,11 +167,12 @@ class DBCollection(base.DBCollection):
     async def contains_id(self, an_id):
         return await self.exists({"id": an_id})
 
-    async def get(self, instance_id):
-        data = None
-        if not data:
-            data = await self.find_one({"id": instance_id})
-        return data
+    async def get(self, instance_id, only_cols=None):
+        if not only_cols:
+            return await self.find_one({"id": instance_id})
+        cols = base.bulk.projection(only_cols)
+        found = await self.find({"id": instance_id}, only_cols=cols, limit=1)
+        return base.bulk.as_record(found[0], cols) if found else None
 
     async def all(self):
         return await self.find()
@@ -125,10 +183,10 @@ class DBCollection(base.DBCollection):
         records in the collection
         :return: the mapping
         """
-        return {x["_id"]: x async for x in self.find()}
+        return {x[self.ID_Field]: x async for x in self.iter_find()}
 
     async def instances(self):
-        return await self.find()
+        return [r async for r in self.iter_find()]
 
     async def replace_one(self, an_id, data):
         await self._coll.replace_one({"id": an_id}, data)
@@ -0,0 +1,68 @@
+"""
+Loading objects of many classes at once, and projecting them.
+
+Requested ids are grouped by class and each class's ids are cut into batches
+of at most batch_size, so no single backend call grows with the request.  The
+batches are independent and callers load them concurrently.  The loaded
+records are then returned in request order, with None for the ids that have
+no object.
+"""
+
+__author__ = "samantha"
+
+from sjasoft.utils.category import partition
+from uop.meta import oid
+
+default_batch_size = 500
+
+
+def batches(uuids, batch_size=default_batch_size):
+    """(class id, ids) pairs covering the distinct uuids, ids at most batch_size long."""
+    res = []
+    for cls_id, ids in partition(dict.fromkeys(uuids), oid.oid_class).items():
+        for start in range(0, len(ids), batch_size):
+            res.append((cls_id, ids[start : start + batch_size]))
+    return res
+
+
+def projection(only_cols):
+    """Columns to load for only_cols, always including the id, or None for all."""
+    if not only_cols:
+        return None
+    return list(dict.fromkeys([oid.id_field, *only_cols]))
+
+
+def projected(record, only_cols):
+    """record cut down to only_cols and its id."""
+    cols = projection(only_cols)
+    if cols is None or record is None:
+        return record
+    return {c: record[c] for c in cols if c in record}
+
+
+def as_record(value, cols):
+    """
+    Record from a result of a find or iter_find with only_cols=cols, which
+    is a bare value when cols is a single column.
+    """
+    if cols is not None and len(cols) == 1:
+        return {cols[0]: value}
+    return value
+
+
+def as_records(found, cols):
+    return (as_record(value, cols) for value in found)
+
+
+def by_id(records):
+    return {r[oid.id_field]: r for r in records}
+
+
+def ordered(uuids, found, preserve_order=True):
+    """
+    The found records in uuids order, None for ids with no record, or if not
+    preserve_order just the found records.
+    """
+    if preserve_order:
+        return [found.get(an_id) for an_id in uuids]
+    return list(found.values())
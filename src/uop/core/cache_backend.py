@@ -0,0 +1,281 @@
+"""
+Cache backends an Interface can share.
+
+A backend is a key value store that also holds sets of ids and combines them
+where they live, after Redis (see docs/redis.org).  Interface keeps object
+records in it and, for tag and group queries, the rolesets of the tags and
+groups involved, so unions and intersections run in the backend and only the
+result comes back.  A backend shared between processes lets every worker use
+the membership sets any of them loaded.
+
+Sets are only trusted once loaded whole by load_set; an empty set is still a
+loaded set.  Applying a changeset adds and removes its related edges in the
+loaded sets they belong to, drops the sets and records of deleted things and
+takes deleted things out of the sets holding them, which LocalCacheBackend
+finds through an index of the sets holding each member.
+
+LocalCacheBackend keeps everything in process.  SharedCacheManager serves one
+LocalCacheBackend from a manager process; its proxies implement the same
+protocol, with the set operations running in the manager process.
+"""
+
+__author__ = "samantha"
+
+from collections import defaultdict
+import fnmatch
+import glob
+from multiprocessing.managers import BaseManager
+from sjasoft.utils.decorations import abstract
+from uop.core.adjacency import edge_parts
+from uop.meta import oid
+
+
+def roleset_set_key(role_id, an_id, reverse=False):
+    return f"roleset:{role_id}:{an_id}:{'r' if reverse else 'f'}"
+
+
+class CacheBackend:
+    """
+    The protocol.  Subclasses implement the primitives; apply_changes is
+    written in terms of them.
+    """
+
+    @abstract
+    def get(self, key):
+        pass
+
+    @abstract
+    def set(self, key, value):
+        """Store value under key, None deleting it."""
+        pass
+
+    @abstract
+    def delete(self, *keys):
+        """Drop values and sets stored under keys."""
+        pass
+
+    @abstract
+    def delete_matching(self, pattern):
+        """Drop every value and set whose key matches a glob pattern."""
+        pass
+
+    @abstract
+    def clear(self):
+        pass
+
+    @abstract
+    def sadd(self, key, *members):
+        pass
+
+    @abstract
+    def srem(self, key, *members):
+        pass
+
+    @abstract
+    def smembers(self, key):
+        pass
+
+    @abstract
+    def scard(self, key):
+        pass
+
+    @abstract
+    def srem_everywhere(self, *members):
+        """Remove members from every set holding them."""
+        pass
+
+    @abstract
+    def srem_class(self, cls_id):
+        """Remove the ids of class cls_id from every set holding them."""
+        pass
+
+    @abstract
+    def sinter(self, *keys):
+        pass
+
+    @abstract
+    def sunion(self, *keys):
+        pass
+
+    @abstract
+    def sdiff(self, key, *keys):
+        """Members of the set at key in none of the sets at keys."""
+        pass
+
+    @abstract
+    def load_set(self, key, members):
+        """Replace the set at key with members, marking it loaded."""
+        pass
+
+    @abstract
+    def unloaded(self, keys):
+        """Those of keys that have no loaded set."""
+        pass
+
+    def _update_edge(self, related, update):
+        subject, role_id, object = edge_parts(related)
+        keys = [
+            roleset_set_key(role_id, subject),
+            roleset_set_key(role_id, object, True),
+        ]
+        missing = set(self.unloaded(keys))
+        if keys[0] not in missing:
+            update(keys[0], object)
+        if keys[1] not in missing:
+            update(keys[1], subject)
+
+    def apply_changes(self, changes):
+        """Bring records and loaded sets up to date with changes."""
+        objects = changes.objects
+        self.delete(*objects.inserted, *objects.modified, *objects.deleted)
+        for related in changes.related.inserted:
+            self._update_edge(related, self.sadd)
+        for related in changes.related.deleted:
+            self._update_edge(related, self.srem)
+        # ids go into key patterns escaped so '*', '?' and '[' in them are literal
+        for role_id in changes.roles.deleted:
+            self.delete_matching(f"roleset:{glob.escape(role_id)}:*")
+        # edges removed with deleted things are not in changes.related
+        for kind in ("objects", "tags", "groups"):
+            deleted = getattr(changes, kind).deleted
+            for an_id in deleted:
+                self.delete_matching(f"roleset:*:{glob.escape(an_id)}:*")
+            self.srem_everywhere(*deleted)
+        classes = changes.classes
+        for cls_id in set(classes.modified) | set(classes.deleted):
+            self.delete_matching(f"*{oid.oid_sep}{glob.escape(cls_id)}")
+        for cls_id in classes.deleted:
+            self.delete_matching(f"roleset:*:*{oid.oid_sep}{glob.escape(cls_id)}:*")
+            self.srem_class(cls_id)
+
+
+class LocalCacheBackend(CacheBackend):
+    """In process backend, also what SharedCacheManager serves."""
+
+    def __init__(self):
+        self._values = {}
+        self._sets = {}
+        self._holding = defaultdict(set)  # member -> keys of the sets holding it
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def set(self, key, value):
+        if value is None:
+            self._values.pop(key, None)
+        else:
+            self._values[key] = value
+
+    def _release(self, key, members):
+        for member in members:
+            keys = self._holding.get(member)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._holding[member]
+
+    def _drop_set(self, key):
+        members = self._sets.pop(key, None)
+        if members:
+            self._release(key, members)
+
+    def delete(self, *keys):
+        for key in keys:
+            self._values.pop(key, None)
+            self._drop_set(key)
+
+    def delete_matching(self, pattern):
+        for key in fnmatch.filter(list(self._values), pattern):
+            del self._values[key]
+        for key in fnmatch.filter(list(self._sets), pattern):
+            self._drop_set(key)
+
+    def clear(self):
+        self._values.clear()
+        self._sets.clear()
+        self._holding.clear()
+
+    def sadd(self, key, *members):
+        self._sets.setdefault(key, set()).update(members)
+        for member in members:
+            self._holding[member].add(key)
+
+    def srem(self, key, *members):
+        members_at = self._sets.get(key)
+        if members_at is not None:
+            members_at.difference_update(members)
+            self._release(key, members)
+
+    def srem_everywhere(self, *members):
+        for member in members:
+            for key in self._holding.pop(member, ()):
+                self._sets[key].discard(member)
+
+    def srem_class(self, cls_id):
+        self.srem_everywhere(*(m for m in self._holding if oid.oid_class(m) == cls_id))
+
+    def smembers(self, key):
+        return set(self._sets.get(key, ()))
+
+    def scard(self, key):
+        return len(self._sets.get(key, ()))
+
+    def _sets_at(self, keys):
+        # smallest first so intersections shrink as fast as possible
+        return sorted((self._sets.get(k, set()) for k in keys), key=len)
+
+    def sinter(self, *keys):
+        if not keys:
+            return set()
+        first, *rest = self._sets_at(keys)
+        return first.intersection(*rest)
+
+    def sunion(self, *keys):
+        return set().union(*(self._sets.get(k, ()) for k in keys))
+
+    def sdiff(self, key, *keys):
+        return self.smembers(key).difference(*(self._sets.get(k, ()) for k in keys))
+
+    def load_set(self, key, members):
+        self._drop_set(key)
+        self._sets[key] = set()
+        self.sadd(key, *members)
+
+    def unloaded(self, keys):
+        return [k for k in keys if k not in self._sets]
+
+
+_served = None
+
+
+def _served_backend():
+    global _served
+    if _served is None:
+        _served = LocalCacheBackend()
+    return _served
+
+
+class SharedCacheManager(BaseManager):
+    """
+    Serves one LocalCacheBackend to every process that connects.  The process
+    owning the cache starts the manager; the others construct it with the
+    same address and authkey and connect.  backend() returns a proxy usable
+    as an Interface cache.
+    """
+
+
+SharedCacheManager.register("backend", callable=_served_backend)
+
+
+def start_shared_cache(address=("127.0.0.1", 0), authkey=None):
+    """Start a manager process serving a cache and return the manager."""
+    manager = SharedCacheManager(address=address, authkey=authkey)
+    manager.start()
+    return manager
+
+
+def connect_shared_cache(address, authkey=None):
+    """Proxy to the cache served at address."""
+    manager = SharedCacheManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.backend()
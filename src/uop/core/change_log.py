@@ -0,0 +1,150 @@
+"""
+Change log checkpoints.
+
+The change log (uop_changes) holds one entry per applied changeset.  Entries
+older than a retention period are folded into checkpoints, one combined
+changeset per tenant per fixed time window, kept in uop_change_checkpoints.
+changes_since then combines the checkpoints ending after the requested time
+followed by the raw entries still in the log.  A time inside a compacted
+window gets the whole window's changes, which reapply harmlessly.
+
+Entries and checkpoints hold their changeset either packed by changeset_codec,
+in a 'packed' field, or in the older dict form in a 'changes' field.
+"""
+
+__author__ = "samantha"
+
+from uop.core import changeset_codec
+from uop.core.changeset import ChangeSet
+from uop.core.query import Q
+from uop.meta.schemas import meta
+
+default_window = 24 * 3600.0
+entry_columns = ("changes", "packed")
+
+
+def stored_changes(changes: ChangeSet, packed=True):
+    """
+    The fields holding changes in a log entry or checkpoint, in dict form if
+    a record holds values the codec cannot pack.
+    """
+    if packed:
+        try:
+            return dict(packed=changeset_codec.encode(changes))
+        except TypeError:
+            pass
+    return dict(changes=changes.to_dict())
+
+
+def entry_changes(entry):
+    """ChangeSet of a log entry or checkpoint in either form."""
+    packed = entry.get("packed")
+    if packed is not None:
+        return changeset_codec.decode(packed)
+    return ChangeSet(**entry["changes"])
+
+
+def entry_delta(entry):
+    """
+    Changes of a log entry or checkpoint to add to a combined ChangeSet.  A
+    packed entry is left packed, its sections decoded only as they are added.
+    """
+    packed = entry.get("packed")
+    if packed is not None:
+        return changeset_codec.PackedChangeSet(packed)
+    return ChangeSet(**entry["changes"])
+
+
+def log_entry(changes: ChangeSet, tenant_id, timestamp, packed=True):
+    """Change log record for changes."""
+    stored = stored_changes(changes, packed)
+    if "packed" in stored:
+        return dict(timestamp=timestamp, tenant_id=tenant_id, **stored)
+    entry = meta.MetaChanges(
+        timestamp=timestamp, tenant_id=tenant_id, changes=changes.to_dict()
+    )
+    return entry.dict()
+
+
+def window_start(timestamp, window):
+    return (timestamp // window) * window
+
+
+def checkpoint_id(tenant_id, start):
+    return f"checkpoint:{tenant_id or ''}:{start!r}"
+
+
+def compactable_criteria(cutoff):
+    """Raw log entries old enough to be compacted."""
+    return Q.lt("timestamp", cutoff)
+
+
+def chain_criteria(epochtime):
+    """Checkpoints holding changes after epochtime."""
+    return Q.gt("end", epochtime)
+
+
+def merged(existing, checkpoint):
+    """checkpoint folded onto an earlier checkpoint for the same window."""
+    combined = entry_changes(existing)
+    combined.add_changes(entry_delta(checkpoint))
+    return dict(
+        checkpoint,
+        count=existing.get("count", 0) + checkpoint["count"],
+        **stored_changes(combined, "packed" in checkpoint),
+    )
+
+
+class LogCompactor:
+    """
+    Folds timestamp ordered change log entries into per tenant window
+    checkpoints.  add returns the checkpoints of windows that the entry
+    shows are complete; finish returns the rest.
+    """
+
+    def __init__(self, window=default_window, packed=True):
+        self.window = window
+        self.packed = packed
+        self._start = None
+        self._open = {}  # tenant_id -> [ChangeSet, entry count]
+
+    def add(self, entry):
+        start = window_start(entry["timestamp"], self.window)
+        done = []
+        if start != self._start:
+            done = self.finish()
+            self._start = start
+        tenant_id = entry.get("tenant_id") or ""
+        current = self._open.get(tenant_id)
+        if current is None:
+            self._open[tenant_id] = [entry_changes(entry), 1]
+        else:
+            current[0].add_changes(entry_delta(entry))
+            current[1] += 1
+        return done
+
+    def finish(self):
+        start, end = self._start, (self._start or 0) + self.window
+        done = [
+            dict(
+                id=checkpoint_id(tenant_id, start),
+                tenant_id=tenant_id,
+                start=start,
+                end=end,
+                timestamp=end,
+                count=count,
+                **stored_changes(changes, self.packed),
+            )
+            for tenant_id, (changes, count) in self._open.items()
+        ]
+        self._open = {}
+        return done
+
+    @staticmethod
+    def window_criteria(checkpoint):
+        """The raw log entries a checkpoint replaces."""
+        return Q.all(
+            Q.gte("timestamp", checkpoint["start"]),
+            Q.lt("timestamp", checkpoint["end"]),
+            Q.eq("tenant_id", checkpoint["tenant_id"]),
+        )
@@ -3,7 +3,7 @@ __author__ = "samantha"
 from collections import defaultdict
 from uop.meta import oid
 from uop.meta import attr_info
-from uop.meta.schemas.meta import MetaContext, Schema, Related
+from uop.meta.schemas.meta import MetaContext, Schema, Related, kind_map
 
 from uop.meta.attr_info import assoc_kinds, meta_kinds, crud_kinds
 from uop.meta.oid import id_field
@@ -22,106 +22,141 @@ class ChangeSetComponent(object):
 
 
 class RelatedChanges(ChangeSetComponent):
+    """
+    Inserted and deleted Related items.  Items in either set are indexed by
+    subject_id, object_id, assoc_id and the classes of subject and object so
+    that deleting an object, tag, group, class or role only visits the items
+    that reference it.
+    """
+
     _object_fields = "object_id", "subject_id"
     kind = "related"
 
     def __init__(self, changeset, data=None):
         data = data or {}
-        items = lambda key: data.get(key, set())
-        self.inserted: set = {Related(d) for d in items("inserted")}
-        self.deleted: set = {Related(d) for d in items("deleted")}
+        items = lambda key: [
+            Related(**d) if isinstance(d, dict) else d for d in data.get(key, ())
+        ]
+        self.inserted: set = set()
+        self.deleted: set = set()
+        self._by_id = defaultdict(set)  # subject or object id -> items
+        self._by_class = defaultdict(set)  # subject or object class -> items
+        self._by_assoc = defaultdict(set)  # assoc_id -> items
+        for item in items("inserted"):
+            self._add(item, self.inserted)
+        for item in items("deleted"):
+            self._add(item, self.deleted)
         ChangeSetComponent.__init__(self, changeset)
 
+    def _index_keys(self, item):
+        for an_id in (item.subject_id, item.object_id):
+            yield self._by_id, an_id
+            yield self._by_class, oid.oid_class(an_id)
+        yield self._by_assoc, item.assoc_id
+
+    def _add(self, item, target):
+        if item not in self.inserted and item not in self.deleted:
+            for index, key in self._index_keys(item):
+                index[key].add(item)
+        target.add(item)
+
+    def _discard(self, item, source):
+        source.discard(item)
+        if item in self.inserted or item in self.deleted:
+            return
+        for index, key in self._index_keys(item):
+            items = index.get(key)
+            if items is not None:
+                items.discard(item)
+                if not items:
+                    del index[key]
+
+    def _drop_all(self, items):
+        for item in list(items):
+            self._discard(item, self.inserted)
+            self._discard(item, self.deleted)
+
     def clear(self):
         self.inserted.clear()
         self.deleted.clear()
+        self._by_id.clear()
+        self._by_class.clear()
+        self._by_assoc.clear()
 
     def has_changes(self):
         return any([self.inserted, self.deleted])
 
+    def _cascaded(self, item):
+        """True if item references something deleted in the containing changeset."""
+        changes = self._changeset
+        for an_id in (item.subject_id, item.object_id):
+            if (
+                an_id in changes.objects.deleted
+                or an_id in changes.tags.deleted
+                or an_id in changes.groups.deleted
+                or oid.oid_class(an_id) in changes.classes.deleted
+            ):
+                return True
+        return item.assoc_id in changes.roles.deleted
+
     def add_changes(self, other):
         """
-        Add subsequent changes to the existing changes
+        Add subsequent changes to the existing changes.  The containing
+        changeset has already taken on the other changeset's deletions, which
+        cascaded to the items held here, so only the other changeset's items
+        need checking against everything deleted so far.
         :param other: the other changeset component
         :return: None
         """
-        deleted_objects = (
-            self._changeset.objects.deleted | other._changeset.objects.deleted
-        )
-        deleted_classes = (
-            self._changeset.classes.deleted | other._changeset.classes.deleted
-        )
-        deleted_tags = self._changeset.tags.deleted | other._changeset.tags.deleted
-        deleted_groups = (
-            self._changeset.groups.deleted | other._changeset.groups.deleted
-        )
-        deleted_roles = self._changeset.roles.deleted | other._changeset.roles.deleted
-
-        self.deleted.update(other.deleted)
-        self.inserted.update(other.inserted)
-        self.inserted -= self.deleted
-        for obj_id in deleted_objects:
-            self.delete_object(obj_id)
-        for cls_id in deleted_classes:
-            self.delete_class(cls_id)
-        for tag_id in deleted_tags:
-            test = lambda x: x == tag_id
-            self.memory_filter(test)
-        for group_id in deleted_groups:
-            test = lambda x: x == group_id
-            self.memory_filter(test)
-        for role_id in deleted_roles:
-            self.delete_association(role_id)
+        for item in other.deleted:
+            self._discard(item, self.inserted)
+            if not self._cascaded(item):
+                self._add(item, self.deleted)
+        for item in other.inserted:
+            if item not in self.deleted and not self._cascaded(item):
+                self._add(item, self.inserted)
 
     def to_dict(self):
+        # sorted so equal changes give equal dicts
+        key = lambda d: (d.subject_id, d.assoc_id, d.object_id)
         return dict(
-            inserted=[d.dict() for d in self.inserted],
-            deleted=[d.dict() for d in self.deleted],
+            inserted=[d.dict() for d in sorted(self.inserted, key=key)],
+            deleted=[d.dict() for d in sorted(self.deleted, key=key)],
         )
 
     def insert(self, data):
         item = Related(**data) if isinstance(data, dict) else data
-        self.inserted.add(item)
+        self._add(item, self.inserted)
         return item
 
     def delete(self, data, unused_changset=None):
         data = Related(**data) if isinstance(data, dict) else data
         if data in self.inserted:
-            self.inserted.discard(data)
+            self._discard(data, self.inserted)
         else:
-            self.deleted.add(data)
+            self._add(data, self.deleted)
 
     def memory_filter(self, object_field_test):
-        self.inserted = {
-            x
-            for x in self.inserted
-            if not (object_field_test(x.subject_id) or object_field_test(x.object_id))
-        }
-        self.deleted = {
+        self._drop_all(
             x
-            for x in self.deleted
-            if not (object_field_test(x.subject_id) or object_field_test(x.object_id))
-        }
+            for x in self.inserted | self.deleted
+            if object_field_test(x.subject_id) or object_field_test(x.object_id)
+        )
 
     def delete_object(self, object_id):
-        test = lambda x: x == object_id
-        self.memory_filter(test)
+        self._drop_all(self._by_id.get(object_id, ()))
 
     def delete_class(self, cls_id):
-        test = lambda x: oid.oid_class(x) == cls_id
-        self.memory_filter(test)
+        self._drop_all(self._by_class.get(cls_id, ()))
 
     def delete_association(self, assoc_id):
-        self.inserted = {x for x in self.inserted if x.assoc_id != assoc_id}
-        self.deleted = {x for x in self.deleted if x.assoc_id != assoc_id}
+        self._drop_all(self._by_assoc.get(assoc_id, ()))
 
     def delete_tag(self, tag_id):
-        test = lambda x: x == tag_id
-        self.memory_filter(test)
+        self._drop_all(self._by_id.get(tag_id, ()))
 
     def delete_group(self, group_id):
-        test = lambda x: x == group_id
-        self.memory_filter(test)
+        self._drop_all(self._by_id.get(group_id, ()))
 
 
 class CrudChanges(ChangeSetComponent):
@@ -276,7 +311,7 @@ class ClassChanges(CrudChanges):
     kind = "classes"
 
     def deletion_criteria(self, key):
-        filter = lambda fld: {"endswith": {fld: key}}
+        filter = lambda fld: {"$endswith": {fld: key}}
         obj_check = filter("object_id")
         subject_check = filter("subject_id")
         return {"$or": [obj_check, subject_check]}
@@ -306,6 +341,7 @@ class ChangeSet(object):
         classes=ClassChanges,
         attributes=AttributeChanges,
         queries=QueryChanges,
+        related=RelatedChanges,
     )
 
     def __init__(self, **data):
@@ -335,6 +371,12 @@ class ChangeSet(object):
         changes = {f: getattr(self, f).has_changes() for f in fields}
         return any(changes.values())
 
+    def has_meta_changes(self):
+        return any(getattr(self, kind).has_changes() for kind in meta_kinds)
+
+    def meta_delta(self):
+        return MetaDelta(self)
+
     def to_dict(self):
         return dict([(key, getattr(self, key).to_dict()) for key in self.change_types])
 
@@ -361,15 +403,29 @@ class ChangeSet(object):
         :return: combined changeset
         """
 
+        return cls.combine_all(changesets)
+
+    @classmethod
+    def combine_all(cls, changesets):
+        """
+        combine_changes over any iterable, consuming it one changeset at a time
+        :param changesets: iterable of changesets, changeset dicts or packed
+        changesets, oldest first
+        :return: combined changeset, None if there were none
+        """
+
         def as_changeset(changes):
-            return changes if isinstance(changes, ChangeSet) else cls(**changes)
+            return cls(**changes) if isinstance(changes, dict) else changes
 
         def as_dict(changes):
             return changes.to_dict() if isinstance(changes, ChangeSet) else changes
 
-        combined = cls(**as_dict(changesets[0]))  # copy of first changeset
-        for cs in changesets[1:]:
-            combined.add_changes(as_changeset(cs))
+        combined = None
+        for cs in changesets:
+            if combined is None:
+                combined = cls(**as_dict(cs))  # copy of first changeset
+            else:
+                combined.add_changes(as_changeset(cs))
         return combined
 
     def clear(self):
@@ -392,6 +448,65 @@ class ChangeSet(object):
         coll.delete(an_id, self)
 
 
+class MetaDelta(object):
+    """
+    The meta kind portions of a changeset, captured so they can be applied to a
+    MetaContext in place after the changeset itself is applied (and cleared).
+    """
+
+    # attributes before classes so class completion sees new attributes
+    kinds = ["attributes", "classes", "roles", "tags", "groups", "queries"]
+
+    def __init__(self, changes: ChangeSet):
+        self.inserted = {}
+        self.modified = {}
+        self.deleted = {}
+        for kind in self.kinds:
+            component = getattr(changes, kind)
+            self.inserted[kind] = [dict(v) for v in component.inserted.values()]
+            self.modified[kind] = {k: dict(v) for k, v in component.modified.items()}
+            self.deleted[kind] = set(component.deleted)
+
+    def changed_kinds(self):
+        return [
+            k
+            for k in self.kinds
+            if self.inserted[k] or self.modified[k] or self.deleted[k]
+        ]
+
+    def has_changes(self):
+        return bool(self.changed_kinds())
+
+    def apply_to(self, context: MetaContext):
+        """
+        Updates context in place. Raises KeyError or ValueError if the changes
+        do not fit the context in which case it should be reloaded instead.
+        :param context: the MetaContext the changes were made against
+        :return: the context
+        """
+        changed = self.changed_kinds()
+        for kind in changed:
+            items = getattr(context, kind)
+            make = kind_map[kind]
+            for an_id in self.deleted[kind]:
+                known = items.by_id.get(an_id)
+                if known:
+                    items.remove_item(known)
+            for an_id, mods in self.modified[kind].items():
+                known = items.by_id[an_id]
+                items.remove_item(known)
+                items.add_item(make(**dict(known.dict(), **mods)))
+            for data in self.inserted[kind]:
+                items.add_item(make(**data))
+        if "classes" in changed or "attributes" in changed:
+            context.class_children = {}
+            context.complete_classes()
+        if "groups" in changed:
+            context.group_children = {}
+            context.complete_groups()
+        return context
+
+
 def meta_context_as_changeset(context: MetaContext):
     """
     Builds a changeset matching the context. This is primarily used
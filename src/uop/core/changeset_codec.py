@@ -0,0 +1,316 @@
+"""
+Versioned binary encoding of changesets.
+
+A packed changeset is a 5 byte header, the magic b'UCS', a version byte and
+a flags byte, followed by the body, zlib compressed when that makes it smaller.
+The body is
+
+  - the string table: every id the changeset mentions, each stored once
+  - a directory giving the byte length of each component's section
+  - the sections themselves, in the order of component_kinds
+
+Crud sections list inserted and modified records as (id, json) pairs and
+deleted ids, all ids as indexes into the string table.  The related section
+holds inserted and deleted items as packed (subject, assoc, object) index
+triples.  Decoding only reads the string table and the sections of components
+that have changes.  Integers are unsigned LEB128 varints.
+
+Record json is a plain object unless the record holds datetimes, dates or
+bytes; then it is a one element array around the object, with those values
+written as single key objects such as {"$datetime": iso}.
+"""
+
+__author__ = "samantha"
+
+import base64
+import datetime
+import json
+import zlib
+from uop.core.changeset import ChangeSet
+from uop.meta.oid import id_field
+from uop.meta.schemas.meta import Related
+
+magic = b"UCS"
+version = 1
+compressed_flag = 1
+compress_threshold = 256
+
+crud_kinds = ["objects", "roles", "tags", "groups", "classes", "attributes", "queries"]
+component_kinds = crud_kinds + ["related"]
+
+
+def is_packed(value):
+    return isinstance(value, (bytes, bytearray, memoryview))
+
+
+def _put_varint(out: bytearray, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _put_bytes(out, raw):
+    _put_varint(out, len(raw))
+    out += raw
+
+
+def _get_bytes(data, pos):
+    size, pos = _get_varint(data, pos)
+    return bytes(data[pos : pos + size]), pos + size
+
+
+class _Strings:
+    def __init__(self):
+        self.index = {}
+        self.values = []
+
+    def __call__(self, value):
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+
+def tagged_json(value):
+    """json.dumps default writing datetimes, dates and bytes as tagged objects."""
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"$date": value.isoformat()}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$bytes": base64.b64encode(value).decode()}
+    raise TypeError(f"cannot pack a {type(value).__name__} value")
+
+
+_untagged = {
+    "$datetime": datetime.datetime.fromisoformat,
+    "$date": datetime.date.fromisoformat,
+    "$bytes": base64.b64decode,
+}
+
+
+def untagged_json(obj):
+    """json.loads object_hook reading back what tagged_json wrote."""
+    if len(obj) == 1:
+        ((key, value),) = obj.items()
+        convert = _untagged.get(key)
+        if convert is not None:
+            return convert(value)
+    return obj
+
+
+def _json(data):
+    try:
+        raw = json.dumps(data, separators=(",", ":"))
+    except TypeError:
+        raw = json.dumps([data], separators=(",", ":"), default=tagged_json)
+    return raw.encode()
+
+
+def _record(raw):
+    if raw[:1] == b"[":
+        return json.loads(raw, object_hook=untagged_json)[0]
+    return json.loads(raw)
+
+
+def _crud_section(component, intern):
+    out = bytearray()
+    for records in (component.inserted, component.modified):
+        _put_varint(out, len(records))
+        for an_id, data in records.items():
+            # a record's own id field is restored from its key
+            implied = data.get(id_field) == an_id
+            if implied:
+                data = {k: v for k, v in data.items() if k != id_field}
+            _put_varint(out, intern(an_id) << 1 | implied)
+            _put_bytes(out, _json(data))
+    _put_varint(out, len(component.deleted))
+    for an_id in component.deleted:
+        _put_varint(out, intern(an_id))
+    return out
+
+
+def _related_section(component, intern):
+    out = bytearray()
+    for items in (component.inserted, component.deleted):
+        _put_varint(out, len(items))
+        for item in items:
+            for an_id in (item.subject_id, item.assoc_id, item.object_id):
+                _put_varint(out, intern(an_id))
+    return out
+
+
+def encode(changes: ChangeSet):
+    """Packed bytes of a changeset."""
+    intern = _Strings()
+    sections = []
+    for kind in component_kinds:
+        component = getattr(changes, kind)
+        if not component.has_changes():
+            sections.append(b"")
+        elif kind == "related":
+            sections.append(_related_section(component, intern))
+        else:
+            sections.append(_crud_section(component, intern))
+    body = bytearray()
+    table = bytearray()
+    _put_varint(table, len(intern.values))
+    for value in intern.values:
+        _put_bytes(table, value.encode())
+    _put_bytes(body, table)
+    for section in sections:
+        _put_varint(body, len(section))
+    for section in sections:
+        body += section
+    flags = 0
+    if len(body) > compress_threshold:
+        packed = zlib.compress(body)
+        if len(packed) < len(body):
+            body, flags = packed, compressed_flag
+    return magic + bytes((version, flags)) + bytes(body)
+
+
+class _Component:
+    """A decoded section read like the changeset component it came from."""
+
+    def __init__(self, kind, data):
+        self.inserted = data.get("inserted", [] if kind == "related" else {})
+        self.modified = data.get("modified", {})
+        self.deleted = data.get("deleted", [])
+
+    def has_changes(self):
+        return bool(self.inserted or self.modified or self.deleted)
+
+
+class PackedChangeSet:
+    """
+    Read access to a packed changeset.  Only the header and section directory
+    are read up front; the string table and each section are decoded on first
+    use.  Components are attributes as on ChangeSet, so a packed changeset can
+    be added to a ChangeSet without decoding its unchanged sections.
+    """
+
+    def __init__(self, data):
+        data = bytes(data)
+        if data[:3] != magic:
+            raise ValueError("not a packed changeset")
+        if data[3] != version:
+            raise ValueError(f"unsupported packed changeset version {data[3]}")
+        body = data[5:]
+        if data[4] & compressed_flag:
+            body = zlib.decompress(body)
+        self._body = body
+        table_size, pos = _get_varint(body, 0)
+        self._table_at = pos
+        pos += table_size
+        self._sections = {}
+        lengths = []
+        for kind in component_kinds:
+            length, pos = _get_varint(body, pos)
+            lengths.append((kind, length))
+        for kind, length in lengths:
+            self._sections[kind] = (pos, length)
+            pos += length
+        self._strings = None
+        self._decoded = {}
+
+    def __getattr__(self, name):
+        if name in component_kinds:
+            return _Component(name, self.section(name))
+        raise AttributeError(name)
+
+    def changed_kinds(self):
+        return [k for k, (_, length) in self._sections.items() if length]
+
+    def has_changes(self):
+        return bool(self.changed_kinds())
+
+    @property
+    def strings(self):
+        if self._strings is None:
+            body, pos = self._body, self._table_at
+            count, pos = _get_varint(body, pos)
+            strings = []
+            for _ in range(count):
+                raw, pos = _get_bytes(body, pos)
+                strings.append(raw.decode())
+            self._strings = strings
+        return self._strings
+
+    def section(self, kind):
+        """One component in the form ChangeSet takes it."""
+        if kind not in self._decoded:
+            start, length = self._sections[kind]
+            if not length:
+                return {}
+            if kind == "related":
+                self._decoded[kind] = self._read_related(start)
+            else:
+                self._decoded[kind] = self._read_crud(start)
+        return self._decoded[kind]
+
+    def _read_crud(self, pos):
+        body, strings = self._body, self.strings
+        res = {}
+        for key in ("inserted", "modified"):
+            count, pos = _get_varint(body, pos)
+            records = {}
+            for _ in range(count):
+                ref, pos = _get_varint(body, pos)
+                raw, pos = _get_bytes(body, pos)
+                an_id, data = strings[ref >> 1], _record(raw)
+                if ref & 1:
+                    data[id_field] = an_id
+                records[an_id] = data
+            res[key] = records
+        count, pos = _get_varint(body, pos)
+        deleted = []
+        for _ in range(count):
+            ref, pos = _get_varint(body, pos)
+            deleted.append(strings[ref])
+        res["deleted"] = deleted
+        return res
+
+    def _read_related(self, pos):
+        body, strings = self._body, self.strings
+        res = {}
+        for key in ("inserted", "deleted"):
+            count, pos = _get_varint(body, pos)
+            items = []
+            for _ in range(count):
+                ids = []
+                for _ in range(3):
+                    ref, pos = _get_varint(body, pos)
+                    ids.append(strings[ref])
+                subject_id, assoc_id, object_id = ids
+                items.append(
+                    Related(
+                        subject_id=subject_id, assoc_id=assoc_id, object_id=object_id
+                    )
+                )
+            res[key] = items
+        return res
+
+    def to_dict(self):
+        return {kind: self.section(kind) for kind in self.changed_kinds()}
+
+    def changeset(self):
+        return ChangeSet(**self.to_dict())
+
+
+def decode(data):
+    """ChangeSet from packed bytes."""
+    return PackedChangeSet(data).changeset()
@@ -8,6 +8,8 @@ uop_collection_names = dict(
     queries='uop_queries',
     related='uop_related',
     changes='uop_changes',
+    change_checkpoints='uop_change_checkpoints',
+    meta_snapshots='uop_meta_snapshots',
     databases='uop_database',
     tenants='uop_tenants',
     schemas='uop_schemas',
@@ -19,8 +21,12 @@ crud_kinds = ['objects', 'classes', 'roles', 'tags',
 meta_kinds = crud_kinds[1:]  # TODO reconsider queries which are mixed!
 internal_kinds = ['database', 'tenants', 'schemas', 'users', 'applications', 'application_tenants']
 assoc_kinds = ['related']
-per_tenant_kinds = assoc_kinds + ['changes'] + meta_kinds
+per_tenant_kinds = (
+    assoc_kinds + ['changes', 'change_checkpoints', 'meta_snapshots'] + meta_kinds
+)
 kinds = crud_kinds + assoc_kinds
+# records of these kinds have no unique id to page on
+unkeyed_kinds = assoc_kinds + ['changes', 'change_checkpoints']
 shared_collections = crud_kinds[1:]
 
 
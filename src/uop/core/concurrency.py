@@ -0,0 +1,122 @@
+"""
+Helpers for running independent awaitables, or blocking calls, concurrently,
+and for writing a changeset as stages of such awaitables.
+"""
+
+__author__ = "samantha"
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+async def gather_bounded(limit, awaitables):
+    """
+    Results of awaitables, in order, with at most limit of them running at once.
+    :param limit: most awaitables in flight, None or 0 for no limit
+    :param awaitables: coroutines or other awaitables
+    :return: list of results
+    """
+    awaitables = list(awaitables)
+    if not awaitables:
+        return []
+    if not limit or limit >= len(awaitables):
+        return await asyncio.gather(*awaitables)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(awaitable):
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*(bounded(a) for a in awaitables))
+
+
+async def as_completed_bounded(awaitables, limit=None, timeout=None):
+    """
+    Async iterator over the results of awaitables in the order they complete,
+    with at most limit running at once.  A call taking longer than timeout
+    seconds raises asyncio.TimeoutError; the calls still pending are then
+    cancelled, as they are if the caller stops iterating early.
+    :param awaitables: coroutines or other awaitables
+    :param limit: most awaitables in flight, None or 0 for no limit
+    :param timeout: seconds allowed each call once started, None for no limit
+    """
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def run(awaitable):
+        if timeout is not None:
+            awaitable = asyncio.wait_for(awaitable, timeout)
+        if semaphore is None:
+            return await awaitable
+        async with semaphore:
+            return await awaitable
+
+    tasks = [asyncio.ensure_future(run(a)) for a in awaitables]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def written_ids(changes):
+    """Ids inserted, modified or deleted by a crud changeset component."""
+    return list(dict.fromkeys([*changes.inserted, *changes.modified, *changes.deleted]))
+
+
+async def write_in_order(coll, changes, ids):
+    """The inserts, updates and removes of changes for ids to coll, in that order."""
+    inserted = [changes.inserted[k] for k in ids if k in changes.inserted]
+    modified = {k: changes.modified[k] for k in ids if k in changes.modified}
+    deleted = [k for k in ids if k in changes.deleted]
+    if inserted:
+        await coll.insert_many(inserted)
+    if modified:
+        await coll.update_many(modified)
+    if deleted:
+        await coll.remove_many(deleted)
+
+
+async def apply_staged(changeset, kinds, meta_collection, extensions, cascade, limit):
+    """
+    Writes the crud changes of changeset in three stages, each running its
+    independent parts concurrently: meta collection writes, then object writes
+    grouped by extension collection, then cascade cleanup of everything deleted.
+    :param kinds: crud kinds to write
+    :param meta_collection: function of a kind other than objects to its collection
+    :param extensions: async function of object ids to (collection, ids) pairs
+    :param cascade: async function of (kind, id) cleaning up after a delete
+    :param limit: most writes in flight per stage
+    """
+    meta = [getattr(changeset, k) for k in kinds if k != "objects"]
+    await gather_bounded(
+        limit,
+        (write_in_order(meta_collection(c.kind), c, written_ids(c)) for c in meta),
+    )
+    objects = changeset.objects
+    parts = await extensions(written_ids(objects))
+    await gather_bounded(
+        limit, (write_in_order(coll, objects, ids) for coll, ids in parts)
+    )
+    await gather_bounded(
+        limit,
+        (
+            cascade(kind, an_id)
+            for kind in kinds
+            for an_id in getattr(changeset, kind).deleted
+        ),
+    )
+
+
+def map_threaded(fun, items, limit=None):
+    """
+    fun(item) for each of items, in order, run on at most limit threads.
+    :param limit: most calls in flight, None or 0 for one thread per item
+    :return: list of results
+    """
+    items = list(items)
+    workers = min(limit or len(items), len(items))
+    if workers <= 1:
+        return [fun(item) for item in items]
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(fun, items))
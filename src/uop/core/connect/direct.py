@@ -1,6 +1,7 @@
 from uop.core.connect import generic
 from uop.core.database import Database
 from uop.core import db_service, changeset
+from uop.meta.schemas import meta
 import asyncio
 
 
@@ -35,8 +36,14 @@ class DirectConnection(generic.GenericConnection):
         the_changes = changeset.ChangeSet(**changes)
         self.dbi.apply_changes(the_changes)
 
-    def get_object(self, obj_id):
-        return self.dbi.get_object(obj_id)
+    def get_object(self, obj_id, only_cols=None):
+        return self.dbi.get_object(obj_id, only_cols=only_cols)
+
+    def class_instances(self, cls_name, only_cols=None):
+        return self.dbi.class_instances(cls_name, only_cols=only_cols)
+
+    def instances_satisfying(self, cls_name, criteria, only_cols=None):
+        return self.dbi.instances_satisfying(cls_name, criteria, only_cols=only_cols)
 
     def get_object_groups(self, object_id):
         return self.dbi.get_object_groups(object_id)
@@ -194,7 +201,9 @@ class DirectConnection(generic.GenericConnection):
 
     def run_query(self, query_id=None, query=None):
         the_query = self.dbi.queries.get(query_id) if query_id else query
-        return self.dbi.query(query)
+        if isinstance(the_query, dict):
+            the_query = meta.MetaQuery.from_dict(the_query)
+        return self.dbi.query(the_query)
 
-    def bulk_load(self, ids, perserve_order=True):
-        return self.dbi.bulk_load(ids, perserve_order)
+    def bulk_load(self, ids, perserve_order=True, only_cols=None):
+        return self.dbi.bulk_load(ids, perserve_order, only_cols=only_cols)
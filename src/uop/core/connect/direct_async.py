@@ -30,8 +30,8 @@ class AsyncDBClient(direct.DirectConnection):
         if self._tenant:
             await self._service.update_if_app_changes(self._tenant, **the_changes)
 
-    async def get_object(self, obj_id):
-        return await super().get_object(obj_id)
+    async def get_object(self, obj_id, only_cols=None):
+        return await super().get_object(obj_id, only_cols=only_cols)
 
     async def get_object_groups(self, object_id):
         return super().get_object_groups(object_id)
@@ -189,5 +189,5 @@ class AsyncDBClient(direct.DirectConnection):
         the_query = (await self.dbi.queries.get(query_id)) if query_id else query
         return await self.dbi.query(query)
 
-    async def bulk_load(self, ids, perserve_order=True):
-        return await self.dbi.bulk_load(ids, perserve_order)
+    async def bulk_load(self, ids, perserve_order=True, only_cols=None):
+        return await self.dbi.bulk_load(ids, perserve_order, only_cols=only_cols)
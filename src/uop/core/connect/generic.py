@@ -35,7 +35,13 @@ class GenericConnection():
     def record_changes(self, changes):
         pass
 
-    def get_object(self, obj_id):
+    def get_object(self, obj_id, only_cols=None):
+        pass
+
+    def class_instances(self, cls_name, only_cols=None):
+        pass
+
+    def instances_satisfying(self, cls_name, criteria, only_cols=None):
         pass
 
     def get_object_groups(self, object_id):
@@ -193,7 +199,7 @@ class GenericConnection():
     def run_query(self, query_id=None, query=None):
         pass
 
-    def bulk_load(self, ids, items_only=True):
+    def bulk_load(self, ids, items_only=True, only_cols=None):
         pass
 
     def id_to_name(self, kind):
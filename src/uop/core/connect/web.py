@@ -30,13 +30,18 @@ class WebConnection(generic.GenericConnection):
         return self._url_head + '/'.join(list(parts))
 
     def get(self, *path, **params):
-        res = self._session.get(self._make_url(*path))
+        res = self._session.get(self._make_url(*path), params=params)
         return res.json()
 
-    def post(self, *path, data):
-        res = self._session.post(self._make_url(*path), json=data)
+    def post(self, *path, data, **params):
+        res = self._session.post(self._make_url(*path), json=data, params=params)
         return res.json()
 
+    @staticmethod
+    def _projection(only_cols):
+        """query parameters asking the server for only_cols of objects"""
+        return {'only_cols': ','.join(only_cols)} if only_cols else {}
+
     def put(self, *path, data):
         res = self._session.put(self._make_url(*path), json=data)
         return res.json()
@@ -83,8 +88,9 @@ class WebConnection(generic.GenericConnection):
     def metadata(self):
         return self.get('metadata')
 
-    def class_instances(self, cls_name):
-        return self.post('run-query', data={'$and': {'$type': cls_name}})
+    def class_instances(self, cls_name, only_cols=None):
+        return self.post('run-query', data={'$and': {'$type': cls_name}},
+                         **self._projection(only_cols))
 
     def get_changes(self, until=None):
         if not until:
@@ -94,8 +100,8 @@ class WebConnection(generic.GenericConnection):
     def record_changes(self, changes):
         return self.post('changes', data=changes)
 
-    def get_object(self, obj_id):
-        return self.get('objects', obj_id)
+    def get_object(self, obj_id, only_cols=None):
+        return self.get('objects', obj_id, **self._projection(only_cols))
 
     def get_object_groups(self, object_id):
         return self.get('object-groups', object_id)
@@ -137,7 +143,7 @@ class WebConnection(generic.GenericConnection):
         return self.put('related-objects', object_id, role_id, data=object_ids)
 
     def set_related_objects(self, object_id, role_id, object_ids):
-        return self.post('related-objects', object_id, role_id, data=object_ids)wvbm 
+        return self.post('related-objects', object_id, role_id, data=object_ids)
 
     def get_tagged(self, tag_id):
         return self.get('tagged', tag_id)
@@ -240,6 +246,6 @@ class WebConnection(generic.GenericConnection):
         else:
             raise Exception('Either query_id or query must be specified')
 
-    def bulk_load(self, ids):
-        return self.post('bulk-load', data={'ids': ids})
+    def bulk_load(self, ids, only_cols=None):
+        return self.post('bulk-load', data={'ids': ids}, **self._projection(only_cols))
 
@@ -21,6 +21,14 @@ linked blocks of either actual object data (clustering) or of object references.
 """
 
 from uop.core import db_collection as db_coll
+from uop.core.adjacency import AdjacencyIndex
+from uop.core.query_cache import QueryCache, changed_ids
+from uop.core.query_pages import PageRows, query_page
+from uop.core.object_cache import ObjectCache, absent
+from uop.core import bulk_load as bulk
+from uop.core.concurrency import map_threaded
+from uop.core.tag_trie import TagTrie
+from uop.core.idsets import IdSet
 from uop.core.collections import (
     uop_collection_names,
     per_tenant_kinds,
@@ -29,20 +37,22 @@ from uop.core.collections import (
 )
 from uop.meta.schemas import schema_store
 from uop.core import changeset
+from uop.core import change_log
+from uop.core import meta_snapshot
 from sjasoft.web.url import is_url
 from sjasoft.utils.tools import match_fields
 from sjasoft.utils.category import partition
-from sjasoft.utils.data import recurse_set
 from uop.meta.schemas import meta
 from uop.meta.schemas.meta import MetaContext, BaseModel, kind_map
 from sjasoft.utils import decorations
 from sjasoft.utils import logging, index
 from sjasoft.utils.decorations import abstract
-from uop.core.query import Q, QueryEvaluator2
+from uop.core.query import Q
 from uop.meta import oid
 from uop.core.exceptions import NoSuchObject
 from collections import defaultdict
 from functools import reduce
+from itertools import chain
 import time
 from collections import defaultdict
 from contextlib import contextmanager
@@ -100,6 +110,11 @@ class Database(object):
         self._tenant: meta.Tenant = None
         self._context: meta.MetaContext = None
         self._changeset: changeset.ChangeSet = None
+        self._adjacency = AdjacencyIndex()
+        self._query_cache = QueryCache()
+        self._query_pages = PageRows()
+        self._object_cache = ObjectCache()
+        self._tag_trie = None
         self._known_schemas = set()
         self._mandatory_schemas = schemas
         self._schema_store = schema_store.SchemaStore()
@@ -114,6 +129,45 @@ class Database(object):
     def reload_metacontext(self):
         coll_meta = self.get_metadata()
         self._context = MetaContext.from_data(coll_meta)
+        self._tag_trie = None
+
+    def tag_trie(self):
+        """TagTrie of the current tags, built on first use after a reload."""
+        if self._tag_trie is None:
+            self._tag_trie = TagTrie(self.metacontext.tags.by_id.values())
+        return self._tag_trie
+
+    def forget_class_extensions(self, delta):
+        """Drops the extension routes of classes a MetaDelta modifies or deletes."""
+        changed = set(delta.deleted["classes"]) | set(delta.modified["classes"])
+        if changed and self._collections:
+            self._collections.forget_extensions(changed)
+
+    def update_metacontext(self, delta):
+        """
+        Brings the metacontext up to date with an applied changeset's MetaDelta
+        without re-reading the meta collections.  Falls back to a full reload if
+        the delta does not fit the current context.
+        """
+        if not delta.has_changes():
+            return
+        self.forget_class_extensions(delta)
+        if self._context is None:
+            self.reload_metacontext()
+            return
+        try:
+            delta.apply_to(self._context)
+            if self._tag_trie is not None:
+                self._tag_trie.apply_delta(delta)
+        except (KeyError, ValueError) as e:
+            logger.warning("reloading metacontext after failed delta: %s", e)
+            self.reload_metacontext()
+
+    def get_adjacency(self):
+        """The related adjacency index, loaded from uop_related on first use."""
+        if not self._adjacency.loaded:
+            self._adjacency.load(self.collections.related.iter_find())
+        return self._adjacency
 
     @contextmanager
     def changes(self):
@@ -331,7 +385,6 @@ class Database(object):
     def end_long_transaction(self):
         self._long_txn_start = 0
         self._changeset = None
-        self.reload_metacontext()
 
     def begin_transaction(self):
         if not self.in_long_transaction:
@@ -340,6 +393,9 @@ class Database(object):
 
     def abort(self):
         self.db_abort()
+        self._adjacency.reset()
+        self._query_cache.clear()
+        self._object_cache.clear()
         self.end_long_transaction()
 
     def db_commit(self):
@@ -392,7 +448,6 @@ class Database(object):
         has_changes = changes.has_changes()
         if has_changes:
             self.apply_changes(changes)
-            self.reload_metacontext()
         self.add_schema(a_schema)
         self._known_schemas.add(a_schema.name)
 
@@ -408,12 +463,91 @@ class Database(object):
             if self._tenant:
                 colmap.update(self._tenant.base_collections)
         self._collections.ensure_collections(colmap)
-        self._collections.ensure_class_extensions()
         self._collections_complete = True
-        self.reload_metacontext()
-        self._known_schemas = self.db_schema_names()
+        self._adjacency.reset()
+        self._query_cache.clear()
+        self._object_cache.clear()
+        generation = self.meta_generation()
+        if not self.load_meta_snapshot(generation):
+            self.reload_metacontext()
+            self._known_schemas = self.db_schema_names()
+            self.save_meta_snapshot(generation or self.stamp_meta_generation())
         for schema_name in self._mandatory_schemas:
             self.ensure_schema(schema_name)
+        if self._known_schemas != self._snapshot_schemas:
+            self.save_meta_snapshot(self.meta_generation())
+
+    # MetaContext snapshots.  Applying meta changes stamps a new generation
+    # before commit and saves a snapshot at it afterwards.  A context taken at
+    # an earlier generation than the one stamped over misses another process's
+    # changes, so it is rebuilt from the meta collections before being saved.
+
+    use_meta_snapshot = True
+    _snapshot_schemas = None
+    _context_generation = None  # generation the metacontext was taken at
+
+    @staticmethod
+    def _store_record(coll, record):
+        if coll.contains_id(record["id"]):
+            coll.replace_one(record["id"], record)
+        else:
+            coll.insert(**record)
+
+    def meta_generation(self):
+        """The current meta generation stamp or None if there is none yet."""
+        if not self.use_meta_snapshot:
+            return None
+        stamp = self.collections.meta_snapshots.get(meta_snapshot.stamp_id)
+        return stamp and stamp.get("generation")
+
+    def stamp_meta_generation(self):
+        """Starts a new meta generation, making any stored snapshot stale."""
+        if not self.use_meta_snapshot:
+            return None
+        generation = meta_snapshot.new_generation()
+        stamp = dict(id=meta_snapshot.stamp_id, generation=generation)
+        self._store_record(self.collections.meta_snapshots, stamp)
+        return generation
+
+    def stored_snapshot(self, generation):
+        """The stored snapshot record if it was taken at generation, else None."""
+        if not (self.use_meta_snapshot and generation):
+            return None
+        snapshot = self.collections.meta_snapshots.get(meta_snapshot.snapshot_id)
+        if not snapshot or snapshot.get("generation") != generation:
+            return None
+        return snapshot
+
+    def load_meta_snapshot(self, generation):
+        """
+        Sets the metacontext and known schemas from the stored snapshot if it
+        was taken at generation.
+        :return: True if the snapshot was used
+        """
+        snapshot = self.stored_snapshot(generation)
+        if snapshot is None:
+            return False
+        self._context = meta_snapshot.decode_context(snapshot["context"])
+        self._tag_trie = None
+        self._known_schemas = set(snapshot["schemas"])
+        self._snapshot_schemas = set(self._known_schemas)
+        self._context_generation = generation
+        return True
+
+    def save_meta_snapshot(self, generation):
+        if not (self.use_meta_snapshot and generation) or self._context is None:
+            return
+        record = meta_snapshot.snapshot_record(
+            self._context, generation, self._known_schemas
+        )
+        self._store_record(self.collections.meta_snapshots, record)
+        self._snapshot_schemas = set(self._known_schemas)
+        self._context_generation = generation
+
+    def snapshot_metacontext(self):
+        """MetaContext from the stored snapshot if it is current, else None."""
+        snapshot = self.stored_snapshot(self.meta_generation())
+        return snapshot and meta_snapshot.decode_context(snapshot["context"])
 
     def db_schema_names(self):
         schemas_coll = self._collections.schemas
@@ -429,11 +563,66 @@ class Database(object):
         We could log external to the main database but here we will presume that
         logging is local.
         """
-        changes = meta.MetaChanges(
-            timestamp=time.time(), tenant_id=tenant_id, changes=changeset.to_dict()
+        entry = change_log.log_entry(
+            changeset, tenant_id, time.time(), self.packed_change_log
         )
         coll = self.collections.changes
-        coll.insert(**changes.dict())
+        coll.insert(**entry)
+        if self.compaction_due(entry["timestamp"]):
+            self.compact_change_log(entry["timestamp"])
+
+    # Change log retention.  Raw entries older than change_retention seconds
+    # are folded into one checkpoint per checkpoint_window per tenant.
+
+    checkpoint_window = change_log.default_window
+    packed_change_log = True  # False logs the dict form of changesets
+    change_retention = None  # keep all raw entries
+    _last_compaction = 0.0
+
+    def compaction_due(self, now):
+        return (
+            self.change_retention is not None
+            and now - self._last_compaction >= self.checkpoint_window
+        )
+
+    def compact_change_log(self, now=None):
+        """
+        Folds raw change log entries past retention into window checkpoints and
+        removes them from the log.
+        :param now: time to apply retention from, defaults to the current time
+        :return: number of raw entries compacted
+        """
+        if self.change_retention is None:
+            return 0
+        now = now or time.time()
+        self._last_compaction = now
+        window = self.checkpoint_window
+        cutoff = change_log.window_start(now - self.change_retention, window)
+        log = self.collections.changes
+        checkpoints = self.collections.change_checkpoints
+        compactor = change_log.LogCompactor(window, self.packed_change_log)
+        compacted = 0
+
+        def store(done):
+            nonlocal compacted
+            for checkpoint in done:
+                existing = checkpoints.get(checkpoint["id"])
+                if existing:
+                    checkpoint = change_log.merged(existing, checkpoint)
+                    checkpoints.remove(checkpoint["id"])
+                checkpoints.insert(**checkpoint)
+                log.remove(compactor.window_criteria(checkpoint))
+                compacted += checkpoint["count"] - (
+                    existing.get("count", 0) if existing else 0
+                )
+
+        entries = log.iter_find(
+            change_log.compactable_criteria(cutoff), order_by=("timestamp",)
+        )
+        for entry in entries:
+            store(compactor.add(entry))
+        store(compactor.finish())
+        return compacted
 
     def changes_since(self, epochtime, tenant_id, device_id=None):
         """Get and return the aggregate changes since the given time made by others
@@ -451,16 +640,24 @@ class Database(object):
         tenant_id = tenant_id or 0
         device_id = device_id or 0
         criteria = Q.all(Q.gt("timestamp", epochtime), Q.neq("device_id", device_id))
-        changesets = self.collections.changes.find(
-            criteria, order_by=("timestamp",), only_cols=("changes",)
+        checkpoints = self.collections.change_checkpoints.iter_find(
+            change_log.chain_criteria(epochtime),
+            order_by=("start",),
+            only_cols=change_log.entry_columns,
         )
-        return changeset.ChangeSet.combine_changes(*changesets)
+        tail = self.collections.changes.iter_find(
+            criteria, order_by=("timestamp",), only_cols=change_log.entry_columns
+        )
+        entries = chain(checkpoints, tail)
+        return changeset.ChangeSet.combine_all(map(change_log.entry_delta, entries))
 
     def remove_collection(self, collection_name):
         pass
 
     def apply_changes(self, changeset):
         extensions_to_remove = []
+        meta_delta = changeset.meta_delta()
+        touched = changed_ids(changeset, self.metacontext)
 
         def get_all_class_attributes():
             res = dict()
@@ -497,11 +694,15 @@ class Database(object):
             if cls:
                 coll_name = getattr(cls, cls_extension_field)
                 if coll_name:
-                    coll = self.collections.get(coll_name)
-                    if coll:
-                        coll.drop()
+                    # extensions are opened lazily, so this one may not be open
+                    coll = self.collections.routed_extension(cls_id)
+                    if coll is None:
+                        coll = self.get_managed_collection(coll_name, cls.dict())
+                    coll.drop()
+                    self.collections.forget_extensions([cls_id])
             criteria = changeset.classes.deletion_criteria(cls_id)
             self.collections.related.remove(criteria)
+            self._adjacency.remove_class(cls_id)
 
         def delete_attribute(attr_id):
             pass
@@ -509,12 +710,13 @@ class Database(object):
         def delete_role(role_id):
             criteria = changeset.roles.deletion_criteria(role_id)
             self.collections.related.remove(criteria)
+            self._adjacency.remove_role(role_id)
 
         def delete_tag(tag_id):
-            criteria = changeset.tags.deletion_criteria(
-                tag_id, self.role_id("tag_applies")
-            )
+            role_id = self.role_id("tag_applies")
+            criteria = changeset.tags.deletion_criteria(tag_id, role_id)
             self.collections.related.remove(criteria)
+            self._adjacency.remove_subject_edges(tag_id, role_id)
 
         def delete_group(group_id):
             containing_role_id = self.role_id("group_contains")
@@ -522,15 +724,18 @@ class Database(object):
                 group_id, containing_role_id
             )
             self.collections.related.remove(contains_criteria)
+            self._adjacency.remove_subject_edges(group_id, containing_role_id)
             contained_role_id = self.role_id("contains_group")
             contained_criteria = changeset.groups.contained_criteria(
                 group_id, contained_role_id
             )
             self.collections.related.remove(contained_criteria)
+            self._adjacency.remove_object_edges(group_id, contained_role_id)
 
         def delete_object(object_id):
             criteria = changeset.objects.deletion_criteria(object_id)
             self.collections.related.remove(criteria)
+            self._adjacency.remove_node(object_id)
 
         def delete_query(query_id):
             pass
@@ -545,39 +750,43 @@ class Database(object):
             queries=delete_query,
         )
 
+        def by_collection(object_ids):
+            "(containing collection, ids) pairs for object_ids grouped by class"
+            by_class = defaultdict(list)
+            for object_id in object_ids:
+                by_class[oid.oid_class(object_id)].append(object_id)
+            return [
+                (self.containing_collection(ids[0]), ids) for ids in by_class.values()
+            ]
+
         def apply_object_changes(changes):
-            for k, v in changes.inserted.items():
-                coll = self.containing_collection(k)
-                coll.insert(**v)
-            for k, v in changes.modified.items():
-                coll = self.containing_collection(k)
-                coll.update_one(k, v)
-            for k in changes.deleted:
-                coll = self.containing_collection(k)
-                coll.remove(k)
-                delete_completions[changes.kind](k)
+            for coll, ids in by_collection(changes.inserted):
+                coll.insert_many([changes.inserted[k] for k in ids])
+            for coll, ids in by_collection(changes.modified):
+                coll.update_many({k: changes.modified[k] for k in ids})
+            for coll, ids in by_collection(changes.deleted):
+                coll.remove_many(ids)
+                for k in ids:
+                    delete_completions[changes.kind](k)
 
         def apply_meta_changes(changes):
             coll = getattr(self.collections, changes.kind)
-            for k, v in changes.inserted.items():
-                if "kind" in v:
-                    print("what the hell?")
-                coll.insert(**v)
-                present = coll.get(k)
-                if not present:
-                    print("what the hell?", present, v)
-            for k, v in changes.modified.items():
-                coll.update_one(k, v)
-            for k in changes.deleted:
-                coll.remove(k)
-                delete_completions[changes.kind](k)
+            if changes.inserted:
+                coll.insert_many(list(changes.inserted.values()))
+            if changes.modified:
+                coll.update_many(changes.modified)
+            if changes.deleted:
+                coll.remove_many(list(changes.deleted))
+                for k in changes.deleted:
+                    delete_completions[changes.kind](k)
 
         def apply_related_changes(changes):
-            for related in changes.inserted:
-                self.collections.related.insert(**related.without_kind())
-
-            for related in changes.deleted:
-                self.collections.related.remove(dict(related))
+            related = self.collections.related
+            if changes.inserted:
+                related.insert_many([r.without_kind() for r in changes.inserted])
+            if changes.deleted:
+                related.remove_many([r.without_kind() for r in changes.deleted])
+            self._adjacency.apply_changes(changes)
 
         # fix_attributes()
         do_transaction = not self.in_long_transaction
@@ -593,6 +802,17 @@ class Database(object):
             if coll:
                 coll.drop()
         self.log_changes(changeset)
+        generation = None
+        if meta_delta.has_changes():
+            current = self.meta_generation() == self._context_generation
+            generation = self.stamp_meta_generation()
+        self.update_metacontext(meta_delta)
+        if generation:
+            if not current:
+                self.reload_metacontext()
+            self.save_meta_snapshot(generation)
+        self._query_cache.invalidate(touched)
+        self._object_cache.apply_changes(changeset)
         changeset.clear()
         self._changeset = None
         if do_transaction:
@@ -698,8 +918,11 @@ class Database(object):
     # Classes
 
     def extension(self, cls_id):
-        cls = self.get_class(cls_id)
-        return self.collections.get_class_extension(cls.dict())
+        coll = self.collections.routed_extension(cls_id)
+        if coll is None:
+            cls = self.get_class(cls_id)
+            coll = self.collections.get_class_extension(cls.dict())
+        return coll
 
     def class_short_form(self, class_id):
         cls = self.get_class(class_id)
@@ -716,12 +939,19 @@ class Database(object):
         cls = self.metaclass_named(name)
         return self.extension(cls.id)
 
-    def class_instances(self, name):
+    def class_instances(self, name, only_cols=None):
+        """
+        Iterator over the instances of the named class, read in batches.
+        :param only_cols: attributes to read besides the id, None for all
+        """
         cls = self.name_to_id("classes", name)
-        return self.extension(cls).find()
+        cols = bulk.projection(only_cols)
+        return bulk.as_records(self.extension(cls).iter_find(only_cols=cols), cols)
 
-    def instances_satisfying(self, name, criteria):
-        return self.class_collection(name).find(criteria)
+    def instances_satisfying(self, name, criteria, only_cols=None):
+        cols = bulk.projection(only_cols)
+        found = self.class_collection(name).find(criteria, only_cols=cols)
+        return list(bulk.as_records(found, cols))
 
     def class_instance_ids(self, name):
         cls = self.metaclass_named(name)
@@ -750,23 +980,83 @@ class Database(object):
 
     # objects and their relationships
 
-    def get_object(self, uuid):
-        obj = None
-        if not obj:
+    def get_object(self, uuid, only_cols=None):
+        """
+        The object with id uuid or None.  Only whole objects are cached.
+        :param only_cols: attributes to read besides the id, None for all
+        """
+        obj = self._object_cache.lookup(uuid)
+        if obj is absent:
+            return None
+        if obj is None:
             coll = self.containing_collection(uuid)
-            obj = coll.get(uuid)
-        return obj
+            obj = coll.get(uuid, only_cols=only_cols)
+            if obj is None or not only_cols:
+                self._object_cache.set(uuid, obj)
+            return obj
+        return bulk.projected(obj, only_cols)
 
-    def bulk_load(self, uuids, preserve_order=True):
-        by_cls = partition(uuids, oid.oid_class)
-        res = []
-        for cls_id, ids in by_cls.items():
-            coll = self.extension(cls_id)
-            res.extend(coll.bulk_load(ids))
-        if preserve_order:
-            by_id = {x["_id"]: x for x in res}
-            res = [by_id[i] for i in uuids]
-        return res
+    def cached_objects(self, uuids):
+        """
+        Split uuids by the object cache.
+        :return: dict of the cached objects by id and list of the uncached ids
+        """
+        found, wanted = {}, []
+        for an_id in uuids:
+            obj = self._object_cache.lookup(an_id)
+            if obj is None:
+                wanted.append(an_id)
+            elif obj is not absent:
+                found[an_id] = obj
+        return found, wanted
+
+    def cache_loaded(self, ids, records):
+        """Caches records loaded for ids, and the ids with no record, by id."""
+        loaded = {r[oid.id_field]: r for r in records}
+        for an_id in ids:
+            self._object_cache.set(an_id, loaded.get(an_id))
+        return loaded
+
+    # bulk_load reads uncached ids in per class batches of at most
+    # bulk_load_batch_size ids, at most bulk_load_concurrency at a time.
+    # Batches run on threads only when an adaptor whose collections may be
+    # used from several threads at once raises bulk_load_concurrency.
+
+    bulk_load_batch_size = bulk.default_batch_size
+    bulk_load_concurrency = 1
+
+    def cached_projections(self, uuids, only_cols):
+        """cached_objects with the cached objects cut down to only_cols"""
+        found, wanted = self.cached_objects(uuids)
+        if only_cols:
+            found = {k: bulk.projected(v, only_cols) for k, v in found.items()}
+        return found, wanted
+
+    def add_loaded(self, found, ids, records, only_cols):
+        """Adds a batch's records to found, caching them unless projected."""
+        if only_cols:
+            found.update(bulk.by_id(records))
+        else:
+            found.update(self.cache_loaded(ids, records))
+
+    def bulk_load(self, uuids, preserve_order=True, only_cols=None):
+        """
+        Objects with ids uuids.  Uncached ids are loaded in per class batches
+        of at most bulk_load_batch_size, on up to bulk_load_concurrency threads.
+        :param preserve_order: return a list parallel to uuids, None for ids
+            without an object, rather than just the objects found
+        :param only_cols: attributes to load besides the id, None for all
+        """
+        uuids = list(uuids)
+        found, wanted = self.cached_projections(uuids, only_cols)
+        batches = bulk.batches(wanted, self.bulk_load_batch_size)
+        colls = {cls_id: self.extension(cls_id) for cls_id, _ in batches}
+        cols = bulk.projection(only_cols)
+        load = lambda batch: colls[batch[0]].bulk_load(batch[1], only_cols=cols)
+        loaded = map_threaded(load, batches, self.bulk_load_concurrency)
+        for (_, ids), records in zip(batches, loaded):
+            self.add_loaded(found, ids, records, only_cols)
+        return bulk.ordered(uuids, found, preserve_order)
 
     def oid_short_form(self, oid):
         obj = self.get_object(oid)
@@ -792,15 +1082,8 @@ class Database(object):
 
     def get_object_roles(self, uuid):
         "returns all role_ids that the object is subject in"
-        data = set(
-            self.collections.related.distinct(
-                "assoc_id", criteria=dict(subject_id=uuid)
-            )
-        )
-        data_rev = set(
-            self.collections.related.distinct("assoc_id", criteria=dict(object_id=uuid))
-        )
-        return data, data_rev  # return both forward and reverse applicable roles
+        # return both forward and reverse applicable roles
+        return self.get_adjacency().object_roles(uuid)
 
     def object_for_url(self, url, record=False, **other_fields):
         """
@@ -862,10 +1145,7 @@ class Database(object):
 
     def get_object_relationships(self, uuid):
         """dictionary of role_id to object_id set"""
-        roles, reverse_roles = self.get_object_roles(uuid)
-        forward = dict([(r, self.get_roleset(uuid, r)) for r in roles])
-        reverse = dict([(r, self.get_roleset(uuid, r, True)) for r in reverse_roles])
-        return forward, reverse
+        return self.get_adjacency().relationships(uuid)
 
     def get_related_objects(self, uuid):
         related, rev_related = self.get_object_relationships(uuid)
@@ -890,11 +1170,12 @@ class Database(object):
         role_id = self.role_id("group_contains")
         res = self.get_roleset(uuid, role_id, reverse=True)
         if recursive:
-            return recurse_set(res, lambda gid: self.groups_containing_group(gid))
+            contained_role_id = self.role_id("contains_group")
+            res |= self.get_adjacency().reachable(res, contained_role_id, reverse=True)
         return res
 
-    def get_object_data(self, uid):
-        obj = self.get_object(uid)
+    def get_object_data(self, uid, only_cols=None):
+        obj = self.get_object(uid, only_cols=only_cols)
         if not obj:
             raise NoSuchObject(uid)
         return obj
@@ -919,11 +1200,24 @@ class Database(object):
 
     def get_tagset(self, tag_id, recursive=False):
         role_id = self.role_id("tag_applies")
-        tags = set(tag_id)
-        if recursive:
-            tags.update(self.metacontext.subtags(tag_id))
-        sets = [self.get_roleset(tid, role_id) for tid in tags]
-        return reduce(lambda a, b: a | b, sets, set())
+        tags = self.tag_trie().with_subtags(tag_id) if recursive else {tag_id}
+        return set().union(*self.get_rolesets(tags, role_id).values())
+
+    def get_tagset_bits(self, tag_id, recursive=False):
+        """get_tagset as an IdSet over the adjacency index's id map"""
+        adjacency = self.get_adjacency()
+        tags = self.tag_trie().with_subtags(tag_id) if recursive else {tag_id}
+        bits = adjacency.union_bits(tags, self.role_id("tag_applies"))
+        return IdSet(adjacency.id_map, bits)
+
+    def get_tagset_under(self, prefix):
+        """
+        Objects tagged with the tag named prefix or any tag beneath it, e.g.
+        everything tagged under 'projects'.
+        """
+        role_id = self.role_id("tag_applies")
+        tags = self.tag_trie().under(prefix)
+        return set().union(*self.get_rolesets(tags, role_id).values())
 
     def modify_tag_objects(self, tag_id, object_ids, do_replace=False, reverse=True):
         role_id = self.role_id("tag_applies")
@@ -936,9 +1230,9 @@ class Database(object):
         Returns dict with tag_ids as keys and list objects having
         tag as value.
         """
-        tagsets = [self.get_tagset(t) for t in tags]
-        res = zip(tags, [list(ts) for ts in tagsets])
-        return dict(res)
+        role_id = self.role_id("tag_applies")
+        tagsets = self.get_rolesets(tags, role_id)
+        return {t: list(ts) for t, ts in tagsets.items()}
 
     def tag_neighbors(self, uuid):
         """
@@ -962,11 +1256,19 @@ class Database(object):
 
     def get_groupset(self, group_id, recursive=False):
         role_id = self.role_id("group_contains")
-        groups = set(group_id)
+        groups = {group_id}
+        if recursive:
+            groups.update(self.groups_in_group(group_id))
+        return set().union(*self.get_rolesets(groups, role_id).values())
+
+    def get_groupset_bits(self, group_id, recursive=False):
+        """get_groupset as an IdSet over the adjacency index's id map"""
+        adjacency = self.get_adjacency()
+        groups = {group_id}
         if recursive:
             groups.update(self.groups_in_group(group_id))
-        sets = [self.get_roleset(gid, role_id) for gid in groups]
-        return reduce(lambda a, b: a | b, sets, set())
+        bits = adjacency.union_bits(groups, self.role_id("group_contains"))
+        return IdSet(adjacency.id_map, bits)
 
     def modify_group_objects(
         self, group_id, object_ids, do_replace=False, reverse=True
@@ -979,14 +1281,29 @@ class Database(object):
     def groups_in_group(self, group_id):
         """get groups contained in group using relations instead of directly"""
         role_id = self.role_id("contains_group")
-        func = lambda gid: self.get_roleset(gid, role_id)
-        return recurse_set(func(group_id), func)
+        return self.get_adjacency().reachable([group_id], role_id)
 
     def groups_containing_group(self, group_id):
         """get groups containing group using relations instead of directly"""
-        role_id = self.name_to_id("roles", "contains_group")
-        func = lambda gid: self.get_roleset(gid, role_id, reverse=True)
-        return recurse_set(func(group_id), func)
+        role_id = self.role_id("contains_group")
+        return self.get_adjacency().reachable([group_id], role_id, reverse=True)
+
+    def group_contains(self, group_id, item, recursive=False):
+        """
+        Whether item, a group or an object, is in group_id.
+        :param recursive: also count item being in a group within group_id
+        """
+        adjacency = self.get_adjacency()
+        group_role = self.role_id("contains_group")
+        if self.group_ok(item):
+            if recursive:
+                return adjacency.closure(group_role).contains(group_id, item)
+            return item in adjacency.roleset(group_id, group_role)
+        direct = adjacency.roleset(item, self.role_id("group_contains"), reverse=True)
+        if group_id in direct:
+            return True
+        closure = adjacency.closure(group_role)
+        return recursive and any(closure.contains(group_id, g) for g in direct)
 
     def group_item_check(self, item):
         return (self.group_ok(item)) or (self.object_ok(item))
@@ -995,9 +1312,9 @@ class Database(object):
         """
         Returns dict with group_ids as keys and list objects directly in group as value.
         """
-        sets = [self.get_groupset(t) for t in groups]
-        res = zip(groups, [list(items) for items in sets])
-        return dict(res)
+        role_id = self.role_id("group_contains")
+        sets = self.get_rolesets(groups, role_id)
+        return {g: list(items) for g, items in sets.items()}
 
     def group_neighbors(self, uuid):
         """
@@ -1011,11 +1328,10 @@ class Database(object):
 
     def objects_in_group(self, group_id, transitive=False):
         role_id = self.role_id("group_contains")
-        groups = set(group_id)
+        groups = {group_id}
         if transitive:
             groups.update(self.groups_in_group(group_id))
-        sets = [self.get_roleset(gid, role_id) for gid in groups]
-        return reduce(lambda a, b: a | b, sets, set())
+        return set().union(*self.get_rolesets(groups, role_id).values())
 
     def group(self, oid, group_id):
         role_name = "group_contains" if self.object_ok(oid) else "contains_group"
@@ -1029,13 +1345,7 @@ class Database(object):
 
     # Roles
     def get_role_related(self, role_id):
-        forward = defaultdict(set)
-        reversed = defaultdict(set)
-        for data in self.collections.related.find(dict(assoc_id=role_id)):
-            subject, object = data["subject_id"], data["object_id"]
-            forward[subject].add(object)
-            reversed[object].add(subject)
-        return forward, reversed
+        return self.get_adjacency().role_related(role_id)
 
     def get_related_by_name(self, uuid):
         related, rev_related = self.get_object_relationships(uuid)
@@ -1050,16 +1360,38 @@ class Database(object):
         return res
 
     def get_roleset(self, subject, role_id, reverse=False):
-        key = role_id + ":" + subject
-        res = None
-        if not res:
-            criteria = {"subject_id": subject, "assoc_id": role_id}
-            col = "object_id"
-            if reverse:
-                criteria = {"object_id": subject, "assoc_id": role_id}
-                col = "subject_id"
-            res = set(self.collections.related.find(criteria=criteria, only_cols=[col]))
-        return res
+        return self.get_adjacency().roleset(subject, role_id, reverse=reverse)
+
+    def get_roleset_size(self, subject, role_id, reverse=False):
+        "size of get_roleset(subject, role_id, reverse) without building it"
+        return self.get_adjacency().roleset_size(subject, role_id, reverse=reverse)
+
+    def get_degree(self, uuid):
+        "number of related rows uuid is subject or object of"
+        return self.get_adjacency().degree(uuid)
+
+    def get_rolesets(self, subject_ids, role_id, reverse=False):
+        """
+        Rolesets of several subjects (objects if reverse) at once.
+        :param subject_ids: ids to get rolesets for
+        :param role_id: the role id
+        :param reverse: whether the ids are objects of the role
+        :return: dict of id to set of related ids
+        """
+        return self.get_adjacency().rolesets(subject_ids, role_id, reverse=reverse)
+
+    def get_roleset_closure(self, subject_ids, role_id, reverse=False):
+        """
+        All ids reachable from subject_ids through one or more role_id steps.
+        Each level is fetched with a single get_rolesets call.
+        """
+        found = set()
+        frontier = set(subject_ids)
+        while frontier:
+            rolesets = self.get_rolesets(frontier, role_id, reverse=reverse)
+            frontier = set().union(*rolesets.values()) - found
+            found.update(frontier)
+        return found
 
     def modify_object_related(
         self, fixed_id, role_id, object_ids, do_replace=False, reverse=False
@@ -1097,22 +1429,14 @@ class Database(object):
         :param role_id: the role id
         :return: the mapping
         """
-        res = defaultdict(set)
-        key, v_key = ["subject", "object"]
-        if reverse:
-            key, v_key = v_key, key
-
-        for rec in self.collections.related.find({"role": role_id}):
-            res[rec[key]].add(rec[v_key])
-        return res
+        forward, reverse_map = self.get_adjacency().role_related(role_id)
+        return reverse_map if reverse else forward
 
     def get_subjects_related(self, role_id):
         """
         Return just the subjects related by role_id
         """
-        return set(
-            self.collections.related.find({"role": role_id}, only_cols=["subject"])
-        )
+        return self.get_adjacency().role_subjects(role_id)
 
     def get_all_related(self, uuid):
         """
@@ -1120,12 +1444,7 @@ class Database(object):
         :param uuid:  the object to find related objects for
         :return: set of object ids of related objects
         """
-        res = set(
-            self.collections.related.find({"subject": uuid}, only_cols=["object_id"])
-        )
-        res.update(
-            self.collections.related.find({"object_id": uuid}, only_cols=["subject"])
-        )
+        res = self.get_adjacency().related(uuid)
         return {r for r in res if oid.has_uuid_form(r)}
 
     def relate(self, subject_oid, roleid, object_oid):
@@ -1133,7 +1452,7 @@ class Database(object):
             subject_id=subject_oid, assoc_id=roleid, object_id=object_oid
         )
         data = r_data.without_kind()
-        if not self.collections.related.exists(data):
+        if not self.get_adjacency().contains(r_data):
             with self.changes() as chng:
                 return chng.related.insert(data)
         return r_data
@@ -1200,5 +1519,32 @@ class Database(object):
             else:
                 return q
 
-        evaluator = QueryEvaluator2(normalized_query(query), self, self.metacontext)
-        return await evaluator()
+        return await self._query_cache.evaluate(
+            normalized_query(query), self, self.metacontext
+        )
+
+    async def query_page(self, query, order_by=None, limit=None, cursor=None):
+        """
+        Ordered page of the uuids satisfying query.
+        @param order_by: attribute to order by, '-' prefixed for descending
+        @param limit: most uuids returned, None for all
+        @param cursor: token returned with the previous page
+        @returns (list of uuids, token for the next page or None)
+        """
+        return await query_page(
+            self,
+            query,
+            order_by,
+            limit,
+            cursor,
+            self._query_pages,
+            self._query_cache.generation,
+        )
+
+    def query_cache_stats(self):
+        """Entry count and hit, miss, eviction and invalidation counts of the query cache."""
+        return self._query_cache.stats()
+
+    def object_cache_stats(self):
+        """Size, hit, miss, eviction, expiry and invalidation counts of the object cache."""
+        return self._object_cache.stats()
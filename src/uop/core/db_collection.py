@@ -2,29 +2,34 @@ __author__ = "samantha"
 
 from functools import partial
 from uop.core import tenant
+from uop.core import bulk_load as bulk
 from uop.core.collections import (
     uop_collection_names,
     meta_kinds,
     assoc_kinds,
     per_tenant_kinds,
+    unkeyed_kinds,
     cls_extension_field,
 )
 from uop.core.constraints import ConstraintViolation
 from uop.meta.schemas.meta import kind_map
-from collections import deque
+from collections import OrderedDict, deque
 import datetime
 
 shared_collections = meta_kinds
+_missing = object()
 
 
 class DatabaseCollections(object):
+    extension_cache_size = 1024  # most class extension handles kept open
+
     def __getattr__(self, name):
         return self._collections[name]
 
     def __init__(self, db):
         self._collections = {}
         self._db = db
-        self._extensions = {}
+        self._extensions = OrderedDict()  # class id -> extension, LRU order
 
     def extension(self, cls):
         name = cls.get(cls_extension_field)
@@ -34,13 +39,34 @@ class DatabaseCollections(object):
             self.classes.update_one(cls["id"], {cls_extension_field: name})
         return name
 
+    def routed_extension(self, cls_id):
+        """The open extension collection of a class or None if not open."""
+        coll = self._extensions.get(cls_id)
+        if coll is not None:
+            self._extensions.move_to_end(cls_id)
+        return coll
+
+    def route_extension(self, cls_id, coll):
+        self._extensions[cls_id] = coll
+        self._extensions.move_to_end(cls_id)
+        while len(self._extensions) > self.extension_cache_size:
+            self._extensions.popitem(last=False)
+        return coll
+
+    def forget_extensions(self, cls_ids=None):
+        """Drops the routes of cls_ids, or of all classes, without dropping data."""
+        if cls_ids is None:
+            self._extensions.clear()
+        for cls_id in cls_ids or ():
+            self._extensions.pop(cls_id, None)
+
     def get_class_extension(self, cls):
-        name = self.extension(cls)
         cid = cls["id"]
-        coll = self._extensions.get(cid)
+        coll = self.routed_extension(cid)
         if not coll:
+            name = self.extension(cls)
             coll = self._db.get_managed_collection(name, schema=cls)
-            self._extensions[cid] = coll
+            self.route_extension(cid, coll)
         return coll
 
     def ensure_class_extensions(self):
@@ -53,19 +79,21 @@ class DatabaseCollections(object):
             if not self._collections.get(name):
                 col_name = col_map[name]
                 schema = kind_map.get(name)
-                self._collections[name] = self._db.get_managed_collection(
-                    col_name, schema
-                )
+                coll = self._db.get_managed_collection(col_name, schema)
+                if name in unkeyed_kinds:
+                    coll.keyed = False
+                self._collections[name] = coll
 
     def metadata(self):
-        return {k: self._collections[k].find() for k in shared_collections}
+        """kind -> iterator over the records of that meta kind"""
+        return {k: self._collections[k].iter_find() for k in shared_collections}
 
     def drop_collections(self, collections):
         for col in collections:
             col.drop()
 
     def class_extension(self, cls_id):
-        return self._extensions.get(cls_id)
+        return self.routed_extension(cls_id)
 
     def get(self, name, schema=None):
         return self._collections.get(name)
@@ -145,12 +173,46 @@ class DBCollection(object):
     def insert(self, **fields):
         pass
 
-    def bulk_load(self, *ids):
-        pass
+    def bulk_load(self, ids, only_cols=None):
+        """
+        Records with the given ids, cut down to only_cols and the id if given.
+        Ids without a record are left out.  Adaptors with a native multi-get
+        should override this.
+        """
+        cols = bulk.projection(only_cols)
+        found = self.find({self.ID_Field: {"$in": list(ids)}}, only_cols=cols)
+        return self._page_records(found, cols)
 
     def remove(self, dict_or_key):
         pass
 
+    # Bulk operations.  These default to one call per item.  Adaptors whose
+    # datastore has native batch writes should override them.
+
+    def insert_many(self, records):
+        """
+        Inserts all records.
+        :param records: iterable of field dicts as would be passed to insert
+        """
+        for record in records:
+            self.insert(**record)
+
+    def update_many(self, modifications):
+        """
+        Applies partial modifications to several records.
+        :param modifications: dict of record id to modifications dict
+        """
+        for an_id, mods in modifications.items():
+            self.update_one(an_id, mods)
+
+    def remove_many(self, dicts_or_keys):
+        """
+        Removes several records.
+        :param dicts_or_keys: iterable of ids or criteria dicts as passed to remove
+        """
+        for dict_or_key in dicts_or_keys:
+            self.remove(dict_or_key)
+
     def remove_all(self):
         return self.remove({})
 
@@ -171,6 +233,91 @@ class DBCollection(object):
     ):
         return []
 
+    # Streaming reads.  iter_find pages through find by keyset so a result is
+    # never held whole.  Adaptors with native cursors should override it.
+
+    find_batch_size = 1000
+    keyed = True  # records have a unique ID_Field value to page on
+
+    def _paging(self, criteria, only_cols, order_by):
+        """
+        (ordering field, columns to fetch) for paging a find or None if it cannot
+        be paged.  Pages are keyed on a single ascending field plus the id, so
+        collections whose records have no id are read with one find.
+        """
+        order = list(order_by or [self.ID_Field])
+        if not self.keyed or isinstance(criteria, str):
+            return None
+        if len(order) > 1 or order[0].startswith("-"):
+            return None
+        cols = None
+        if only_cols is not None:
+            cols = list(dict.fromkeys([*only_cols, order[0], self.ID_Field]))
+        return order[0], cols
+
+    def _page_after(self, criteria, order_field, last):
+        """
+        criteria restricted to records after last in (order_field, id) order or
+        None if last has no order_field value to compare with.
+        """
+        id_field = self.ID_Field
+        if last.get(order_field) is None:
+            return None
+        after = {"$gt": {id_field: last[id_field]}}
+        if order_field != id_field:
+            after = {
+                "$or": [
+                    {"$gt": {order_field: last[order_field]}},
+                    {"$and": [{order_field: last[order_field]}, after]},
+                ]
+            }
+        return {"$and": [criteria, after]} if criteria else after
+
+    @staticmethod
+    def _page_records(page, cols):
+        if cols is not None and len(cols) == 1:
+            return [{cols[0]: value} for value in page]
+        return page
+
+    @staticmethod
+    def _projected(record, only_cols):
+        if not only_cols:
+            return record
+        if len(only_cols) == 1:
+            return record.get(only_cols[0], _missing)
+        return {c: record[c] for c in only_cols if c in record}
+
+    def iter_find(self, criteria=None, only_cols=None, order_by=None, batch_size=None):
+        """
+        Iterates over what find(criteria, only_cols, order_by) returns, fetching
+        batch_size records per round trip.  Orderings other than a single
+        ascending field, and collections that are not keyed, are read with one
+        find, as is the rest once a page ends on a record without the field.
+        """
+        paging = self._paging(criteria, only_cols, order_by)
+        if paging is None:
+            yield from self.find(criteria, only_cols=only_cols, order_by=order_by)
+            return
+        order_field, cols = paging
+        batch_size = batch_size or self.find_batch_size
+        key_order = list(dict.fromkeys([order_field, self.ID_Field]))
+        page_criteria, limit, read, skip = criteria, batch_size, 0, 0
+        while True:
+            page = self.find(
+                page_criteria, only_cols=cols, order_by=key_order, limit=limit
+            )
+            records = self._page_records(page, cols)
+            for record in records[skip:]:
+                value = self._projected(record, only_cols)
+                if value is not _missing:
+                    yield value
+            read += len(page)
+            if limit is None or len(page) < batch_size:
+                return
+            page_criteria = self._page_after(criteria, order_field, records[-1])
+            if page_criteria is None:
+                page_criteria, limit, skip = criteria, None, read
+
     def all(self):
         return self.find()
 
@@ -187,8 +334,13 @@ class DBCollection(object):
     def contains_id(self, an_id):
         return self.exists({"id": an_id})
 
-    def get(self, instance_id):
-        return self.find_one({"id": instance_id})
+    def get(self, instance_id, only_cols=None):
+        """The record with instance_id, cut down to only_cols and the id if given."""
+        if not only_cols:
+            return self.find_one({"id": instance_id})
+        cols = bulk.projection(only_cols)
+        found = self.find({"id": instance_id}, only_cols=cols, limit=1)
+        return bulk.as_record(found[0], cols) if found else None
 
     def get_all(self):
         """
@@ -196,7 +348,7 @@ class DBCollection(object):
         records in the collection
         :return: the mapping
         """
-        return {x["_id"]: x for x in self.find()}
+        return {x[self.ID_Field]: x for x in self.iter_find()}
 
     def instances(self):
-        return self.find()
+        return list(self.iter_find())
@@ -1,9 +1,15 @@
 from uop.core import changeset
+from uop.core import change_log
 from sjasoft.utils.category import binary_partition, partition
 from sjasoft.utils.tools import match_fields
 from sjasoft.web.url import is_url
-from sjasoft.utils.data import recurse_set
-from uop.core import query as query_module
+from uop.core.query_cache import QueryCache, changed_ids
+from uop.core.query_pages import PageRows, query_page
+from uop.core.object_cache import absent
+from uop.core.roleset_cache import RolesetCache
+from uop.core.cache_backend import roleset_set_key
+from uop.core import bulk_load as bulk
+from uop.core.concurrency import map_threaded
 from uop.meta.schemas.meta import (
     MetaContext,
     Related,
@@ -20,6 +26,7 @@ from uop.meta.schemas import meta
 from uop.core.query import Q
 from uop.meta import oid
 from uop.core.exceptions import NoSuchObject
+from sjasoft.utils import logging
 from collections import defaultdict
 from functools import reduce
 
@@ -27,6 +34,8 @@ import re
 import asyncio
 from contextlib import contextmanager
 
+logger = logging.getLogger("uop.db_interface")
+
 
 def as_dict(data):
     if isinstance(data, BaseModel):
@@ -36,12 +45,8 @@ def as_dict(data):
 
 @contextmanager
 def changes(obj):
-    changes = obj._changeset or changeset.ChangeSet()
-    yield changes
-    if not obj._changeset:
-        if obj._cache:
-            obj._cache.apply_changes(changes)
-        obj._db.apply_changes(changes, obj._db.collections)
+    with obj.changes() as changes:
+        yield changes
 
 
 def get_tenant_interface(db, tenant_id):
@@ -66,11 +71,15 @@ class Interface(object):
     Passing a user works well with this choice in that the tenantDatabase wrapper allowing access
     to only the tenants data is set up around the database.  This is very convenient for servers
     handling requests for multiple tenants.
-    Similarly a cache should be shared across requests to a process.
+    Similarly a cache should be shared across requests to a process.  A cache
+    that implements the cache_backend set protocol also holds tag and group
+    memberships and combines them for queries.
     """
 
     _db = None
     _cache = None
+    bulk_load_batch_size = bulk.default_batch_size
+    bulk_load_concurrency = 1  # threads, raise only for thread safe databases
 
     def __init__(self, db, cache=None, tenant_id=None):
         self._db = db
@@ -81,6 +90,10 @@ class Interface(object):
         self._changeset = None
         self._metadata = None
         self._context = None
+        self._query_cache = QueryCache()
+        self._query_pages = PageRows()
+        self._rolesets = RolesetCache()
+        self._set_cache = cache if hasattr(cache, "sunion") else None
 
     @property
     def tenant_id(self):
@@ -93,7 +106,10 @@ class Interface(object):
         if not self._changeset:
             if self._cache:
                 self._cache.apply_changes(changes)
+            self._rolesets.apply_changes(changes)
+            touched = changed_ids(changes, self.metacontext)
             self._db.apply_changes(changes, self._db.collections)
+            self._query_cache.invalidate(touched)
 
     @property
     def metacontext(self):
@@ -103,8 +119,26 @@ class Interface(object):
         return self.raw_db.collections.metadata()
 
     def reload_metacontext(self):
-        coll_meta = self.get_metadata()
-        self._context = MetaContext.from_data(coll_meta)
+        snapshot = getattr(self.raw_db, "snapshot_metacontext", None)
+        self._context = snapshot() if snapshot else None
+        if self._context is None:
+            self._context = MetaContext.from_data(self.get_metadata())
+
+    def update_metacontext(self, delta):
+        """
+        Applies the MetaDelta of changes just applied to the metacontext,
+        reloading only when there is no context yet or the delta does not fit it.
+        """
+        if not delta.has_changes():
+            return
+        if self._context is None:
+            self.reload_metacontext()
+            return
+        try:
+            delta.apply_to(self._context)
+        except (KeyError, ValueError) as e:
+            logger.warning("reloading metacontext after failed delta: %s", e)
+            self.reload_metacontext()
 
     def ensure_collections(self):
         if not self._collections:
@@ -118,7 +152,6 @@ class Interface(object):
         has_changes = changes.has_changes()
         if has_changes:
             self.apply_changes(changes)
-            self.reload_metacontext()
         return has_changes, changes
 
     @property
@@ -155,8 +188,11 @@ class Interface(object):
         :param metadata: Basically a changeset of updates.
         :return: None
         """
+        delta = metadata.meta_delta()
+        touched = changed_ids(metadata, self.metacontext)
         self._db.apply_changes(metadata, self.collections)
-        self.reload_metacontext()
+        self.update_metacontext(delta)
+        self._query_cache.invalidate(touched)
 
     def begin_transaction(self):
         """starts a changeset that will not be applied unitl commit"""
@@ -173,12 +209,18 @@ class Interface(object):
             self._db.end_long_transaction()
 
     def commit(self):
+        delta = None
         if self._changeset:
+            delta = self._changeset.meta_delta()
+            touched = changed_ids(self._changeset, self.metacontext)
             if self._cache:
                 self._cache.apply_changes(self._changeset)
+            self._rolesets.apply_changes(self._changeset)
             self._db.apply_changes(self._changeset, self.collections)
         self.end_transaction()
-        self.reload_metacontext()
+        if delta:
+            self.update_metacontext(delta)
+            self._query_cache.invalidate(touched)
 
     def apply_changes(self, changes):
         """
@@ -189,16 +231,26 @@ class Interface(object):
         :param changes:  the changeset of changes to apply
         :return: None
         """
+        delta = changes.meta_delta()
+        touched = changed_ids(changes, self.metacontext)
+        if self._cache:
+            self._cache.apply_changes(changes)
+        self._rolesets.apply_changes(changes)
         self._db.apply_changes(changes, self.collections)
-        self.reload_metacontext()
+        self.update_metacontext(delta)
+        self._query_cache.invalidate(touched)
 
     def changes_until(self, a_time):
         changes = self._db.get_collection("changes")
-        changesets = changes.find({"time": {"le": a_time}})
-        if changesets:
-            first = changeset.ChangeSet(**changesets[0])
-            return first.add_changes(changesets[1:])
-        return changeset.ChangeSet()
+        entries = changes.iter_find(
+            Q.lte("timestamp", a_time),
+            order_by=("timestamp",),
+            only_cols=change_log.entry_columns,
+        )
+        combined = changeset.ChangeSet.combine_all(
+            map(change_log.entry_delta, entries)
+        )
+        return combined or changeset.ChangeSet()
 
     @property
     def has_admin_user(self):
@@ -212,8 +264,8 @@ class Interface(object):
                     self._admin_user = user["is_admin"]
         return self._admin_user
 
-    def get_object_data(self, uid):
-        obj = self.get_object(uid)
+    def get_object_data(self, uid, only_cols=None):
+        obj = self.get_object(uid, only_cols=only_cols)
         if not obj:
             raise NoSuchObject(uid)
         return obj
@@ -226,7 +278,11 @@ class Interface(object):
         return self.meta_insert(obj)
 
     def extension(self, cls_id):
-        return self.collections.class_extension(cls_id)
+        coll = self.collections.routed_extension(cls_id)
+        if coll is None:
+            cls = self.get_class(cls_id)
+            coll = self.collections.get_class_extension(cls.dict())
+        return coll
 
     @property
     def related(self):
@@ -412,20 +468,105 @@ class Interface(object):
         return res
 
     def get_roleset(self, subject, role_id, reverse=False):
-        key = role_id + ":" + subject
-        res = self._cache and self._cache.get(key)
-        if not res:
-            role = self.roles.get(role_id)
+        res = self._rolesets.get(role_id, subject, reverse)
+        if res is None:
             criteria = {"subject_id": subject, "assoc_id": role_id}
             col = "object_id"
             if reverse:
                 criteria = {"object_id": subject, "assoc_id": role_id}
                 col = "subject_id"
             res = set(self.related.find(criteria=criteria, only_cols=[col]))
-            if self._cache:
-                self._cache.set(key, res)
+            self._rolesets.put(role_id, subject, reverse, res)
+        return res
+
+    def get_roleset_size(self, subject, role_id, reverse=False):
+        "size of get_roleset(subject, role_id, reverse) without loading it"
+        res = self._rolesets.get(role_id, subject, reverse)
+        if res is not None:
+            return len(res)
+        if self._set_cache is not None and not reverse:
+            key = roleset_set_key(role_id, subject)
+            if not self._set_cache.unloaded([key]):
+                return self._set_cache.scard(key)
+        key_col = "object_id" if reverse else "subject_id"
+        return self.related.count({key_col: subject, "assoc_id": role_id})
+
+    def get_degree(self, uuid):
+        "number of related rows uuid is subject or object of"
+        return self.related.count({"subject_id": uuid}) + self.related.count(
+            {"object_id": uuid}
+        )
+
+    def get_rolesets(self, subject_ids, role_id, reverse=False):
+        """
+        Rolesets of several subjects (objects if reverse) in one related query.
+        :param subject_ids: ids to get rolesets for
+        :param role_id: the role id
+        :param reverse: whether the ids are objects of the role
+        :return: dict of id to set of related ids
+        """
+        key_col, col = ("subject_id", "object_id")
+        if reverse:
+            key_col, col = col, key_col
+        res, missing = self._rolesets.get_many(subject_ids, role_id, reverse)
+        if missing:
+            loaded = {an_id: set() for an_id in missing}
+            criteria = {"assoc_id": role_id, key_col: {"$in": list(loaded)}}
+            for rec in self.related.find(criteria=criteria, only_cols=[key_col, col]):
+                loaded[rec[key_col]].add(rec[col])
+            for an_id, roleset in loaded.items():
+                self._rolesets.put(role_id, an_id, reverse, roleset)
+            res.update(loaded)
         return res
 
+    def role_id(self, name):
+        return self.metacontext.roles.name_to_id(name)
+
+    def warm_rolesets(self, subject_ids, role_id):
+        """
+        Ensures the set cache holds the rolesets of subject_ids, loading the
+        missing ones with one get_rolesets call.
+        :return: the set cache keys of the rolesets
+        """
+        keys = {an_id: roleset_set_key(role_id, an_id) for an_id in subject_ids}
+        missing = set(self._set_cache.unloaded(list(keys.values())))
+        cold = [an_id for an_id, key in keys.items() if key in missing]
+        if cold:
+            for an_id, roleset in self.get_rolesets(cold, role_id).items():
+                self._set_cache.load_set(keys[an_id], roleset)
+        return list(keys.values())
+
+    def combine_rolesets(self, subject_ids, role_id, intersect=False):
+        """
+        Union, or if intersect the intersection, of the rolesets of
+        subject_ids.  With a set cache the sets are combined in the cache.
+        """
+        subject_ids = list(subject_ids)
+        if not subject_ids:
+            return set()
+        if self._set_cache is not None:
+            keys = self.warm_rolesets(subject_ids, role_id)
+            if intersect:
+                return self._set_cache.sinter(*keys)
+            return self._set_cache.sunion(*keys)
+        rolesets = list(self.get_rolesets(subject_ids, role_id).values())
+        if intersect:
+            return set.intersection(*rolesets)
+        return set().union(*rolesets)
+
+    def get_roleset_closure(self, subject_ids, role_id, reverse=False):
+        """
+        All ids reachable from subject_ids through one or more role_id steps.
+        Each level is fetched with a single get_rolesets call.
+        """
+        found = set()
+        frontier = set(subject_ids)
+        while frontier:
+            rolesets = self.get_rolesets(frontier, role_id, reverse=reverse)
+            frontier = set().union(*rolesets.values()) - found
+            found.update(frontier)
+        return found
+
     def modify_associated_with_role(
         self, role_id, an_id, desired, reverse=False, do_replace=False
     ):
@@ -484,14 +625,12 @@ class Interface(object):
     def groups_in_group(self, group_id):
         """get groups contained in group using relations instead of directly"""
         role_id = self.roles.by_name["contains_group"]
-        func = lambda gid: self.get_roleset(gid, role_id)
-        return recurse_set(func(group_id), func)
+        return self.get_roleset_closure([group_id], role_id)
 
     def groups_containing_group(self, group_id):
         """get groups containing group using relations instead of directly"""
         role_id = self.roles.by_name["contains_group"]
-        func = lambda gid: self.get_roleset(gid, role_id, reverse=True)
-        return recurse_set(func(group_id), func)
+        return self.get_roleset_closure([group_id], role_id, reverse=True)
 
     def group_item_check(self, item):
         return (self.group_ok(item)) or (self.object_ok(item))
@@ -529,19 +668,17 @@ class Interface(object):
 
     def get_tagset(self, tag_id, recursive=False):
         role_id = self.roles.by_name["tag_applies"]
-        tags = set(tag_id)
+        tags = {tag_id}
         if recursive:
             tags.update(self.metacontext.subtags(tag_id))
-        sets = [self.get_roleset(tid, role_id) for tid in tags]
-        return reduce(lambda a, b: a | b, sets, set())
+        return set().union(*self.get_rolesets(tags, role_id).values())
 
     def get_groupset(self, group_id, recursive=False):
         role_id = self.roles.by_name["group_contains"]
-        groups = set(group_id)
+        groups = {group_id}
         if recursive:
             groups.update(self.groups_in_group(group_id))
-        sets = [self.get_roleset(gid, role_id) for gid in groups]
-        return reduce(lambda a, b: a | b, sets, set())
+        return set().union(*self.get_rolesets(groups, role_id).values())
 
     def get_object_tags(self, uuid):
         role_id = self.roles.by_name["tag_applies"]
@@ -560,7 +697,8 @@ class Interface(object):
         role_id = self.roles.by_name["group_contains"]
         res = self.get_roleset(uuid, role_id, reverse=True)
         if recursive:
-            return recurse_set(res, lambda gid: self.groups_containing_group(gid))
+            contained_role_id = self.roles.by_name["contains_group"]
+            res |= self.get_roleset_closure(res, contained_role_id, reverse=True)
         return res
 
     def tagsets(self, tags):
@@ -568,9 +706,9 @@ class Interface(object):
         Returns dict with tag_ids as keys and list objects having
         tag as value.
         """
-        tagsets = [self.get_tagset(t) for t in tags]
-        res = zip(tags, [list(ts) for ts in tagsets])
-        return dict(res)
+        role_id = self.roles.by_name["tag_applies"]
+        tagsets = self.get_rolesets(tags, role_id)
+        return {t: list(ts) for t, ts in tagsets.items()}
 
     def tag_neighbors(self, uuid):
         """
@@ -586,9 +724,9 @@ class Interface(object):
         """
         Returns dict with group_ids as keys and list objects directly in group as value.
         """
-        sets = [self.get_groupset(t) for t in groups]
-        res = zip(groups, [list(items) for items in sets])
-        return dict(res)
+        role_id = self.roles.by_name["group_contains"]
+        sets = self.get_rolesets(groups, role_id)
+        return {g: list(items) for g, items in sets.items()}
 
     def group_neighbors(self, uuid):
         """
@@ -602,11 +740,10 @@ class Interface(object):
 
     def objects_in_group(self, group_id, transitive=False):
         role_id = self.roles.by_name["group_contains"]
-        groups = set(group_id)
+        groups = {group_id}
         if transitive:
             groups.update(self.groups_in_group(group_id))
-        sets = [self.get_roleset(gid, role_id) for gid in groups]
-        return reduce(lambda a, b: a | b, sets, set())
+        return set().union(*self.get_rolesets(groups, role_id).values())
 
     def _ensure_dict(self, d):
         if isinstance(d, BaseModel):
@@ -795,12 +932,15 @@ class Interface(object):
         cls = self.metaclass_named(name)
         return self.extension(cls.id)
 
-    def class_instances(self, name):
+    def class_instances(self, name, only_cols=None):
         coll = self.class_collection(name)
-        return coll.find()
+        cols = bulk.projection(only_cols)
+        return bulk.as_records(coll.iter_find(only_cols=cols), cols)
 
-    def instances_satisfying(self, name, criteria):
-        return self.class_collection(name).find(criteria)
+    def instances_satisfying(self, name, criteria, only_cols=None):
+        cols = bulk.projection(only_cols)
+        found = self.class_collection(name).find(criteria, only_cols=cols)
+        return list(bulk.as_records(found, cols))
 
     def class_instance_ids(self, name):
         cls = self.metaclass_named(name)
@@ -827,25 +967,47 @@ class Interface(object):
         else:
             raise Exception(f"No class named {clsName}")
 
-    def get_object(self, uuid):
+    def get_object(self, uuid, only_cols=None):
         obj = None
         if self._cache:
-            obj = self._cache.get(uuid)
-        if not obj:
+            obj = self._cache.lookup(uuid)
+        if obj is absent:
+            return None
+        if obj is None:
             coll = self.containing_collection(uuid)
-            obj = coll.get(uuid)
-        return obj
+            obj = coll.get(uuid, only_cols=only_cols)
+            if self._cache and (obj is None or not only_cols):
+                self._cache.set(uuid, obj)
+            return obj
+        return bulk.projected(obj, only_cols)
 
-    def bulk_load(self, uuids, preserve_order=True):
-        by_cls = partition(uuids, oid.oid_class)
-        res = []
-        for cls_id, ids in by_cls.items():
-            coll = self.extension(cls_id)
-            res.extend(coll.bulk_load(ids))
-        if preserve_order:
-            by_id = {x["_id"]: x for x in res}
-            res = [by_id[i] for i in uuids]
-        return res
+    def bulk_load(self, uuids, preserve_order=True, only_cols=None):
+        """
+        Objects with ids uuids, as Database.bulk_load, using the cache if any.
+        Projected loads are not cached.
+        """
+        uuids = list(uuids)
+        found, wanted = {}, uuids
+        if self._cache:
+            wanted = []
+            for an_id in uuids:
+                obj = self._cache.lookup(an_id)
+                if obj is None:
+                    wanted.append(an_id)
+                elif obj is not absent:
+                    found[an_id] = bulk.projected(obj, only_cols)
+        batches = bulk.batches(wanted, self.bulk_load_batch_size)
+        colls = {cls_id: self.extension(cls_id) for cls_id, _ in batches}
+        cols = bulk.projection(only_cols)
+        load = lambda batch: colls[batch[0]].bulk_load(batch[1], only_cols=cols)
+        loaded = map_threaded(load, batches, self.bulk_load_concurrency)
+        for (_, ids), records in zip(batches, loaded):
+            records = bulk.by_id(records)
+            if self._cache and not only_cols:
+                for an_id in ids:
+                    self._cache.set(an_id, records.get(an_id))
+            found.update(records)
+        return bulk.ordered(uuids, found, preserve_order)
 
     async def query(self, query):
         """
@@ -869,7 +1031,30 @@ class Interface(object):
             else:
                 return q
 
-        evaluator = query_module.QueryEvaluator2(
+        return await self._query_cache.evaluate(
             normalized_query(query), self, self.metacontext
         )
-        return await evaluator()
+
+    async def query_page(self, query, order_by=None, limit=None, cursor=None):
+        """
+        Ordered page of the uuids satisfying query.
+        @param order_by: attribute to order by, '-' prefixed for descending
+        @param limit: most uuids returned, None for all
+        @param cursor: token returned with the previous page
+        @returns (list of uuids, token for the next page or None)
+        """
+        return await query_page(
+            self,
+            query,
+            order_by,
+            limit,
+            cursor,
+            self._query_pages,
+            self._query_cache.generation,
+        )
+
+    def query_cache_stats(self):
+        return self._query_cache.stats()
+
+    def roleset_cache_stats(self):
+        return self._rolesets.stats()
@@ -0,0 +1,300 @@
+"""
+Compact id sets for query and association algebra.
+
+IdMap assigns each oid a dense int the first time it is seen.  Bitmap is a
+compressed set of such ints: ints are split into 2**16 wide chunks and each
+chunk is held in an array container (a sorted array('H') of the low 16 bits)
+while sparse and in a bitset container (a 2**16 bit Python int) once dense.
+AND, OR and AND-NOT work chunk by chunk on the containers without touching
+the oids.
+
+IdSet pairs a Bitmap with its IdMap and a negated flag, giving the
+NegatableSet operations over bitmaps.  It iterates and tests membership in
+oids, so it can be handed to code expecting a set of ids, and it combines
+with plain sets by mapping them into the same IdMap.  Only ids that can end up
+in a result are given ints, and an IdSet over another IdMap is mapped through
+its oids, so an owner may start a fresh IdMap to drop dead ids while sets over
+the old one are still around.
+"""
+
+__author__ = "samantha"
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+chunk_bits = 16
+chunk_mask = (1 << chunk_bits) - 1
+bitset_bytes = (1 << chunk_bits) // 8
+array_limit = 4096  # beyond this an array container is bigger than a bitset
+
+
+def _to_bitset(container):
+    if isinstance(container, int):
+        return container
+    flags = bytearray(bitset_bytes)
+    for low in container:
+        flags[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(flags, "little")
+
+
+def _lows(container):
+    """Sorted low bits held by a container."""
+    if not isinstance(container, int):
+        return container
+    flags = container.to_bytes(bitset_bytes, "little")
+    return array(
+        "H",
+        (
+            (i << 3) | j
+            for i, byte in enumerate(flags)
+            if byte
+            for j in range(8)
+            if byte >> j & 1
+        ),
+    )
+
+
+def _size(container):
+    return container.bit_count() if isinstance(container, int) else len(container)
+
+
+def _normalized(container):
+    """Container in its compact form, None if empty."""
+    if isinstance(container, int):
+        count = container.bit_count()
+        if not count:
+            return None
+        return _lows(container) if count <= array_limit else container
+    if not container:
+        return None
+    if len(container) > array_limit:
+        return _to_bitset(container)
+    return container
+
+
+def _filtered(lows, bitset, keep):
+    flags = bitset.to_bytes(bitset_bytes, "little")
+    return array("H", (x for x in lows if bool(flags[x >> 3] >> (x & 7) & 1) == keep))
+
+
+def _and(a, b):
+    a_bits, b_bits = isinstance(a, int), isinstance(b, int)
+    if a_bits and b_bits:
+        return _normalized(a & b)
+    if a_bits:
+        return _normalized(_filtered(b, a, True))
+    if b_bits:
+        return _normalized(_filtered(a, b, True))
+    return _normalized(array("H", sorted(set(a).intersection(b))))
+
+
+def _or(a, b):
+    if isinstance(a, int) or isinstance(b, int):
+        return _to_bitset(a) | _to_bitset(b)
+    return _normalized(array("H", sorted(set(a).union(b))))
+
+
+def _andnot(a, b):
+    if isinstance(a, int):
+        return _normalized(a & ~_to_bitset(b))
+    if isinstance(b, int):
+        return _normalized(_filtered(a, b, False))
+    return _normalized(array("H", sorted(set(a).difference(b))))
+
+
+class Bitmap:
+    """Compressed set of non-negative ints."""
+
+    __slots__ = ("_chunks",)
+
+    def __init__(self, ints=()):
+        self._chunks = {}
+        by_chunk = defaultdict(set)
+        for i in ints:
+            by_chunk[i >> chunk_bits].add(i & chunk_mask)
+        for high, lows in by_chunk.items():
+            self._chunks[high] = _normalized(array("H", sorted(lows)))
+
+    @classmethod
+    def _from_chunks(cls, chunks):
+        res = cls()
+        res._chunks = {k: v for k, v in chunks.items() if v is not None}
+        return res
+
+    def __len__(self):
+        return sum(_size(c) for c in self._chunks.values())
+
+    def __bool__(self):
+        return bool(self._chunks)
+
+    def __iter__(self):
+        for high in sorted(self._chunks):
+            base = high << chunk_bits
+            for low in _lows(self._chunks[high]):
+                yield base | low
+
+    def __contains__(self, i):
+        container = self._chunks.get(i >> chunk_bits)
+        if container is None:
+            return False
+        low = i & chunk_mask
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        pos = bisect_left(container, low)
+        return pos < len(container) and container[pos] == low
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __and__(self, other):
+        common = self._chunks.keys() & other._chunks.keys()
+        return self._from_chunks(
+            {k: _and(self._chunks[k], other._chunks[k]) for k in common}
+        )
+
+    def __or__(self, other):
+        chunks = dict(self._chunks)
+        for k, container in other._chunks.items():
+            mine = chunks.get(k)
+            chunks[k] = container if mine is None else _or(mine, container)
+        return self._from_chunks(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for k, container in self._chunks.items():
+            theirs = other._chunks.get(k)
+            chunks[k] = container if theirs is None else _andnot(container, theirs)
+        return self._from_chunks(chunks)
+
+    @classmethod
+    def union(cls, bitmaps):
+        res = cls()
+        for bitmap in bitmaps:
+            res = res | bitmap
+        return res
+
+
+class IdMap:
+    """Dense int for each oid, assigned in order of first sight."""
+
+    def __init__(self):
+        self._ints = {}
+        self._oids = []
+
+    def __len__(self):
+        return len(self._oids)
+
+    def int_of(self, an_id):
+        i = self._ints.get(an_id)
+        if i is None:
+            i = self._ints[an_id] = len(self._oids)
+            self._oids.append(an_id)
+        return i
+
+    def known_int(self, an_id):
+        return self._ints.get(an_id)
+
+    def known_bitmap(self, ids):
+        """Bitmap of those of ids that already have ints."""
+        ints = self._ints
+        return Bitmap(i for i in map(ints.get, ids) if i is not None)
+
+    def oid_of(self, i):
+        return self._oids[i]
+
+    def bitmap(self, ids):
+        return Bitmap(self.int_of(i) for i in ids)
+
+    def oids(self, bitmap):
+        oids = self._oids
+        return [oids[i] for i in bitmap]
+
+
+class IdSet:
+    """
+    Set of oids held as a Bitmap of their IdMap ints.  A negated IdSet stands
+    for everything except its members.
+    """
+
+    __slots__ = ("id_map", "bits", "_negated")
+
+    def __init__(self, id_map: IdMap, bits: Bitmap = None, negated=False):
+        self.id_map = id_map
+        self.bits = bits if bits is not None else Bitmap()
+        self._negated = negated
+
+    @classmethod
+    def of(cls, id_map, ids, negated=False):
+        return cls(id_map, id_map.bitmap(ids), negated)
+
+    @property
+    def negated(self):
+        return self._negated
+
+    def _coerce(self, other, known_only=False):
+        """
+        other as an IdSet over self.id_map.  With known_only ids without an int
+        are left out, for results that cannot hold anything self does not.
+        """
+        if isinstance(other, IdSet) and other.id_map is self.id_map:
+            return other
+        negated = getattr(other, "_negated", False)
+        if known_only:
+            return IdSet(self.id_map, self.id_map.known_bitmap(other), negated)
+        return IdSet.of(self.id_map, other, negated)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __bool__(self):
+        return bool(self.bits)
+
+    def __iter__(self):
+        return iter(self.id_map.oids(self.bits))
+
+    def __contains__(self, an_id):
+        i = self.id_map.known_int(an_id)
+        return i is not None and i in self.bits
+
+    def __eq__(self, other):
+        if isinstance(other, IdSet) and other.id_map is self.id_map:
+            return self._negated == other._negated and self.bits == other.bits
+        if isinstance(other, (IdSet, set, frozenset)):
+            negated = getattr(other, "_negated", False)
+            return self._negated == negated and set(self) == set(other)
+        return NotImplemented
+
+    def __and__(self, other):
+        other = self._coerce(other, known_only=not self._negated)
+        a, b = self.bits, other.bits
+        if self._negated and other._negated:
+            return IdSet(self.id_map, a | b, True)
+        if self._negated:
+            return IdSet(self.id_map, b - a)
+        if other._negated:
+            return IdSet(self.id_map, a - b)
+        return IdSet(self.id_map, a & b)
+
+    def __or__(self, other):
+        other = self._coerce(other)
+        a, b = self.bits, other.bits
+        if self._negated and other._negated:
+            return IdSet(self.id_map, a & b, True)
+        if self._negated:
+            return IdSet(self.id_map, a - b, True)
+        if other._negated:
+            return IdSet(self.id_map, b - a, True)
+        return IdSet(self.id_map, a | b)
+
+    def __sub__(self, other):
+        other = self._coerce(other, known_only=not self._negated)
+        return self & IdSet(self.id_map, other.bits, not other._negated)
+
+    def __rsub__(self, other):
+        return self._coerce(other) - self
+
+    __rand__ = __and__
+    __ror__ = __or__
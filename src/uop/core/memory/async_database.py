@@ -0,0 +1,58 @@
+__author__ = "samantha"
+
+from uop.core import async_database as base
+from uop.core.memory import database as memory_db
+from uop.core.memory import db_collection as memory
+from uop.core.memory import async_db_collection as db_coll
+from random import randint
+
+
+class Database(base.Database):
+    @classmethod
+    def make_test_database(cls, *schemas, **kwargs):
+        name = f"testdb_{randint(10000, 99999)}"
+        return cls.make_named_database(name, *schemas, **kwargs)
+
+    @classmethod
+    def make_named_database(cls, name, *schemas, **kwargs):
+        return cls(name, *schemas, **kwargs)
+
+    @classmethod
+    def existing_db_names(cls):
+        return list(memory_db.databases)
+
+    @classmethod
+    def drop_named_database(cls, name):
+        memory_db.databases.pop(name, None)
+
+    def __init__(self, dbname, *schemas, tenant_id="", **dbcredentials):
+        super().__init__(dbname, *schemas, tenant_id=tenant_id, **dbcredentials)
+        self._tables = memory_db.database_tables(dbname)
+
+    async def drop_database(self):
+        self._tables.clear()
+        self.drop_named_database(self._dbname)
+
+    async def get_raw_collection(self, name, schema=None):
+        table = self._tables.get(name)
+        if table is None:
+            table = self._tables[name] = memory.Table(name, schema, self._tables)
+        return table
+
+    def wrap_raw_collection(self, raw):
+        return db_coll.DBCollection(raw)
+
+    async def remove_collection(self, collection_name):
+        table = self._tables.get(collection_name)
+        if table is not None:
+            table.drop()
+
+    def _db_has_collection(self, name):
+        return name in self._tables
+
+
+def register():
+    """Registers this adaptor for async DatabaseClass lookup under db_type."""
+    from uop.core.connect.uop_connect import register_adaptor
+
+    register_adaptor(Database, memory_db.db_type, is_async=True)
@@ -0,0 +1,87 @@
+__author__ = "samantha"
+
+from uop.core import async_db_collection as base
+from uop.core.memory import db_collection as memory
+
+
+class DBCollection(base.DBCollection):
+    """Async managed collection over a memory Table. All work is done by the sync collection."""
+
+    def __init__(self, collection: memory.Table, indexed=False, *constraints):
+        super().__init__(collection, indexed, *constraints)
+        self._sync = memory.DBCollection(collection, indexed, *constraints)
+
+    @property
+    def table(self) -> memory.Table:
+        return self._coll
+
+    async def ensure_index(self, coll, *attr_order):
+        self._sync.ensure_index(coll, *attr_order)
+
+    async def find(
+        self, criteria=None, only_cols=None, order_by=None, limit=None, ids_only=False
+    ):
+        return self._sync.find(
+            criteria,
+            only_cols=only_cols,
+            order_by=order_by,
+            limit=limit,
+            ids_only=ids_only,
+        )
+
+    async def iter_find(
+        self, criteria=None, only_cols=None, order_by=None, batch_size=None
+    ):
+        for record in self._sync.iter_find(criteria, only_cols, order_by, batch_size):
+            yield record
+
+    async def find_one(self, criteria, only_cols=None):
+        return self._sync.find_one(criteria, only_cols=only_cols)
+
+    async def get(self, instance_id, only_cols=None):
+        return self._sync.get(instance_id, only_cols)
+
+    async def contains_id(self, an_id):
+        return self._sync.contains_id(an_id)
+
+    async def count(self, criteria=None):
+        return self._sync.count(criteria)
+
+    async def exists(self, criteria):
+        return self._sync.exists(criteria)
+
+    async def distinct(self, key, criteria=None):
+        return self._sync.distinct(key, criteria)
+
+    async def insert(self, **fields):
+        return self._sync.insert(**fields)
+
+    async def bulk_load(self, ids, only_cols=None):
+        return self._sync.bulk_load(ids, only_cols)
+
+    async def update_one(self, an_id, mods):
+        return self._sync.update_one(an_id, mods)
+
+    async def update(self, selector, mods, partial=True):
+        return self._sync.update(selector, mods, partial=partial)
+
+    async def replace_one(self, an_id, data):
+        self._sync.replace_one(an_id, data)
+
+    async def remove(self, dict_or_key):
+        return self._sync.remove(dict_or_key)
+
+    async def insert_many(self, records):
+        self._sync.insert_many(records)
+
+    async def update_many(self, modifications):
+        self._sync.update_many(modifications)
+
+    async def remove_many(self, dicts_or_keys):
+        self._sync.remove_many(dicts_or_keys)
+
+    async def drop(self):
+        self._coll.drop()
+
+    async def get_all(self):
+        return self._sync.get_all()
@@ -0,0 +1,70 @@
+"""
+In-process reference database adaptor.  All data lives in Tables held in a process
+wide map of database name to tables so separate Database instances (sync or async)
+opened on the same name share contents.  Nothing is persisted.
+"""
+
+__author__ = "samantha"
+
+from uop.core import database as base
+from uop.core.memory import db_collection as memory
+from random import randint
+
+db_type = "memory"
+
+databases = {}  # database name -> {collection name -> Table}
+
+
+def database_tables(name):
+    return databases.setdefault(name, {})
+
+
+class Database(base.Database):
+    @classmethod
+    def make_test_database(cls, *schemas, **kwargs):
+        name = f"testdb_{randint(10000, 99999)}"
+        return cls.make_named_database(name, *schemas, **kwargs)
+
+    @classmethod
+    def make_named_database(cls, name, *schemas, **kwargs):
+        return cls(name, *schemas, **kwargs)
+
+    @classmethod
+    def existing_db_names(cls):
+        return list(databases)
+
+    @classmethod
+    def drop_named_database(cls, name):
+        databases.pop(name, None)
+
+    def __init__(self, dbname, *schemas, tenant_id="", **dbcredentials):
+        super().__init__(dbname, *schemas, tenant_id=tenant_id, **dbcredentials)
+        self._tables = database_tables(dbname)
+
+    def drop_database(self):
+        self._tables.clear()
+        self.drop_named_database(self._dbname)
+
+    def get_raw_collection(self, name, schema=None):
+        table = self._tables.get(name)
+        if table is None:
+            table = self._tables[name] = memory.Table(name, schema, self._tables)
+        return table
+
+    def wrap_raw_collection(self, raw):
+        return memory.DBCollection(raw)
+
+    def remove_collection(self, collection_name):
+        table = self._tables.get(collection_name)
+        if table is not None:
+            table.drop()
+
+    def _db_has_collection(self, name):
+        return name in self._tables
+
+
+def register():
+    """Registers this adaptor for DatabaseClass lookup under db_type."""
+    from uop.core.connect.uop_connect import register_adaptor
+
+    register_adaptor(Database, db_type)
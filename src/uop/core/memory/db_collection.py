@@ -0,0 +1,296 @@
+"""
+In-process storage for the memory adaptor.
+
+A Table holds the records of one named collection keyed by id together with any
+hash secondary indices on it.  DBCollection is the managed collection wrapper the
+rest of UOP talks to.  Criteria are evaluated by the predicates compiled in
+uop.core.predicates after narrowing candidates through the indices.
+"""
+
+__author__ = "samantha"
+
+from uop.core import db_collection as base
+from uop.core.predicates import compiled_query, criteria_operator, hashable_types
+from collections import defaultdict
+from itertools import count
+
+
+def equality_terms(criteria):
+    """
+    Extracts the conjunctive equality terms of criteria usable against a hash index.
+    :param criteria: criteria dict
+    :return: map of field to tuple of acceptable values
+    """
+    terms = {}
+
+    def add(field, values):
+        if all(isinstance(v, hashable_types) for v in values):
+            terms.setdefault(field, tuple(values))
+
+    for key, value in (criteria or {}).items():
+        if key == "$and":
+            for clause in value:
+                for field, values in equality_terms(clause).items():
+                    terms.setdefault(field, values)
+        elif key in ("$eq", "$in"):
+            for field, val in value.items():
+                add(field, tuple(val) if key == "$in" else (val,))
+        elif key.startswith("$") or criteria_operator(key):
+            continue
+        elif isinstance(value, dict):
+            if set(value) == {"$in"}:
+                add(key, tuple(value["$in"]))
+            elif set(value) == {"$eq"}:
+                add(key, (value["$eq"],))
+        else:
+            add(key, (value,))
+    return terms
+
+
+class Table(object):
+    """Records of one collection by key plus hash secondary indices over field tuples."""
+
+    def __init__(self, name, schema=None, owner=None):
+        self.name = name
+        self.schema = schema
+        self.records = {}
+        self.indices = {}
+        self._owner = owner
+        self._sequence = count()
+
+    def key_for(self, record):
+        an_id = record.get("id")
+        return an_id if an_id else f"#{next(self._sequence)}"
+
+    def index_key(self, fields, record):
+        key = tuple(record.get(f) for f in fields)
+        if all(isinstance(k, hashable_types) for k in key):
+            return key
+
+    def ensure_index(self, fields):
+        fields = tuple(fields)
+        if fields not in self.indices:
+            index = defaultdict(set)
+            for key, record in self.records.items():
+                ikey = self.index_key(fields, record)
+                if ikey is not None:
+                    index[ikey].add(key)
+            self.indices[fields] = index
+        return self.indices[fields]
+
+    def _unindex(self, key, record):
+        for fields, index in self.indices.items():
+            ikey = self.index_key(fields, record)
+            if ikey is not None:
+                keys = index.get(ikey)
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del index[ikey]
+
+    def _index(self, key, record):
+        for fields, index in self.indices.items():
+            ikey = self.index_key(fields, record)
+            if ikey is not None:
+                index[ikey].add(key)
+
+    def put(self, key, record):
+        old = self.records.get(key)
+        if old is not None:
+            self._unindex(key, old)
+        self.records[key] = record
+        self._index(key, record)
+
+    def delete(self, key):
+        record = self.records.pop(key, None)
+        if record is not None:
+            self._unindex(key, record)
+        return record
+
+    def candidates(self, criteria):
+        """
+        Keys of records that may satisfy criteria using the id or the best matching
+        hash index. Returns None when a full scan is needed.
+        """
+        terms = equality_terms(criteria)
+        if not terms:
+            return None
+        if "id" in terms:
+            return {i for i in terms["id"] if i in self.records}
+        usable = [f for f in self.indices if all(x in terms for x in f)]
+        if not usable:
+            return None
+        fields = max(usable, key=len)
+        index = self.indices[fields]
+        keys = set()
+        combos = [()]
+        for f in fields:
+            combos = [c + (v,) for c in combos for v in terms[f]]
+        for combo in combos:
+            keys.update(index.get(combo, ()))
+        return keys
+
+    def _candidate_records(self, criteria):
+        keys = self.candidates(criteria)
+        if keys is None:
+            return self.records
+        return {k: self.records[k] for k in keys if k in self.records}
+
+    def matching(self, criteria):
+        """Generates (key, record) pairs of the records satisfying criteria."""
+        test = compiled_query(criteria)
+        for key, record in list(self._candidate_records(criteria).items()):
+            if test(record):
+                yield key, record
+
+    def select(self, criteria):
+        """List of the records satisfying criteria, filtered as one batch."""
+        records = self._candidate_records(criteria).values()
+        if not criteria:
+            return list(records)
+        return compiled_query(criteria).filter_many(records)
+
+    def clear(self):
+        self.records.clear()
+        for index in self.indices.values():
+            index.clear()
+
+    def drop(self):
+        self.clear()
+        if self._owner is not None:
+            self._owner.pop(self.name, None)
+
+
+def sort_records(records, order_by):
+    """Sorts in place by the given fields, a leading '-' on a field sorts it descending."""
+    for field in reversed(list(order_by)):
+        descending = field.startswith("-")
+        name = field[1:] if descending else field
+        key = lambda r: (r.get(name) is not None, r.get(name))
+        records.sort(key=key, reverse=descending)
+    return records
+
+
+class DBCollection(base.DBCollection):
+    """Managed collection over a memory Table."""
+
+    def __init__(self, collection: Table, indexed=False, *constraints):
+        super().__init__(collection, indexed, *constraints)
+        indices = getattr(collection.schema, "secondary_indices", None)
+        if callable(indices):
+            for index in indices(collection.name):
+                self.ensure_index(collection, *index.fields)
+
+    def ensure_index(self, coll, *attr_order):
+        coll.ensure_index(attr_order)
+
+    @property
+    def table(self) -> Table:
+        return self._coll
+
+    def _project(self, records, only_cols=None, ids_only=False):
+        if ids_only:
+            return [r[self.ID_Field] for r in records if self.ID_Field in r]
+        if only_cols:
+            if len(only_cols) == 1:
+                col = only_cols[0]
+                return [r[col] for r in records if col in r]
+            return [{c: r[c] for c in only_cols if c in r} for r in records]
+        return [dict(r) for r in records]
+
+    def find(
+        self, criteria=None, only_cols=None, order_by=None, limit=None, ids_only=False
+    ):
+        if isinstance(criteria, str):
+            criteria = {self.ID_Field: criteria}
+        records = self._coll.select(criteria)
+        if order_by:
+            sort_records(records, order_by)
+        if limit:
+            records = records[:limit]
+        return self._project(records, only_cols, ids_only)
+
+    def iter_find(self, criteria=None, only_cols=None, order_by=None, batch_size=None):
+        """The matches are already in memory, so they are only copied out as consumed."""
+        if isinstance(criteria, str):
+            criteria = {self.ID_Field: criteria}
+        records = self._coll.select(criteria)
+        if order_by:
+            sort_records(records, order_by)
+        for record in records:
+            yield from self._project([record], only_cols)
+
+    def find_one(self, criteria, only_cols=None):
+        for _, record in self._coll.matching(criteria):
+            return self._project([record], only_cols)[0]
+        return None
+
+    def get(self, instance_id, only_cols=None):
+        record = self._coll.records.get(instance_id)
+        if record is None or only_cols:
+            return base.bulk.projected(record, only_cols)
+        return dict(record)
+
+    def contains_id(self, an_id):
+        return an_id in self._coll.records
+
+    def count(self, criteria=None):
+        if not criteria:
+            return len(self._coll.records)
+        return len(self._coll.select(criteria))
+
+    def exists(self, criteria):
+        return any(True for _ in self._coll.matching(criteria))
+
+    def distinct(self, key, criteria=None):
+        return {r[key] for r in self._coll.select(criteria) if key in r}
+
+    def insert(self, **fields):
+        """Inserts a record. A record with the id of an existing one replaces it."""
+        record = dict(fields)
+        self._coll.put(self._coll.key_for(record), record)
+        return dict(record)
+
+    def bulk_load(self, ids, only_cols=None):
+        records = self._coll.records
+        found = [records[i] for i in ids if i in records]
+        if only_cols:
+            return [base.bulk.projected(r, only_cols) for r in found]
+        return [dict(r) for r in found]
+
+    def update_one(self, an_id, mods):
+        record = self._coll.records.get(an_id)
+        if record is None:
+            return False
+        updated = dict(record)
+        updated.update(mods)
+        self._coll.put(an_id, updated)
+        return True
+
+    def update(self, selector, mods, partial=True):
+        if isinstance(selector, str):
+            selector = {self.ID_Field: selector}
+        changed = list(self._coll.matching(selector))
+        for key, record in changed:
+            updated = dict(record) if partial else {}
+            if not partial and self.ID_Field in record:
+                updated[self.ID_Field] = record[self.ID_Field]
+            updated.update(mods)
+            self._coll.put(key, updated)
+        return len(changed)
+
+    def replace_one(self, an_id, data):
+        record = dict(data)
+        record[self.ID_Field] = an_id
+        self._coll.put(an_id, record)
+
+    def remove(self, dict_or_key):
+        if isinstance(dict_or_key, str):
+            return 1 if self._coll.delete(dict_or_key) is not None else 0
+        doomed = [k for k, _ in self._coll.matching(dict_or_key)]
+        for key in doomed:
+            self._coll.delete(key)
+        return len(doomed)
+
+    def get_all(self):
+        return {k: dict(r) for k, r in self._coll.records.items()}
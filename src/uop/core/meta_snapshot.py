@@ -0,0 +1,46 @@
+"""
+Stored MetaContext snapshots.
+
+The uop_meta_snapshots collection holds two records.  The stamp record carries
+a generation token replaced whenever meta changes are applied.  The snapshot
+record carries the meta objects, encoded as compressed JSON, the names of the
+installed schemas and the generation it was taken at.  A process opening the
+database builds its MetaContext from the snapshot when the two generations
+match, instead of reading every meta collection, and otherwise rebuilds and
+writes a fresh snapshot.
+"""
+
+__author__ = "samantha"
+
+import json
+import uuid
+import zlib
+from uop.meta.attr_info import meta_kinds
+from uop.meta.schemas.meta import MetaContext
+
+stamp_id = "generation"
+snapshot_id = "metacontext"
+
+
+def new_generation():
+    return uuid.uuid4().hex
+
+
+def encode_context(context: MetaContext):
+    data = {
+        kind: [m.dict() for m in context.metas_of_kind(kind)] for kind in meta_kinds
+    }
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode())
+
+
+def decode_context(packed):
+    return MetaContext.from_data(json.loads(zlib.decompress(packed)))
+
+
+def snapshot_record(context: MetaContext, generation, schema_names):
+    return dict(
+        id=snapshot_id,
+        generation=generation,
+        schemas=sorted(schema_names),
+        context=encode_context(context),
+    )
@@ -0,0 +1,176 @@
+"""
+Cache of object records by id.
+
+Entries are kept in least recently used order, bounded both by count and by
+an approximate size in bytes, and optionally expire ttl seconds after they
+were stored.  Ids looked up and not found are remembered too, so repeated
+lookups of missing objects do not go to the database.  Applying a changeset
+drops the objects it inserts, modifies or deletes and every object of the
+classes it modifies or deletes.
+"""
+
+__author__ = "samantha"
+
+from collections import OrderedDict, defaultdict
+import copy
+import sys
+import time
+from uop.meta import oid
+
+# marks a cached lookup of an id that has no object
+absent = object()
+
+
+def approximate_size(value):
+    """Rough byte size of value and the containers and values inside it."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(v) for v in value)
+    return size
+
+
+def key_class(key):
+    """Class id of an object id key, None for other keys."""
+    if isinstance(key, str) and oid.oid_sep in key:
+        return oid.oid_class(key)
+    return None
+
+
+class ObjectCache:
+    """
+    Bounded LRU of object records with changeset based invalidation.
+    :param max_entries: most entries kept
+    :param max_bytes: most approximate bytes kept, None for no limit
+    :param ttl: seconds an entry is good for, None to keep until dropped
+    :param negative_ttl: seconds a missing id is remembered, defaults to ttl
+    """
+
+    def __init__(
+        self,
+        max_entries=10000,
+        max_bytes=64 * 1024 * 1024,
+        ttl=None,
+        negative_ttl=None,
+        clock=time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (value, size, expires)
+        self._by_class = defaultdict(set)  # class id -> keys
+        self.bytes = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        # callers test 'if cache:', which must hold for an empty cache
+        return True
+
+    def stats(self):
+        return dict(
+            entries=len(self._entries),
+            bytes=self.bytes,
+            hits=self.hits,
+            negative_hits=self.negative_hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+            invalidations=self.invalidations,
+        )
+
+    def clear(self):
+        self._entries.clear()
+        self._by_class.clear()
+        self.bytes = 0
+
+    def lookup(self, key):
+        """
+        Copy of the value cached for key, absent if key is known to have no
+        value or None if it is not cached, counting the hit or miss.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= self._clock():
+            self._drop(key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        value = entry[0]
+        if value is absent:
+            self.negative_hits += 1
+            return absent
+        self.hits += 1
+        return copy.copy(value)
+
+    def get(self, key):
+        """Cached value of key or None if it is not cached or has no value."""
+        value = self.lookup(key)
+        return None if value is absent else value
+
+    def set(self, key, value):
+        """Cache value for key, a value of None recording that key has none."""
+        self._drop(key)
+        if value is None:
+            value, ttl = absent, self.negative_ttl
+        else:
+            value, ttl = copy.copy(value), self.ttl
+        size = approximate_size(value) if value is not absent else 0
+        size += approximate_size(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = self._clock() + ttl if ttl is not None else None
+        self._entries[key] = (value, size, expires)
+        self.bytes += size
+        cls_id = key_class(key)
+        if cls_id is not None:
+            self._by_class[cls_id].add(key)
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes -= entry[1]
+        cls_id = key_class(key)
+        keys = self._by_class.get(cls_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_class[cls_id]
+        return True
+
+    def invalidate(self, keys):
+        """Drop the entries for keys."""
+        for key in keys:
+            if self._drop(key):
+                self.invalidations += 1
+
+    def invalidate_classes(self, cls_ids):
+        """Drop the entries of every object of the classes cls_ids."""
+        for cls_id in cls_ids:
+            self.invalidate(list(self._by_class.get(cls_id, ())))
+
+    def apply_changes(self, changes):
+        """Drop what changes makes stale.  Call before changes is cleared."""
+        objects = changes.objects
+        for ids in (objects.inserted, objects.modified, objects.deleted):
+            self.invalidate(list(ids))
+        classes = changes.classes
+        self.invalidate_classes(set(classes.modified) | set(classes.deleted))
@@ -0,0 +1,277 @@
+"""
+Compiles record criteria to specialized Python predicates.
+
+Criteria are the dict forms the core builds:
+  - plain field equality {field: value}
+  - Q style operator-first clauses {'$gt': {field: value}}
+  - field-first clauses {field: {'$gt': value}}
+  - '$and' / '$or' lists of criteria and '$not' of a criteria
+
+A criteria is compiled once into Python source for a single expression over
+the record which is turned into both a one record predicate and a batch filter
+running the expression in a list comprehension.  Compiled queries are cached by
+the canonical form of the criteria so equivalent dicts share one compilation.
+"""
+
+__author__ = "samantha"
+
+from collections import OrderedDict
+import re
+
+_missing = object()
+
+hashable_types = (str, int, float, bool, type(None))
+
+operator_aliases = {
+    ">": "gt",
+    ">=": "gte",
+    "ge": "gte",
+    "<": "lt",
+    "<=": "lte",
+    "le": "lte",
+    "==": "eq",
+    "!=": "neq",
+    "ne": "neq",
+}
+
+operators = {
+    "gt",
+    "gte",
+    "lt",
+    "lte",
+    "eq",
+    "neq",
+    "in",
+    "nin",
+    "exists",
+    "regex",
+    "startswith",
+    "endswith",
+    "like",
+    "not_like",
+}
+
+ordering_symbols = dict(gt=">", gte=">=", lt="<", lte="<=")
+
+
+def operator_name(key):
+    """Canonical operator name for an operator key or None if key is not an operator."""
+    if not isinstance(key, str):
+        return None
+    name = key[1:] if key.startswith("$") else key
+    name = operator_aliases.get(name, name)
+    return name if name in operators else None
+
+
+def criteria_operator(key):
+    """
+    operator_name of a top level criteria key.  Only '$' prefixed names and
+    symbols such as '>' are operators there; a bare name such as 'in' or
+    'like' is a field.
+    """
+    if isinstance(key, str) and (key.startswith("$") or not key.isidentifier()):
+        return operator_name(key)
+    return None
+
+
+def criteria_key(op):
+    """Top level criteria key of the operator op, e.g. '$like' for 'like'."""
+    return f"${operator_name(op)}"
+
+
+def like_pattern(pattern):
+    """Compiled regex for a 'like' pattern where * matches anything."""
+    return re.compile(".*".join(re.escape(p) for p in pattern.split("*")))
+
+
+def canonical_query(query):
+    """Hashable form of a criteria equal for equal criteria regardless of key order."""
+    if isinstance(query, dict):
+        return ("{", tuple(sorted((k, canonical_query(v)) for k, v in query.items())))
+    if isinstance(query, (list, tuple)):
+        return ("[", tuple(canonical_query(v) for v in query))
+    if isinstance(query, (set, frozenset)):
+        return ("(", tuple(sorted(map(canonical_query, query), key=repr)))
+    return query
+
+
+class _Guard(object):
+    """Comparisons used by guarded predicates: type mismatches are simply false."""
+
+    @staticmethod
+    def compare(op, value, other):
+        if value is _missing:
+            return False
+        try:
+            if op == "gt":
+                return value > other
+            if op == "gte":
+                return value >= other
+            if op == "lt":
+                return value < other
+            return value <= other
+        except TypeError:
+            return False
+
+    @staticmethod
+    def member(value, values):
+        try:
+            return value in values
+        except TypeError:  # unhashable value against a frozenset
+            return any(value == v for v in values)
+
+    @staticmethod
+    def call(fn, value):
+        if value is _missing:
+            return False
+        try:
+            return fn(value)
+        except (TypeError, AttributeError):
+            return False
+
+
+class CompiledQuery(object):
+    """
+    Predicate for one criteria.  Calling it tests a single record and
+    filter_many tests a whole batch in one call.
+    """
+
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self._names = {"_M": _missing, "_G": _Guard}
+        self._count = 0
+        self.source = self._emit(criteria or {}, guarded=False)
+        guarded_source = self._emit(criteria or {}, guarded=True)
+        self._fast, self._fast_many = self._build(self.source)
+        self._guarded, self._guarded_many = self._build(guarded_source)
+
+    def __call__(self, record):
+        try:
+            return self._fast(record)
+        except (TypeError, AttributeError):
+            return self._guarded(record)
+
+    def filter_many(self, records):
+        """List of the records satisfying the criteria."""
+        records = records if isinstance(records, (list, tuple)) else list(records)
+        try:
+            return self._fast_many(records)
+        except (TypeError, AttributeError):
+            return self._guarded_many(records)
+
+    def _build(self, expression):
+        code = (
+            f"def test(r):\n    return bool({expression})\n"
+            f"def many(records):\n    return [r for r in records if {expression}]\n"
+        )
+        namespace = dict(self._names)
+        exec(compile(code, "<uop query>", "exec"), namespace)
+        return namespace["test"], namespace["many"]
+
+    def _name(self, value, prefix="_c"):
+        name = f"{prefix}{self._count}"
+        self._count += 1
+        self._names[name] = value
+        return name
+
+    def _emit(self, criteria, guarded):
+        if not isinstance(criteria, dict):
+            raise ValueError(f"bad query criteria: {criteria!r}")
+        parts = []
+        for key, value in criteria.items():
+            if key in ("$and", "$or"):
+                subs = [self._emit(c, guarded) for c in value]
+                joiner = " and " if key == "$and" else " or "
+                parts.append(f"({joiner.join(subs)})" if subs else str(key == "$and"))
+            elif key == "$not":
+                parts.append(f"(not {self._emit(value, guarded)})")
+            elif criteria_operator(key):
+                op = criteria_operator(key)
+                parts.extend(self._leaf(f, op, v, guarded) for f, v in value.items())
+            elif isinstance(key, str) and key.startswith("$"):
+                raise ValueError(f"{key} is not a record criteria operator")
+            elif isinstance(value, dict) and value and all(map(operator_name, value)):
+                parts.extend(
+                    self._leaf(key, operator_name(o), v, guarded)
+                    for o, v in value.items()
+                )
+            else:
+                parts.append(self._leaf(key, "eq", value, guarded))
+        if not parts:
+            return "True"
+        return parts[0] if len(parts) == 1 else f"({' and '.join(parts)})"
+
+    def _leaf(self, field, op, value, guarded):
+        get = f"r.get({field!r}, _M)"
+        if op in ("in", "nin"):
+            values = tuple(value)
+            if all(isinstance(v, hashable_types) for v in values):
+                values = frozenset(values)
+            if guarded:
+                test = self._name(lambda v: _Guard.member(v, values), "_f")
+                res = f"_G.call({test}, {get})"
+                return res if op == "in" else f"(not {res})"
+            test = "in" if op == "in" else "not in"
+            return f"({get} {test} {self._name(values)})"
+        if op in ("eq", "neq"):
+            if guarded:
+                test = self._name(lambda v: v == value, "_f")
+                res = f"_G.call({test}, {get})"
+                return res if op == "eq" else f"(not {res})"
+            test = "==" if op == "eq" else "!="
+            return f"({get} {test} {self._name(value)})"
+        if op == "exists":
+            return f"(({get} is not _M) == {bool(value)})"
+        if op in ordering_symbols:
+            const = self._name(value)
+            if guarded:
+                return f"_G.compare({op!r}, {get}, {const})"
+            x = self._name(None, "_x")
+            return f"(({x} := {get}) is not _M and {x} {ordering_symbols[op]} {const})"
+        if op in ("startswith", "endswith"):
+            const = self._name(value)
+            if guarded:
+                test = self._name(lambda v: getattr(v, op)(value), "_f")
+                return f"_G.call({test}, {get})"
+            x = self._name(None, "_x")
+            return f"(({x} := {get}) is not _M and {x}.{op}({const}))"
+        if op in ("like", "not_like"):
+            pattern = like_pattern(value)
+        else:
+            pattern = re.compile(value)
+        negate = op == "not_like"
+        if guarded:
+            test = self._name(lambda v: pattern.search(v) is not None, "_f")
+            res = f"_G.call({test}, {get})"
+            return f"(not {res})" if negate else res
+        x = self._name(None, "_x")
+        search = f"{self._name(pattern, '_p')}.search({x})"
+        if negate:
+            return f"(({x} := {get}) is _M or {search} is None)"
+        return f"(({x} := {get}) is not _M and {search} is not None)"
+
+
+compiled_cache_size = 512
+_compiled = OrderedDict()
+
+
+def compiled_query(criteria):
+    """
+    The CompiledQuery for criteria, shared by all equivalent criteria.
+    :param criteria: criteria dict or None for everything
+    :return: the compiled predicate
+    """
+    key = canonical_query(criteria or {})
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = _compiled[key] = CompiledQuery(criteria)
+        if len(_compiled) > compiled_cache_size:
+            _compiled.popitem(last=False)
+    else:
+        _compiled.move_to_end(key)
+    return compiled
+
+
+def filter_many(criteria, records):
+    """List of records satisfying criteria, evaluated in a single batch."""
+    return compiled_query(criteria).filter_many(records)
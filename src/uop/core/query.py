@@ -1,12 +1,14 @@
 from sjasoft.utils.category import binary_partition, identity_function as identity
-from sjasoft.utils.dicts import first_kv
 from collections import defaultdict
 from functools import reduce, partial
 from uop.meta.schemas import meta
 from uop.meta import oid
-from sjasoft.utils.tools import a_set_and, a_set_or, set_and, set_or
+from uop.core import predicates
+from uop.core.idsets import IdSet
+from uop.core.concurrency import as_completed_bounded
+from sjasoft.utils.tools import set_and, set_or
 from sjasoft.utils.logging import getLogger
-import asyncio
+import inspect
 
 logger = getLogger(__file__)
 
@@ -25,46 +27,22 @@ class Q:
     def query_function(query):
         """
         Returns a function that can be used to evaluate a query against a dictionary.
+        The function is compiled once per distinct query and also offers
+        filter_many(records) to filter a whole batch in one call.
         @param query: the query to evaluate
         @return: a function that can be used to evaluate a query against a dictionary
         """
+        return predicates.compiled_query(query)
 
-        def _and(functions: list[callable]):
-            return lambda x: all(fn(x) for fn in functions)
-
-        def _or(functions: list[callable]):
-            return lambda x: any(fn(x) for fn in functions)
-
-        def operator_function(key, value):
-            ops = "$gt", "$lt", "$gte", "$lte", "$eq", "$neq", "$regex"
-            if key != ops:
-                temp = {key: value}
-                key = "$eq"
-                value = temp
-            prop, val = first_kv(value)
-            ops_map = {
-                "$gt": lambda x: x[prop] > val,
-                "$lt": lambda x: x[prop] < val,
-                "$gte": lambda x: x[prop] >= val,
-                "$lte": lambda x: x[prop] <= val,
-                "$eq": lambda x: x[prop] == val,
-                "$neq": lambda x: x[prop] != val,
-                "$regex": lambda x: re.search(val, x[prop]),
-            }
-            return ops_map[key]
-
-        key, value = first_kv(query)
-        functions = (
-            [Q.query_function(i) for i in value]
-            if key in ("$and", "$or")
-            else [operator_function(key, value)]
-        )
-        if key == "$and":
-            return _and(functions)
-        if key == "$or":
-            return _or(functions)
-        else:
-            return functions[0]
+    @staticmethod
+    def filter_many(query, records):
+        """
+        Returns the records satisfying query.
+        @param query: the query to evaluate
+        @param records: iterable of dictionaries
+        @return: list of the satisfying records
+        """
+        return predicates.filter_many(query, records)
 
     @staticmethod
     def gt(prop, val):
@@ -133,23 +111,82 @@ def split_clause(clause):
     return key, criteria
 
 
-async def evaluate_classes(dbi, classes, to_filter=None):
+async def evaluate_classes(dbi, classes, to_filter=None, limit=None, timeout=None):
     if to_filter:
         return {i for i in to_filter if oid.oid_class(i) in classes}
     else:
 
         async def cls_find(cid):
-            coll = await dbi.extension(cid)
-            return await coll.ids_only()
+            coll = await resolved(dbi.extension(cid))
+            return set(await resolved(coll.ids_only()))
 
-        return await a_set_or(cls_find, classes)
+        return await a_set_or(cls_find, classes, limit, timeout)
 
 
 property_operations = ("$gt", "$lt", "$gte", "$lte", "$neq", "$eq")
 
+unbounded = float("inf")  # estimate for components only cheap as filters
+
 
-async def a_set_or(fun, items):
-    return reduce(lambda a, b: a | b, asyncio.gather(map(fun, items), set()))
+async def resolved(value):
+    """value, awaited if need be, so sync and async database interfaces both work"""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+def is_negated(ids):
+    return isinstance(ids, (NegatableSet, IdSet)) and ids._negated
+
+
+def intersect(ids, other):
+    """ids & other staying in bitmap space if either is an IdSet"""
+    if isinstance(ids, IdSet):
+        return ids & other
+    if isinstance(other, IdSet):
+        return other & ids
+    return NegatableSet(ids) & other
+
+
+def negation(ids):
+    if isinstance(ids, IdSet):
+        return IdSet(ids.id_map, ids.bits, True)
+    return NegatableSet(ids, True)
+
+
+def as_oid_set(ids):
+    """Query result with any IdSet turned back into a set of oids."""
+    if isinstance(ids, IdSet):
+        return NegatableSet(ids, True) if ids.negated else set(ids)
+    return ids
+
+
+async def a_set_or(fun, items, limit=None, timeout=None):
+    """
+    Union of fun(item) over items.  The calls run concurrently, at most limit
+    at a time and each within timeout seconds, and their results are merged
+    into the union as they arrive.
+    """
+
+    async def call(item):
+        return await resolved(fun(item))
+
+    res = set()
+    async for ids in as_completed_bounded(map(call, items), limit, timeout):
+        res = res | ids
+    return res
+
+
+async def a_set_and(fun, items):
+    items = list(items)
+    if not items:
+        return set()
+    current = await resolved(fun(items[0]))
+    for item in items[1:]:
+        if not current and not is_negated(current):
+            break
+        current = current & await resolved(fun(item))
+    return current
 
 
 class NegatableSet(set):
@@ -158,6 +195,8 @@ class NegatableSet(set):
         self._negated = negated
 
     def __and__(self, other_set):
+        if isinstance(other_set, IdSet):
+            return NotImplemented
         self_negated = self._negated
         other_negated = isinstance(other_set, NegatableSet) and other_set._negated
         not_both = self_negated ^ other_negated
@@ -171,6 +210,8 @@ class NegatableSet(set):
             return self.__class__(raw, self_negated)
 
     def __or__(self, other_set):
+        if isinstance(other_set, IdSet):
+            return NotImplemented
         self_negated = self._negated
         other_negated = isinstance(other_set, NegatableSet) and other_set._negated
         not_both = self_negated ^ other_negated
@@ -192,9 +233,14 @@ class NegatableSet(set):
 
 
 class ComponentEvaluator:
+    # bounds on the concurrent per extension, per association and per child
+    # calls a component fans out to
+    fan_out_limit = 16
+    call_timeout = None  # seconds
+
     @classmethod
-    def evaluator(cls, component, in_context, object_ids=None):
-        return cls(component, in_context, object_ids)
+    def evaluator(cls, component, in_context, object_ids=None, class_context=None):
+        return cls(component, in_context, object_ids, class_context)
 
     def __init__(self, component, in_context, object_ids=None, class_context=None):
         self._object_ids = object_ids
@@ -207,6 +253,15 @@ class ComponentEvaluator:
     def object_filter(self):
         return NegatableSet(self._object_ids)
 
+    async def union(self, fun, items):
+        """Union of fun(item) over items fanned out within the evaluator bounds."""
+        return await a_set_or(fun, items, self.fan_out_limit, self.call_timeout)
+
+    async def class_ids(self, classes, to_filter=None):
+        return await evaluate_classes(
+            self.dbi, classes, to_filter, self.fan_out_limit, self.call_timeout
+        )
+
     @property
     def dbi(self):
         return self._in_context.dbi
@@ -219,73 +274,139 @@ class ComponentEvaluator:
         by_name = getattr(self.metacontext, kind).by_name
         return {by_name[n].id for n in names}
 
-    async def get_association(self, component: meta.AssociatedComponent):
-        assoc_ids = set()
-        assoc_objs = set()
+    def assoc_role(self, component: meta.AssociatedComponent):
+        """(association kind, role relating association to objects) of component"""
+        if isinstance(component, meta.TagsComponent):
+            return "tags", self.dbi.role_id("tag_applies")
+        return "groups", self.dbi.role_id("group_contains")
 
-        async def obj_assocs(obj):
-            return set()
+    async def roleset_size(self, subject, role_id, reverse=False):
+        """Roleset size, unbounded when the dbi cannot count without loading it."""
+        sizer = getattr(self.dbi, "get_roleset_size", None)
+        if sizer is None:
+            return unbounded
+        return await resolved(sizer(subject, role_id, reverse=reverse))
 
-        if isinstance(component, meta.TagsComponent):
-            assoc_ids = self.get_named("tags", component.names)
-            associated = self.dbi.get_tagset
-            obj_assocs = self.dbi.get_object_tags
-        elif isinstance(component, meta.GroupsComponent):
-            assoc_ids = self.get_named("groups", component.names)
-            if component.include_subgroups:
-                pass
-            # TODO need group tree for subgroups in meta
-            kinds = "groups"
-            associated = self.dbi.get_groupset
-            obj_assocs = self.dbi.get_object_groups
+    async def estimate(self, component):
+        """
+        Estimated number of ids component evaluates to unfiltered, from
+        association sizes and related degrees.  Negated components and attribute
+        criteria are unbounded as they are only worth running as filters.
+        """
+        if isinstance(component, meta.AssociatedComponent):
+            if component.application == "none":
+                return unbounded
+            kind, role_id = self.assoc_role(component)
+            sizes = [
+                await self.roleset_size(an_id, role_id)
+                for an_id in self.get_named(kind, component.names)
+            ]
+            if not sizes:
+                return 0
+            return min(sizes) if component.application == "all" else sum(sizes)
+        elif isinstance(component, meta.RelatedTo):
+            if component.negated:
+                return unbounded
+            if component.role:
+                rid = self.metacontext.roles.by_name[component.role].id
+                return await self.roleset_size(component.obj_id, rid)
+            degree = getattr(self.dbi, "get_degree", None)
+            if degree is None:
+                return unbounded
+            return await resolved(degree(component.obj_id))
+        elif isinstance(component, meta.AndQuery):
+            estimates = [await self.estimate(c) for c in component.components]
+            return min(estimates, default=unbounded)
+        elif isinstance(component, meta.OrQuery):
+            estimates = [await self.estimate(c) for c in component.components]
+            return sum(estimates)
+        return unbounded
 
-        if self._object_ids:
-            assoc_map = {oid: set(await obj_assocs(oid)) for oid in self._object_ids}
-            if component.application == "all":
-                test = lambda s: (s & assoc_ids) == assoc_ids
-                return {k for k, v in assoc_map.items() if test(v)}
-            elif component.application == "any":
-                return {k for k, v in assoc_map.items() if v and assoc_ids}
-            elif component.application == "none":
-                return {k for k, v in assoc_map.items() if not (v and assoc_ids)}
-            return set()
+    async def get_association(self, component: meta.AssociatedComponent):
+        """
+        Filters self._object_ids by component using one batched lookup of the
+        associations of all the objects.
+        """
+        kind, role_id = self.assoc_role(component)
+        assoc_ids = self.get_named(kind, component.names)
+        if kind == "groups":
+            assoc_ids = set(self.group_scope(component, assoc_ids))
+        assoc_map = await resolved(
+            self.dbi.get_rolesets(self._object_ids, role_id, reverse=True)
+        )
+        if component.application == "all":
+            test = lambda s: (s & assoc_ids) == assoc_ids
+        elif component.application == "any":
+            test = lambda s: bool(s & assoc_ids)
         else:
-            pass
+            test = lambda s: not (s & assoc_ids)
+        return {k for k, v in assoc_map.items() if test(v)}
+
+    async def combine(self, component: meta.AssociatedComponent, assoc_ids):
+        """
+        Objects with all (application 'all') or any of assoc_ids, combined by
+        the database interface, which may do it in a shared cache.
+        """
+        _, role_id = self.assoc_role(component)
+        intersect = component.application == "all"
+        return await resolved(
+            self.dbi.combine_rolesets(assoc_ids, role_id, intersect=intersect)
+        )
 
     async def evaluate_tags(self, component: meta.TagsComponent):
-        eval_tag = lambda tag: self.dbi.get_tagset(tag)
-        tag_ids = [self.metacontext.tags.by_name[t][id] for t in component.names]
+        if self._object_ids:
+            return await self.get_association(component)
+        tag_ids = [self.metacontext.tags.by_name[t].id for t in component.names]
         raw = set()
-        if component.application in ("any", "none"):
-            raw = await a_set_or(eval_tag, tag_ids)
-        elif component.application == "all":
-            raw = await a_set_and(eval_tag, tag_ids)
+        if hasattr(self.dbi, "combine_rolesets"):
+            raw = await self.combine(component, tag_ids)
+        else:
+            eval_tag = getattr(self.dbi, "get_tagset_bits", None) or self.dbi.get_tagset
+            if component.application in ("any", "none"):
+                raw = await self.union(eval_tag, tag_ids)
+            elif component.application == "all":
+                raw = await a_set_and(eval_tag, tag_ids)
         if component.application == "none":
-            return NegatableSet(raw, True)
+            return negation(raw)
         else:
             return raw
 
+    def group_scope(self, component: meta.GroupsComponent, group_ids):
+        """The groups whose members a groups component reads, subgroups included."""
+        if not group_ids:
+            return set()
+        if component.application == "all":
+            return set_and(self.metacontext.subgroups, list(group_ids))
+        return set_or(self.metacontext.subgroups, group_ids)
+
     async def evaluate_groups(self, component: meta.GroupsComponent):
-        eval_tag = lambda tag: self.dbi.get_groupset(tag)
-        group_ids = {self.metacontext.groups.by_name[t][id] for t in component.names}
+        if self._object_ids:
+            return await self.get_association(component)
+        group_ids = {self.metacontext.groups.by_name[t].id for t in component.names}
         raw = set()
-        if component.application in ("any", "none"):
-            group_ids = set_or(self.metacontext.subgroups, group_ids)
-            raw = await a_set_or(eval_tag, group_ids)
-        elif component.application == "all":
-            group_ids = set_and(self.metacontext.subgroups, group_ids)
-            raw = await a_set_and(eval_tag, group_ids)
+        group_ids = self.group_scope(component, group_ids)
+        if hasattr(self.dbi, "combine_rolesets"):
+            raw = await self.combine(component, group_ids)
+        else:
+            eval_group = (
+                getattr(self.dbi, "get_groupset_bits", None) or self.dbi.get_groupset
+            )
+            if component.application in ("any", "none"):
+                raw = await self.union(eval_group, group_ids)
+            elif component.application == "all":
+                raw = await a_set_and(eval_group, group_ids)
         if component.application == "none":
-            return NegatableSet(raw, True)
+            return negation(raw)
         else:
             return raw
 
     async def evaluate_related(self, component: meta.RelatedTo):
-        fun = self.dbi.get_related_objects
         if component.role:
             rid = self.metacontext.roles.by_name[component.role].id
             fun = partial(self.dbi.get_roleset, role_id=rid)
-        oids = await fun(component.obj_id)
+        else:
+            fun = self.dbi.get_related_objects
+        oids = await resolved(fun(component.obj_id))
         if component.negated:
             return NegatableSet(items=oids, negated=True)
         else:
@@ -294,7 +415,7 @@ class ComponentEvaluator:
     async def evaluate_or(self, component: meta.OrQuery):
         evaluator = partial(self.sub_eval, class_context=self._class_context)
         fun = lambda child: evaluator(child)()
-        return a_set_or(fun, component.components)
+        return await self.union(fun, component.components)
 
     def _combine_classes(self, class_specs: meta.List[meta.ClassComponent], is_and):
         """
@@ -315,7 +436,7 @@ class ComponentEvaluator:
         :prama is_and: whether we are in and clause. False is for OR clause
         :return: set of classes allowed, set of classes not allowed
         """
-        by_name = self._in_context.classes.by_name
+        by_name = self.metacontext.classes.by_name
         positive = set()
         negative = set()
         all_subs = self.metacontext.subclasses(by_name["PersistentObject"].id)
@@ -354,27 +475,50 @@ class ComponentEvaluator:
 
         return res
 
+    async def plan_and(self, components):
+        """
+        Orders AND children most selective first by estimated cardinality.
+        Ties keep their written order.
+        """
+        estimates = [await self.estimate(c) for c in components]
+        order = sorted(range(len(components)), key=lambda i: (estimates[i], i))
+        return [components[i] for i in order]
+
     async def evaluate_and(self, component: meta.AndQuery):
+        """
+        Evaluates the most selective child unfiltered, restricted to the class
+        context, and the rest as filters over the running set of ids.
+        """
         class_specs, non_class = binary_partition(
             component.components, lambda x: isinstance(x, meta.ClassComponent)
         )
-        class_context = None
+        class_context = self._class_context
         if class_specs:
-            class_context = self._combine_classes(class_specs)
+            class_context = self._combine_classes(class_specs, True)
             if class_context is not None:
                 if not class_context:
                     return set()
+        if not non_class:
+            if class_context:
+                return await self.class_ids(class_context, self._object_ids)
+            return set()
 
         evaluator = partial(self.sub_eval, class_context=class_context)
-        first = non_class[0]
-        rest = non_class[1:]
-        obj_ids = await evaluator(first)()
-        if obj_ids:
-            for child in rest:
-                ids = await evaluator(child, object_ids=obj_ids)()
-                obj_ids &= ids
-                if not obj_ids:
-                    return set()
+        obj_ids = self._object_ids
+        for child in await self.plan_and(non_class):
+            filter_ids = None if is_negated(obj_ids) else obj_ids
+            ids = await evaluator(child, object_ids=filter_ids)()
+            if obj_ids is None:
+                obj_ids = ids
+                if class_context:
+                    in_classes = await self.class_ids(
+                        class_context, None if is_negated(ids) else ids
+                    )
+                    obj_ids = intersect(in_classes, ids)
+            else:
+                obj_ids = intersect(obj_ids, ids)
+            if not obj_ids and not is_negated(obj_ids):
+                return set()
         return obj_ids
 
     async def evaluate_attribute(self, component: meta.AttributeComponent):
@@ -393,34 +537,34 @@ class ComponentEvaluator:
         :param component:
         :return:
         """
-        cls_by_id = self._in_context.classes.by_id
+        cls_by_id = self.metacontext.classes.by_id
 
         def check_class(clsid):
-            cls = cls_by_id(clsid)
-            if not cls.is_abstract:
+            cls = cls_by_id.get(clsid)
+            if cls and not cls.is_abstract:
                 return any(a.name == component.attr_name for a in cls.attributes)
+            return False
 
-        expr = {component.operate: {component.attr_name: component.value}}
+        expr = {
+            predicates.criteria_key(component.operate): {
+                component.attr_name: component.value
+            }
+        }
         find_objects = lambda coll: coll.ids_only(expr)
         if self._object_ids:
-            by_id = defaultdict(list)
-            to_check = []
-            for o in self._object_ids:
-                by_id[oid.oid_class(o)].append(o)
-            for cid, oids in by_id.items():
-                to_check.extend(oids)
-            fun = component.obj_eval()
-            return a_set_or(fun, to_check)
+            test = component.obj_eval()
+            name = component.attr_name
+            objects = await resolved(self.dbi.bulk_load(list(self._object_ids)))
+            return {o["id"] for o in objects if o and name in o and test(o)}
         else:
-            classes = []
-            test = lambda cls: check_class(cls.id) and not cls.is_abstract
-            if self._class_context:
-                cids = [check_class(cid) for cid in self._class_context]
-            else:
-                cids = [check_class(cid) for cid in self.metacontext.classes.by_id]
-            colls = [self._in_context.dbi.extension(cid) for cid in cids]
-            fun = lambda coll: coll.find(expr)
-            return await a_set_or(fun, colls)
+            candidates = self._class_context or self.metacontext.classes.by_id
+            cids = [cid for cid in candidates if check_class(cid)]
+
+            async def find_in_class(cid):
+                coll = await resolved(self.dbi.extension(cid))
+                return set(await resolved(find_objects(coll)))
+
+            return await self.union(find_in_class, cids)
 
     async def __call__(self):
         component = self._component
@@ -456,6 +600,6 @@ class QueryEvaluator2:
     def dbi(self):
         return self._dbi
 
-    def __call__(self):
+    async def __call__(self):
         evaluator = ComponentEvaluator(self._component, in_context=self)
-        return evaluator()
+        return as_oid_set(await evaluator())
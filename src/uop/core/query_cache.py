@@ -0,0 +1,260 @@
+"""
+Result cache for saved and ad hoc queries.
+
+Results are keyed by the canonical form of the query component so equal
+queries share an entry however their dicts were written.  Each entry records
+the ids its result depends on: the classes (with subclasses) it is scoped to,
+the tags, groups and related objects it reads associations of, and the roles
+and attributes it names.  Queries not restricted to some classes depend on any
+object change when they test attributes and otherwise only on object deletes,
+which drop the deleted objects' associations without listing them.  Applying a changeset invalidates only the entries depending on
+ids the changeset touches.
+"""
+
+__author__ = "samantha"
+
+from collections import OrderedDict, defaultdict
+import copy
+from uop.core.predicates import canonical_query
+from uop.core.query import QueryEvaluator2
+from uop.meta import oid
+from uop.meta.schemas import meta
+
+any_object = "*"
+deleted_object = "*deleted"
+
+
+def query_component(query):
+    """The QueryComponent of a MetaQuery, or query itself if already one."""
+    return getattr(query, "query", query)
+
+
+def query_key(query):
+    """Canonical hashable key of a query or None if it cannot be keyed."""
+    component = query_component(query)
+    if isinstance(component, meta.QueryComponent):
+        component = component.to_dict()
+    elif isinstance(component, dict) and "query" in component:
+        component = component["query"]
+    try:
+        key = canonical_query(component)
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def class_scope(component, context: meta.MetaContext):
+    """Class ids every result of component must belong to, None if unrestricted."""
+    if isinstance(component, meta.ClassComponent):
+        if not component.positive:
+            return None
+        cid = context.classes.by_name[component.cls_name].id
+        return context.subclasses(cid) if component.include_subclasses else {cid}
+    if isinstance(component, meta.AndQuery):
+        scopes = [class_scope(c, context) for c in component.components]
+        scopes = [s for s in scopes if s is not None]
+        return set.intersection(*scopes) if scopes else None
+    if isinstance(component, meta.OrQuery):
+        scopes = [class_scope(c, context) for c in component.components]
+        if not scopes or None in scopes:
+            return None
+        return set.union(*scopes)
+    return None
+
+
+def query_dependencies(component, context: meta.MetaContext):
+    """Ids a result of component may change with."""
+    deps = set()
+    reads_attributes = False
+
+    def named(kind, name):
+        return getattr(context, kind).by_name[name].id
+
+    def walk(comp):
+        nonlocal reads_attributes
+        if isinstance(comp, meta.CompositeQuery):
+            for child in comp.components:
+                walk(child)
+        elif isinstance(comp, meta.ClassComponent):
+            cid = named("classes", comp.cls_name)
+            deps.update(context.subclasses(cid) if comp.include_subclasses else {cid})
+        elif isinstance(comp, meta.TagsComponent):
+            for name in comp.names:
+                tid = named("tags", name)
+                deps.add(tid)
+                deps.update(context.subtags(tid))
+        elif isinstance(comp, meta.GroupsComponent):
+            for name in comp.names:
+                # the evaluator reads subgroups for every application
+                deps.update(context.subgroups(named("groups", name)))
+        elif isinstance(comp, meta.RelatedTo):
+            deps.add(comp.obj_id)
+            if comp.role:
+                deps.add(named("roles", comp.role))
+        elif isinstance(comp, meta.AttributeComponent):
+            deps.add(named("attributes", comp.attr_name))
+            reads_attributes = True
+
+    walk(component)
+    if class_scope(component, context) is None:
+        deps.add(any_object if reads_attributes else deleted_object)
+    return deps
+
+
+def changed_ids(changes, context: meta.MetaContext):
+    """
+    Ids a changeset touches in the sense of query_dependencies.  Inserted and
+    modified metadata also touches the meta objects it is placed under (the
+    superclass, parent tags and containing groups) as queries on those
+    include it.  Call before the changeset is applied or cleared.
+    """
+    res = set()
+
+    def id_of(kind, name):
+        known = getattr(context, kind).by_name.get(name) if context else None
+        if known is not None:
+            return known.id
+        for data in getattr(changes, kind).inserted.values():
+            if data.get("name") == name:
+                return data.get("id")
+
+    def parents(kind, data):
+        if kind == "classes" and data.get("superclass"):
+            return [data["superclass"]]
+        if kind == "tags" and data.get("name"):
+            parts = data["name"].split(".")
+            return [".".join(parts[:i]) for i in range(1, len(parts))]
+        if kind == "groups":
+            contained_in = data.get("contained_in") or []
+            return [contained_in] if isinstance(contained_in, str) else contained_in
+        return []
+
+    for kind in ("classes", "attributes", "roles", "tags", "groups"):
+        kind_changes = getattr(changes, kind)
+        res.update(kind_changes.deleted)
+        for data_map in (kind_changes.inserted, kind_changes.modified):
+            for an_id, data in data_map.items():
+                res.add(an_id)
+                res.update(id_of(kind, name) for name in parents(kind, data))
+
+    objects = changes.objects
+    object_ids = set(objects.inserted) | set(objects.modified) | set(objects.deleted)
+    if object_ids:
+        res.add(any_object)
+        if objects.deleted:
+            res.add(deleted_object)
+        res.update(object_ids)
+        res.update(oid.oid_class(o) for o in object_ids)
+
+    for kind in ("tagged", "grouped", "related"):
+        kind_changes = getattr(changes, kind, None)
+        if kind_changes is None:
+            continue
+        for related in kind_changes.inserted | kind_changes.deleted:
+            res.update((related.subject_id, related.object_id))
+    res.discard(None)
+    return res
+
+
+class QueryCache:
+    """
+    Bounded LRU of query results with dependency based invalidation.
+    Results larger than max_result_size are evaluated but not kept.
+    """
+
+    def __init__(self, max_entries=256, max_result_size=100000):
+        self.max_entries = max_entries
+        self.max_result_size = max_result_size
+        self._entries = OrderedDict()  # key -> (result, deps)
+        self._by_dependency = defaultdict(set)  # dependency id -> keys
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def generation(self):
+        """Count of clears and invalidations, moving on whenever results may change."""
+        return self._generation
+
+    def stats(self):
+        return dict(
+            entries=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._by_dependency.clear()
+
+    def get(self, key):
+        """Copy of the cached result for key or None, counting the hit or miss."""
+        entry = self._entries.get(key) if key is not None else None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return copy.copy(entry[0])
+
+    def put(self, key, result, deps):
+        if key is None or result is None or len(result) > self.max_result_size:
+            return
+        self._drop(key)
+        self._entries[key] = (copy.copy(result), deps)
+        for dep in deps:
+            self._by_dependency[dep].add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for dep in entry[1]:
+            keys = self._by_dependency.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_dependency[dep]
+        return True
+
+    def invalidate(self, ids):
+        """Drop the entries depending on any of ids."""
+        self._generation += 1
+        keys = set()
+        for an_id in ids:
+            keys.update(self._by_dependency.get(an_id, ()))
+        for key in keys:
+            if self._drop(key):
+                self.invalidations += 1
+
+    async def evaluate(self, query, dbi, metacontext: meta.MetaContext = None):
+        """
+        Result of query from the cache or else evaluated with QueryEvaluator2
+        and cached unless changes were applied while it was being evaluated.
+        """
+        key = query_key(query)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        generation = self._generation
+        context = metacontext or dbi.metacontext
+        result = await QueryEvaluator2(query, dbi, context)()
+        if key is not None and generation == self._generation:
+            try:
+                deps = query_dependencies(query_component(query), context)
+            except (KeyError, AttributeError):
+                return result
+            self.put(key, result, deps)
+        return result
@@ -0,0 +1,261 @@
+"""
+Ordered, limited query results with continuation tokens.
+
+A page is the next limit ids of a query's result ordered by one attribute,
+'-name' for descending, with the id breaking ties.  Missing values sort
+before all others ascending, as collection find orders them.  Values of
+types that do not compare with each other are ordered by type name.  Each
+page but the last comes with an opaque token holding the sort key of its
+last id, dates, datetimes and bytes tagged as in changeset_codec; the next
+page is whatever sorts after that key.
+
+Queries on a single class, alone or with attribute criteria, are handed to
+the class collection's find with the order, limit and a keyset condition on
+the token's key, so the backend can use its indexes.  Other queries are
+evaluated, the sort attribute of the result is loaded and a bounded heap
+picks the page.  Those (value, id) rows are kept under the token so later
+pages come from them without evaluating the query again, as long as the
+query cache generation has not moved on since.
+"""
+
+__author__ = "samantha"
+
+import base64
+from collections import OrderedDict
+import hashlib
+import heapq
+import json
+import uuid
+from uop.core.changeset_codec import tagged_json, untagged_json
+from uop.core.predicates import criteria_key
+from uop.core.query import as_oid_set, is_negated, resolved
+from uop.core.query_cache import query_component, query_key
+from uop.meta import oid
+from uop.meta.schemas import meta
+
+
+def order_spec(order_by):
+    """(field, descending) of an order_by such as 'name' or '-name'."""
+    if isinstance(order_by, (list, tuple)):
+        if len(order_by) != 1:
+            raise ValueError("queries are ordered by a single attribute")
+        order_by = order_by[0]
+    order_by = order_by or oid.id_field
+    if order_by.startswith("-"):
+        return order_by[1:], True
+    return order_by, False
+
+
+class _Descending:
+    """Sort key wrapper reversing the order of what it wraps."""
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class _Mixed:
+    """Sort key wrapper ordering values that do not compare by type name."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        try:
+            return self.value < other.value
+        except TypeError:
+            return type(self.value).__name__ < type(other.value).__name__
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def sort_key(value, an_id, descending=False, mixed=False):
+    value_key = (value is not None, _Mixed(value) if mixed else value)
+    return (_Descending(value_key) if descending else value_key), an_id
+
+
+def query_digest(query):
+    key = query_key(query)
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16] if key else ""
+
+
+def encode_token(digest, order_by, last, rows_id=None):
+    data = [digest, order_by, list(last), rows_id]
+    raw = json.dumps(data, default=tagged_json)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_token(token, digest, order_by):
+    """(last (value, id), rows id) of a token for this query and order."""
+    try:
+        token_digest, token_order, last, rows_id = json.loads(
+            base64.urlsafe_b64decode(token.encode()), object_hook=untagged_json
+        )
+    except (ValueError, TypeError):
+        raise ValueError("invalid continuation token")
+    if (token_digest, token_order) != (digest, order_by):
+        raise ValueError("continuation token is for a different query or order")
+    return tuple(last), rows_id
+
+
+def top_k(rows, limit, descending=False, after=None):
+    """
+    The first limit (value, id) rows in sort order after the key of the row
+    after, with a heap of at most limit rows.  Values are compared directly
+    unless some do not compare with each other.
+    """
+    try:
+        return _top_k(rows, limit, descending, after, False)
+    except TypeError:
+        return _top_k(rows, limit, descending, after, True)
+
+
+def _top_k(rows, limit, descending, after, mixed):
+    key = lambda row: sort_key(row[0], row[1], descending, mixed)
+    if after is not None:
+        floor = key(after)
+        rows = [r for r in rows if floor < key(r)]
+    if limit is None:
+        return sorted(rows, key=key)
+    return heapq.nsmallest(limit, rows, key=key)
+
+
+def single_class(component, context: meta.MetaContext):
+    """
+    (class id, criteria) when component is one class, without subclasses,
+    possibly with attribute criteria, and so can be found in one collection.
+    """
+    if isinstance(component, meta.AndQuery) and not component.negated:
+        parts = component.components
+    else:
+        parts = [component]
+    classes = [p for p in parts if isinstance(p, meta.ClassComponent)]
+    attributes = [p for p in parts if isinstance(p, meta.AttributeComponent)]
+    if len(classes) != 1 or len(classes) + len(attributes) != len(parts):
+        return None
+    cls = context.classes.by_name.get(classes[0].cls_name)
+    if cls is None or not classes[0].positive:
+        return None
+    if classes[0].include_subclasses and context.subclasses(cls.id) - {cls.id}:
+        return None
+    criteria = [{criteria_key(a.operate): {a.attr_name: a.value}} for a in attributes]
+    return cls.id, criteria
+
+
+def keyset_criteria(field, descending, last):
+    """
+    Criteria for records sorting after last, a (value, id), in find's order:
+    missing values first ascending and last descending, ids ascending on ties.
+    """
+    value, an_id = last
+    if field == oid.id_field:
+        return {"$lt" if descending else "$gt": {field: value}}
+    later_id = {"$gt": {oid.id_field: an_id}}
+    no_value = {"$or": [{field: None}, {field: {"$exists": False}}]}
+    if value is None:
+        tie = {"$and": [no_value, later_id]}
+        if descending:
+            return tie
+        has_value = {"$and": [{field: {"$exists": True}}, {"$neq": {field: None}}]}
+        return {"$or": [tie, has_value]}
+    beyond = {"$lt" if descending else "$gt": {field: value}}
+    tie = {"$and": [{field: value}, later_id]}
+    return {"$or": [beyond, tie, no_value] if descending else [beyond, tie]}
+
+
+class PageRows:
+    """Bounded LRU of the (value, id) rows of paged queries."""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # rows id -> (generation, rows)
+
+    def save(self, rows, generation):
+        rows_id = uuid.uuid4().hex[:16]
+        self._entries[rows_id] = (generation, rows)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return rows_id
+
+    def get(self, rows_id, generation):
+        """Rows saved under rows_id or None if gone or from an earlier generation."""
+        entry = self._entries.get(rows_id)
+        if entry is None or entry[0] != generation:
+            return None
+        self._entries.move_to_end(rows_id)
+        return entry[1]
+
+
+async def _find_page(dbi, cls_id, criteria, field, descending, limit, last):
+    if last is not None:
+        criteria = criteria + [keyset_criteria(field, descending, last)]
+    coll = await resolved(dbi.extension(cls_id))
+    order = [f"-{field}" if descending else field, oid.id_field]
+    cols = list(dict.fromkeys([oid.id_field, field]))
+    found = await resolved(
+        coll.find(
+            {"$and": criteria} if criteria else None,
+            only_cols=cols,
+            order_by=order,
+            limit=limit + 1 if limit else None,
+        )
+    )
+    if len(cols) == 1:
+        return [(an_id, an_id) for an_id in found]
+    return [(r.get(field), r[oid.id_field]) for r in found]
+
+
+async def _result_rows(dbi, query, field):
+    ids = await dbi.query(query)
+    if is_negated(ids):
+        raise ValueError("a negated query result cannot be ordered")
+    ids = list(as_oid_set(ids))
+    if field == oid.id_field:
+        return [(an_id, an_id) for an_id in ids]
+    records = await resolved(
+        dbi.bulk_load(ids, preserve_order=False, only_cols=[field])
+    )
+    return [(r.get(field), r[oid.id_field]) for r in records]
+
+
+async def query_page(
+    dbi, query, order_by=None, limit=None, cursor=None, pages=None, generation=0
+):
+    """
+    A page of the ids satisfying query.
+    :param dbi: Database or Interface the query runs against
+    :param order_by: attribute to order by, '-' prefixed for descending
+    :param limit: most ids returned, None for all of them
+    :param cursor: token returned with the previous page, None for the first
+    :param pages: PageRows keeping evaluated rows for later pages
+    :param generation: query cache generation the saved rows are good for
+    :return: (list of ids, token for the next page or None if there is none)
+    """
+    field, descending = order_spec(order_by)
+    order_by = f"-{field}" if descending else field
+    digest = query_digest(query)
+    last, rows_id = decode_token(cursor, digest, order_by) if cursor else (None, None)
+    rows = pages.get(rows_id, generation) if pages is not None and rows_id else None
+    target = single_class(query_component(query), dbi.metacontext)
+    if rows is None and target is not None:
+        page = await _find_page(dbi, *target, field, descending, limit, last)
+    else:
+        if rows is None:
+            rows = await _result_rows(dbi, query, field)
+            rows_id = pages.save(rows, generation) if pages is not None else None
+        page = top_k(rows, limit + 1 if limit else None, descending, last)
+    token = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        token = encode_token(digest, order_by, page[-1], rows_id)
+    return [an_id for _, an_id in page], token
@@ -0,0 +1,140 @@
+"""
+Cache of rolesets read from the related collection.
+
+A roleset is keyed by (role_id, id, reverse): the objects an id is subject of
+under a role or, reversed, the subjects it is object of.  An inserted or
+deleted related edge changes exactly two rolesets, its subject's forward one
+and its object's reverse one, so applying a changeset evicts just those.
+Deleting a role evicts every roleset of the role and deleting an object, tag
+or group every roleset keyed by or containing its id, whether or not the
+edges removed with them appear in the changeset.
+"""
+
+__author__ = "samantha"
+
+from collections import OrderedDict, defaultdict
+from uop.core.adjacency import edge_parts
+from uop.meta import oid
+
+
+def roleset_key(role_id, an_id, reverse=False):
+    return role_id, an_id, bool(reverse)
+
+
+class RolesetCache:
+    """Bounded LRU of rolesets with edge level invalidation."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # roleset_key -> frozenset of ids
+        self._by_role = defaultdict(set)  # role_id -> keys
+        self._by_id = defaultdict(set)  # id -> keys of rolesets of or holding it
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return dict(
+            entries=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
+
+    def clear(self):
+        self._entries.clear()
+        self._by_role.clear()
+        self._by_id.clear()
+
+    def get(self, role_id, an_id, reverse=False):
+        """Copy of the cached roleset or None, counting the hit or miss."""
+        key = roleset_key(role_id, an_id, reverse)
+        ids = self._entries.get(key)
+        if ids is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return set(ids)
+
+    def get_many(self, ids, role_id, reverse=False):
+        """
+        Cached rolesets of ids.
+        :return: dict of id to roleset for the cached ones and list of the rest
+        """
+        found, missing = {}, []
+        for an_id in ids:
+            roleset = self.get(role_id, an_id, reverse)
+            if roleset is None:
+                missing.append(an_id)
+            else:
+                found[an_id] = roleset
+        return found, missing
+
+    def put(self, role_id, an_id, reverse, ids):
+        key = roleset_key(role_id, an_id, reverse)
+        self._drop(key)
+        self._entries[key] = frozenset(ids)
+        self._by_role[role_id].add(key)
+        for index_id in (an_id, *ids):
+            self._by_id[index_id].add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        ids = self._entries.pop(key, None)
+        if ids is None:
+            return False
+        role_id, an_id, _ = key
+        indexed = [(self._by_role, role_id), (self._by_id, an_id)]
+        indexed.extend((self._by_id, i) for i in ids)
+        for index, index_key in indexed:
+            keys = index.get(index_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[index_key]
+        return True
+
+    def _invalidate(self, keys):
+        for key in list(keys):
+            if self._drop(key):
+                self.invalidations += 1
+
+    def evict_edge(self, related):
+        """Drop the two rolesets a related edge belongs to."""
+        subject, role_id, object = edge_parts(related)
+        self._invalidate(
+            (roleset_key(role_id, subject), roleset_key(role_id, object, True))
+        )
+
+    def evict_role(self, role_id):
+        self._invalidate(self._by_role.get(role_id, ()))
+
+    def evict_id(self, an_id):
+        """Drop the rolesets of an_id and those holding it."""
+        self._invalidate(self._by_id.get(an_id, ()))
+
+    def evict_class(self, cls_id):
+        """Drop the rolesets of or holding every object of class cls_id."""
+        for an_id in [i for i in self._by_id if oid.oid_class(i) == cls_id]:
+            self.evict_id(an_id)
+
+    def apply_changes(self, changes):
+        """Drop the rolesets changes affects.  Call before changes is cleared."""
+        related = changes.related
+        for edge in list(related.inserted) + list(related.deleted):
+            self.evict_edge(edge)
+        for role_id in changes.roles.deleted:
+            self.evict_role(role_id)
+        for kind in ("objects", "tags", "groups"):
+            for an_id in getattr(changes, kind).deleted:
+                self.evict_id(an_id)
+        for cls_id in changes.classes.deleted:
+            self.evict_class(cls_id)
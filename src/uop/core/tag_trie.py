@@ -0,0 +1,103 @@
+"""
+Trie over hierarchical tag names.
+
+Tag hierarchy is expressed in tag names: 'projects.uop.core' is a subtag of
+'projects.uop' and of 'projects'.  The trie has a node per name segment and
+each node keeps the ids of all tags at or beneath it, so the subtags of a tag,
+or all tags under some prefix, are a single lookup rather than a scan of every
+tag name.
+"""
+
+__author__ = "samantha"
+
+separator = "."
+
+
+class _Node:
+    __slots__ = ("children", "tag_id", "ids")
+
+    def __init__(self):
+        self.children = {}
+        self.tag_id = None
+        self.ids = set()  # ids of tags at or beneath this node
+
+
+class TagTrie:
+    def __init__(self, tags=()):
+        """
+        :param tags: MetaTag instances or tag dicts to start with
+        """
+        self._root = _Node()
+        self._names = {}  # tag_id -> name
+        for tag in tags:
+            if isinstance(tag, dict):
+                self.add(tag["id"], tag["name"])
+            else:
+                self.add(tag.id, tag.name)
+
+    @staticmethod
+    def segments(name):
+        return [s for s in name.split(separator) if s]
+
+    def _path(self, name, create=False):
+        """Nodes from the root down to name, None if name is not present."""
+        node = self._root
+        path = [node]
+        for segment in self.segments(name):
+            child = node.children.get(segment)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[segment] = _Node()
+            node = child
+            path.append(node)
+        return path
+
+    def add(self, tag_id, name):
+        if tag_id in self._names:
+            self.remove(tag_id)
+        self._names[tag_id] = name
+        path = self._path(name, create=True)
+        path[-1].tag_id = tag_id
+        for node in path:
+            node.ids.add(tag_id)
+
+    def remove(self, tag_id):
+        name = self._names.pop(tag_id, None)
+        if name is None:
+            return
+        path = self._path(name)
+        if path[-1].tag_id == tag_id:
+            path[-1].tag_id = None
+        for node in path:
+            node.ids.discard(tag_id)
+        segments = self.segments(name)
+        for parent, node, segment in reversed(list(zip(path[:-1], path[1:], segments))):
+            if node.ids:
+                break
+            del parent.children[segment]
+
+    def apply_delta(self, delta):
+        """Brings the trie up to date with the tag changes of a MetaDelta."""
+        for tag_id in delta.deleted.get("tags", ()):
+            self.remove(tag_id)
+        for data in delta.inserted.get("tags", ()):
+            self.add(data["id"], data["name"])
+        for tag_id, mods in delta.modified.get("tags", {}).items():
+            if "name" in mods:
+                self.add(tag_id, mods["name"])
+
+    def under(self, prefix):
+        """Ids of the tag named prefix, if any, and of all tags beneath it."""
+        path = self._path(prefix)
+        return set(path[-1].ids) if path else set()
+
+    def subtags(self, tag_id):
+        """Ids of the tags strictly beneath tag_id."""
+        name = self._names.get(tag_id)
+        if name is None:
+            return set()
+        return self.under(name) - {tag_id}
+
+    def with_subtags(self, tag_id):
+        return self.subtags(tag_id) | {tag_id}
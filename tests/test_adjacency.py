@@ -0,0 +1,106 @@
+__author__ = "samantha"
+
+from uop.core.adjacency import AdjacencyIndex
+from uop.core.changeset import ChangeSet
+from uop.meta.schemas.meta import Related
+
+
+def edge(subject, role, object):
+    return Related(subject_id=subject, assoc_id=role, object_id=object)
+
+
+def loaded_index():
+    index = AdjacencyIndex()
+    rows = [
+        edge("t1", "tags", "a_c1"),
+        edge("t1", "tags", "b_c2"),
+        edge("t2", "tags", "a_c1"),
+        edge("g1", "contains", "a_c1"),
+        edge("g1", "contains_group", "g2"),
+    ]
+    index.load([r.without_kind() for r in rows])
+    return index
+
+
+def test_queries():
+    index = loaded_index()
+    assert index.roleset("t1", "tags") == {"a_c1", "b_c2"}
+    assert index.roleset("a_c1", "tags", reverse=True) == {"t1", "t2"}
+    assert index.object_roles("a_c1") == (set(), {"tags", "contains"})
+    forward, reverse = index.relationships("g1")
+    assert forward == {"contains": {"a_c1"}, "contains_group": {"g2"}}
+    assert not reverse
+    assert index.related("a_c1") == {"t1", "t2", "g1"}
+    assert index.role_subjects("tags") == {"t1", "t2"}
+    assert index.contains(edge("t2", "tags", "a_c1"))
+    by_subject, by_object = index.role_related("tags")
+    assert by_object["a_c1"] == {"t1", "t2"}
+
+
+def test_changes_and_cascades():
+    index = loaded_index()
+    changes = ChangeSet()
+    changes.related.insert(edge("t2", "tags", "b_c2"))
+    changes.related.insert(edge("t2", "tags", "d_xc2"))
+    changes.related.delete(edge("t1", "tags", "a_c1"))
+    index.apply_changes(changes.related)
+    assert index.roleset("b_c2", "tags", reverse=True) == {"t1", "t2"}
+    assert index.roleset("t1", "tags") == {"b_c2"}
+
+    index.remove_class("c2")
+    assert index.role_subjects("tags") == {"t2"}
+    assert index.roleset("t2", "tags") == {"a_c1", "d_xc2"}
+    index.remove_class("xc2")
+    index.remove_object_edges("g2", "contains_group")
+    assert index.object_roles("g1") == ({"contains"}, set())
+    index.remove_node("a_c1")
+    assert index.related("g1") == set()
+    assert index.role_subjects("tags") == set()
+
+
+def test_unloaded_ignores_changes():
+    index = AdjacencyIndex()
+    index.add(edge("t1", "tags", "a_c1"))
+    assert not index.roleset("t1", "tags")
+
+
+def test_rolesets():
+    index = loaded_index()
+    assert index.rolesets(["t1", "t2", "t3"], "tags") == {
+        "t1": {"a_c1", "b_c2"},
+        "t2": {"a_c1"},
+        "t3": set(),
+    }
+    assert index.rolesets(["g2"], "contains_group", reverse=True) == {"g2": {"g1"}}
+
+
+def test_closure_maintained():
+    index = AdjacencyIndex()
+    index.load(
+        [
+            edge("g1", "contains_group", "g2"),
+            edge("g2", "contains_group", "g3"),
+            edge("g2", "contains_group", "g4"),
+        ]
+    )
+    closure = index.closure("contains_group")
+    assert index.reachable(["g1"], "contains_group") == {"g2", "g3", "g4"}
+    assert index.reachable(["g3"], "contains_group", reverse=True) == {"g1", "g2"}
+
+    index.add(edge("g4", "contains_group", "g5"))
+    index.add(edge("g0", "contains_group", "g1"))
+    assert closure.contains("g0", "g5")
+    assert index.reachable(["g5"], "contains_group", reverse=True) == {
+        "g0",
+        "g1",
+        "g2",
+        "g4",
+    }
+
+    index.discard(edge("g1", "contains_group", "g2"))
+    assert index.reachable(["g0"], "contains_group") == {"g1"}
+    assert index.reachable(["g3"], "contains_group", reverse=True) == {"g2"}
+
+    index.remove_node("g2")
+    assert index.reachable(["g4"], "contains_group", reverse=True) == set()
+    assert index.reachable(["g4"], "contains_group") == {"g5"}
@@ -0,0 +1,25 @@
+__author__ = "samantha"
+
+from uop.core import bulk_load as bulk
+
+
+def test_batches():
+    ids = [f"o{i}_a" for i in range(5)] + ["p_b", "o1_a", "q_b"]
+    batches = bulk.batches(ids, batch_size=2)
+    assert batches == [
+        ("a", ["o0_a", "o1_a"]),
+        ("a", ["o2_a", "o3_a"]),
+        ("a", ["o4_a"]),
+        ("b", ["p_b", "q_b"]),
+    ]
+
+
+def test_projection_and_order():
+    assert bulk.projection(None) is None
+    assert bulk.projection(["name", "id"]) == ["id", "name"]
+    record = dict(id="x_a", name="x", size=3)
+    assert bulk.projected(record, ["size"]) == dict(id="x_a", size=3)
+    assert bulk.projected(None, ["size"]) is None
+    found = bulk.by_id([record])
+    assert bulk.ordered(["y_a", "x_a", "x_a"], found) == [None, record, record]
+    assert bulk.ordered(["y_a", "x_a"], found, preserve_order=False) == [record]
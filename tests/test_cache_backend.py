@@ -0,0 +1,140 @@
+__author__ = "samantha"
+
+import asyncio
+from uop.core.cache_backend import (
+    LocalCacheBackend,
+    connect_shared_cache,
+    roleset_set_key,
+    start_shared_cache,
+)
+from uop.core.changeset import ChangeSet
+from uop.core.query import QueryEvaluator2
+from uop.meta.schemas import meta
+from uop.meta.schemas.predefined import pkm_schema
+
+
+class SetDB:
+    """Just enough of a database interface to run tag queries in a set cache"""
+
+    def __init__(self, backend, tagged):
+        self.metacontext = meta.MetaContext.from_schema(pkm_schema)
+        for name in tagged:
+            self.metacontext.tags.add_item(meta.MetaTag(name=name))
+        self.backend = backend
+        self.tagged = {self.tag_id(n): ids for n, ids in tagged.items()}
+
+    def tag_id(self, name):
+        return self.metacontext.tags.by_name[name].id
+
+    def role_id(self, name):
+        return self.metacontext.roles.by_name[name].id
+
+    def combine_rolesets(self, subject_ids, role_id, intersect=False):
+        keys = [roleset_set_key(role_id, an_id) for an_id in subject_ids]
+        for an_id, key in zip(subject_ids, keys):
+            if key in self.backend.unloaded([key]):
+                self.backend.load_set(key, self.tagged[an_id])
+        return self.backend.sinter(*keys) if intersect else self.backend.sunion(*keys)
+
+
+def edge(subject, role, object):
+    return meta.Related(subject_id=subject, assoc_id=role, object_id=object)
+
+
+def check_set_algebra(backend):
+    backend.load_set("a", {"1", "2", "3"})
+    backend.load_set("b", {"2", "3", "4"})
+    backend.load_set("empty", ())
+    assert backend.unloaded(["a", "empty", "c"]) == ["c"]
+    assert backend.sinter("a", "b") == {"2", "3"}
+    assert backend.sunion("a", "b", "c") == {"1", "2", "3", "4"}
+    assert backend.sdiff("a", "b") == {"1"}
+    backend.sadd("a", "5")
+    backend.srem("a", "1")
+    assert backend.smembers("a") == {"2", "3", "5"} and backend.scard("a") == 3
+    backend.set("x_c1", dict(id="x_c1"))
+    backend.delete_matching("*_c1")
+    assert backend.get("x_c1") is None
+
+
+def test_local_set_algebra():
+    check_set_algebra(LocalCacheBackend())
+
+
+def test_apply_changes():
+    backend = LocalCacheBackend()
+    forward, reverse = roleset_set_key("r1", "t1"), roleset_set_key("r1", "a_c1", True)
+    backend.load_set(forward, {"b_c1"})
+    backend.load_set(roleset_set_key("r2", "t2"), {"a_c1"})
+    backend.set("a_c1", dict(id="a_c1"))
+    changes = ChangeSet()
+    changes.related.insert(edge("t1", "r1", "a_c1"))
+    changes.related.delete(edge("t1", "r1", "b_c1"))
+    backend.apply_changes(changes)
+    assert backend.smembers(forward) == {"a_c1"}
+    assert backend.unloaded([reverse]) == [reverse]
+
+    changes = ChangeSet()
+    changes.objects.deleted.add("a_c1")
+    changes.roles.deleted.add("r2")
+    backend.apply_changes(changes)
+    assert backend.get("a_c1") is None
+    assert backend.unloaded([roleset_set_key("r2", "t2")])
+    assert not backend.unloaded([forward])
+
+
+def test_deleted_members_removed():
+    backend = LocalCacheBackend()
+    tag_set = roleset_set_key("tagrole", "T")
+    backend.load_set(tag_set, {"x_c1", "y_c1", "z_c2"})
+    changes = ChangeSet()
+    changes.objects.deleted.add("x_c1")
+    backend.apply_changes(changes)
+    assert backend.smembers(tag_set) == {"y_c1", "z_c2"}
+    changes = ChangeSet()
+    changes.classes.deleted.add("c2")
+    backend.apply_changes(changes)
+    assert backend.smembers(tag_set) == {"y_c1"}
+
+
+def test_deleted_ids_are_not_patterns():
+    backend = LocalCacheBackend()
+    tag_set = roleset_set_key("tagrole", "T")
+    backend.load_set(tag_set, {"a_c1", "b_c1", "*_c1", "ab_xc1"})
+    backend.load_set(roleset_set_key("tagrole", "a_c1"), {"q_c3"})
+    changes = ChangeSet()
+    changes.objects.deleted.update({"?_c1", "[ab]_c1", "*_c1"})
+    backend.apply_changes(changes)
+    assert backend.smembers(tag_set) == {"a_c1", "b_c1", "ab_xc1"}
+    assert not backend.unloaded([roleset_set_key("tagrole", "a_c1")])
+    changes = ChangeSet()
+    changes.classes.deleted.add("c1")
+    backend.apply_changes(changes)
+    assert backend.smembers(tag_set) == {"ab_xc1"}
+    backend.load_set(tag_set, {"n_c4"})
+    changes = ChangeSet()
+    changes.objects.deleted.update({"n_c4", "ab_xc1"})
+    backend.apply_changes(changes)
+    assert backend.smembers(tag_set) == set()
+
+
+def test_tag_queries_combined_in_cache():
+    dbi = SetDB(LocalCacheBackend(), dict(red={"o1", "o2"}, blue={"o2", "o3"}))
+
+    def run(application):
+        component = meta.TagsComponent(names=["red", "blue"], application=application)
+        query = meta.MetaQuery(name=application, query=component)
+        return asyncio.run(QueryEvaluator2(query, dbi, dbi.metacontext)())
+
+    assert run("any") == {"o1", "o2", "o3"}
+    assert run("all") == {"o2"}
+
+
+def test_shared_cache():
+    manager = start_shared_cache()
+    try:
+        check_set_algebra(connect_shared_cache(manager.address))
+        other = connect_shared_cache(manager.address)
+        assert other.sinter("a", "b") == {"2", "3"}
+    finally:
+        manager.shutdown()
@@ -0,0 +1,58 @@
+__author__ = "samantha"
+
+from uop.core import change_log
+from uop.core.changeset import ChangeSet
+from uop.core.memory import db_collection as memory
+from uop.meta.schemas import meta
+
+window = 100.0
+
+
+def log_entry(timestamp, tag_name, tenant_id="t1", packed=True):
+    changes = ChangeSet()
+    changes.insert("tags", meta.MetaTag(name=tag_name).dict())
+    entry = change_log.log_entry(changes, tenant_id, timestamp, packed)
+    return dict(entry, id=f"c{timestamp}")
+
+
+def tag_names(entry):
+    changes = change_log.entry_changes(entry)
+    return {t["name"] for t in changes.tags.inserted.values()}
+
+
+def test_windows():
+    compactor = change_log.LogCompactor(window)
+    assert compactor.add(log_entry(10, "a")) == []
+    assert compactor.add(log_entry(20, "b", tenant_id="t2")) == []
+    assert compactor.add(log_entry(50, "c", packed=False)) == []
+    done = compactor.add(log_entry(150, "d"))
+    by_tenant = {c["tenant_id"]: c for c in done}
+    assert set(by_tenant) == {"t1", "t2"}
+    first = by_tenant["t1"]
+    assert (first["start"], first["end"], first["count"]) == (0, 100, 2)
+    assert first["id"] == change_log.checkpoint_id("t1", 0.0)
+    assert tag_names(first) == {"a", "c"}
+    [rest] = compactor.finish()
+    assert (rest["start"], rest["count"]) == (100, 1)
+    assert compactor.finish() == []
+
+
+def test_merge_and_replace():
+    compactor = change_log.LogCompactor(window, packed=False)
+    compactor.add(log_entry(10, "a"))
+    [earlier] = compactor.finish()
+    assert "packed" not in earlier
+    compactor.add(log_entry(60, "b"))
+    [later] = compactor.finish()
+    merged = change_log.merged(earlier, later)
+    assert merged["count"] == 2
+    assert tag_names(merged) == {"a", "b"}
+
+    log = memory.DBCollection(memory.Table("uop_changes"))
+    for ts in (10, 60, 120):
+        log.insert(**log_entry(ts, f"tag{ts}"))
+    log.insert(**log_entry(30, "other", tenant_id="t2"))
+    assert log.remove(compactor.window_criteria(merged)) == 2
+    assert sorted(log.find(only_cols=["timestamp"])) == [30, 120]
+    compactable = log.find(change_log.compactable_criteria(100), only_cols=["id"])
+    assert compactable == ["c30"]
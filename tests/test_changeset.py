@@ -7,6 +7,9 @@ from uop.core import changeset
 from uop.meta import attr_info
 from uop.meta.schemas.predefined import pkm_schema
 from uop.meta.schemas.meta import (
+    MetaContext,
+    MetaGroup,
+    MetaTag,
     WorkingContext,
     as_dict,
     Related,
@@ -350,3 +353,60 @@ def test_combination():
         check(data[3], cs_data.inserted, cs_data.deleted)
         check(data[1], cs_data.deleted, cs_data.inserted)
         check(data[4], cs_data.deleted, cs_data.inserted)
+
+
+def test_meta_delta():
+    context = MetaContext.from_schema(pkm_schema)
+    cs = changeset.ChangeSet()
+    cs.insert("objects", dict(id="x.y"))
+    cs.insert("related", Related(subject_id="a", assoc_id="b", object_id="c"))
+    assert not cs.has_meta_changes()
+    assert not cs.meta_delta().has_changes()
+
+    tag = MetaTag(name="alpha.beta").without_kind()
+    group = MetaGroup(name="some_group").without_kind()
+    cls_id = next(iter(context.classes.by_id))
+    cs.insert("tags", tag)
+    cs.insert("groups", group)
+    cs.modify("classes", cls_id, dict(description="changed"))
+    delta = cs.meta_delta()
+    cs.clear()  # the delta must survive the changeset being cleared
+    delta.apply_to(context)
+    assert context.tags.by_name["alpha.beta"].id == tag[id_field]
+    assert context.groups.by_id[group[id_field]].name == "some_group"
+    assert context.classes.by_id[cls_id].description == "changed"
+
+    cs.delete("tags", tag[id_field])
+    cs.meta_delta().apply_to(context)
+    assert "alpha.beta" not in context.tags.by_name
+
+
+def test_combine_cascades():
+    role = dataset.random_role()
+    objects = [i["id"] for i in dataset.instances[:4]]
+    edges = [
+        Related(subject_id=s, assoc_id=role.id, object_id=o)
+        for s, o in zip(objects, objects[1:])
+    ]
+    first = changeset.ChangeSet()
+    first.insert("related", edges[0])
+    first.insert("related", edges[1])
+    first.delete("objects", objects[0])
+    assert first.related.inserted == {edges[1]}
+    second = changeset.ChangeSet()
+    second.insert(
+        "related",
+        Related(subject_id=objects[3], assoc_id=role.id, object_id=objects[0]),
+    )
+    second.delete("related", edges[2])
+    second.delete("objects", objects[2])
+    combined = changeset.ChangeSet.combine_changes(first, second)
+    assert combined.related.inserted == set()
+    assert combined.related.deleted == set()
+    assert not combined.related._by_id and not combined.related._by_assoc
+
+    third = changeset.ChangeSet()
+    third.insert("related", edges[2])
+    third.delete("roles", role.id)
+    combined.add_changes(third)
+    assert not combined.related.has_changes()
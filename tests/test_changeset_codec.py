@@ -0,0 +1,86 @@
+__author__ = "samantha"
+
+import datetime
+import pytest
+from uop.core import change_log
+from uop.core import changeset_codec as codec
+from uop.core.changeset import ChangeSet
+from uop.meta.schemas.meta import MetaTag, Related
+from tests.test_changeset import full_changeset
+
+
+def comparable(changes: ChangeSet):
+    res = {}
+    for kind, data in changes.to_dict().items():
+        if kind == "related":
+            res[kind] = {k: sorted(map(repr, v)) for k, v in data.items()}
+        else:
+            res[kind] = dict(
+                inserted=dict(data["inserted"]),
+                modified=dict(data["modified"]),
+                deleted=sorted(data["deleted"]),
+            )
+    return res
+
+
+def test_round_trip():
+    changes = full_changeset()
+    packed = codec.encode(changes)
+    assert packed[:4] == codec.magic + bytes([codec.version])
+    assert comparable(codec.decode(packed)) == comparable(changes)
+    assert comparable(codec.decode(codec.encode(ChangeSet()))) == comparable(
+        ChangeSet()
+    )
+
+
+def test_interned_and_lazy():
+    changes = ChangeSet()
+    tag = MetaTag(name="alpha")
+    changes.insert("tags", tag.dict())
+    for i in range(50):
+        changes.insert(
+            "related", Related(subject_id=tag.id, assoc_id="r", object_id=f"o{i}")
+        )
+    packed = codec.PackedChangeSet(codec.encode(changes))
+    assert packed.changed_kinds() == ["tags", "related"]
+    assert packed._strings is None
+    assert len(packed.section("related")["inserted"]) == 50
+    assert packed.strings.count(tag.id) == 1
+    assert "objects" not in packed._decoded
+    assert packed.section("tags")["inserted"][tag.id]["name"] == "alpha"
+
+
+def test_rejects_unknown():
+    packed = codec.encode(ChangeSet())
+    with pytest.raises(ValueError):
+        codec.decode(b"XYZ" + packed[3:])
+    with pytest.raises(ValueError):
+        codec.decode(packed[:3] + bytes([codec.version + 1]) + packed[4:])
+
+
+def test_dates_and_bytes():
+    when = datetime.datetime(2024, 5, 1, 12, 30, tzinfo=datetime.timezone.utc)
+    record = dict(id="a_c1", when=when, day=when.date(), blob=b"\x00\xff", n=1)
+    changes = ChangeSet()
+    changes.insert("objects", record)
+    changes.insert("objects", dict(id="b_c1", plain={"$date": "x"}))
+    decoded = codec.decode(codec.encode(changes))
+    assert decoded.objects.inserted["a_c1"] == record
+    assert decoded.objects.inserted["b_c1"]["plain"] == {"$date": "x"}
+    changes.insert("objects", dict(id="c_c1", odd={1, 2}))
+    with pytest.raises(TypeError):
+        codec.encode(changes)
+    assert "changes" in change_log.stored_changes(changes)
+
+
+def test_added_without_decoding_unchanged():
+    changes = ChangeSet()
+    changes.insert("tags", MetaTag(name="beta").dict())
+    packed = codec.PackedChangeSet(codec.encode(changes))
+    combined = ChangeSet()
+    combined.add_changes(packed)
+    assert set(packed._decoded) == {"tags"}
+    assert comparable(combined) == comparable(changes)
+    assert comparable(ChangeSet.combine_all([ChangeSet(), packed])) == comparable(
+        changes
+    )
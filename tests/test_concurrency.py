@@ -0,0 +1,183 @@
+__author__ = "samantha"
+
+import asyncio
+import pytest
+import threading
+from uop.core.changeset import ChangeSet
+from uop.core.concurrency import (
+    apply_staged,
+    as_completed_bounded,
+    gather_bounded,
+    map_threaded,
+)
+from uop.core.memory import async_db_collection as async_memory
+from uop.core.memory import db_collection as memory
+from uop.core.query import a_set_or
+from uop.meta import oid
+
+
+def test_gather_bounded():
+    running = []
+    peak = []
+
+    async def work(i):
+        running.append(i)
+        peak.append(len(running))
+        await asyncio.sleep(0.001 * (5 - i % 5))
+        running.remove(i)
+        return i * i
+
+    results = asyncio.run(gather_bounded(3, (work(i) for i in range(10))))
+    assert results == [i * i for i in range(10)]
+    assert max(peak) == 3
+    assert asyncio.run(gather_bounded(3, [])) == []
+    peak.clear()
+    asyncio.run(gather_bounded(None, [work(i) for i in range(6)]))
+    assert max(peak) == 6
+
+
+def test_as_completed_bounded():
+    async def work(i, delay):
+        await asyncio.sleep(delay)
+        return i
+
+    async def collect(awaitables, **kwargs):
+        return [r async for r in as_completed_bounded(awaitables, **kwargs)]
+
+    delays = [0.03, 0.01, 0.02]
+    assert asyncio.run(collect(work(i, d) for i, d in enumerate(delays))) == [1, 2, 0]
+    limited = asyncio.run(collect((work(i, d) for i, d in enumerate(delays)), limit=1))
+    assert limited == [0, 1, 2]
+
+    async def slow_union():
+        return await a_set_or(
+            lambda d: work({d}, d), [0.001, 1.0], limit=2, timeout=0.05
+        )
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(slow_union())
+    union = asyncio.run(a_set_or(lambda i: {i, i + 1} if i else work({0}, 0), range(3)))
+    assert union == {0, 1, 2, 3}
+
+
+def test_map_threaded():
+    threads = set()
+
+    def work(i):
+        threads.add(threading.get_ident())
+        return i * i
+
+    assert map_threaded(work, range(20), 4) == [i * i for i in range(20)]
+    assert 1 <= len(threads) <= 4
+    threads.clear()
+    assert map_threaded(work, [3], 4) == [9]
+    assert threads == {threading.get_ident()}
+    assert map_threaded(work, [], None) == []
+
+
+class SlowCollection(async_memory.DBCollection):
+    """Async memory collection whose writes yield first, so staged writes interleave"""
+
+    def __init__(self, name, delay):
+        super().__init__(memory.Table(name))
+        self.delay = delay
+
+    async def insert_many(self, records):
+        await asyncio.sleep(self.delay)
+        return await super().insert_many(records)
+
+    async def update_many(self, modified):
+        await asyncio.sleep(self.delay)
+        return await super().update_many(modified)
+
+    async def remove_many(self, ids):
+        await asyncio.sleep(self.delay)
+        return await super().remove_many(ids)
+
+
+kinds = ["objects", "classes", "roles", "tags", "groups", "attributes", "queries"]
+
+
+def staged_state(concurrent):
+    """What two changesets leave in memory collections, written in one mode"""
+    colls = {k: SlowCollection(k, 0.001 * i) for i, k in enumerate(kinds)}
+    extensions = {c: SlowCollection(c, d) for c, d in (("C1", 0.003), ("C2", 0))}
+    related = async_memory.DBCollection(memory.Table("related"))
+    people = [f"p{i}_C1" for i in range(4)]
+    phones = [f"f{i}_C2" for i in range(2)]
+
+    async def by_collection(object_ids):
+        by_class = {}
+        for an_id in object_ids:
+            by_class.setdefault(oid.oid_class(an_id), []).append(an_id)
+        return [(extensions[c], ids) for c, ids in by_class.items()]
+
+    async def cascade(kind, an_id):
+        await asyncio.sleep(0)
+        await related.remove({"$or": [{"subject_id": an_id}, {"object_id": an_id}]})
+
+    async def sequential(changeset):
+        for kind in kinds:
+            changes = getattr(changeset, kind)
+            if kind == "objects":
+                for coll, ids in await by_collection(list(changes.inserted)):
+                    await coll.insert_many([changes.inserted[k] for k in ids])
+                for coll, ids in await by_collection(list(changes.modified)):
+                    await coll.update_many({k: changes.modified[k] for k in ids})
+                for coll, ids in await by_collection(list(changes.deleted)):
+                    await coll.remove_many(ids)
+            else:
+                coll = colls[kind]
+                if changes.inserted:
+                    await coll.insert_many(list(changes.inserted.values()))
+                if changes.modified:
+                    await coll.update_many(changes.modified)
+                if changes.deleted:
+                    await coll.remove_many(list(changes.deleted))
+            for an_id in changes.deleted:
+                await cascade(kind, an_id)
+
+    async def apply(changeset):
+        if concurrent:
+            await apply_staged(changeset, kinds, colls.get, by_collection, cascade, 3)
+        else:
+            await sequential(changeset)
+
+    async def run():
+        first = ChangeSet()
+        for name in ("friend", "work"):
+            first.insert("tags", dict(id=f"{name}_T", name=name))
+        for an_id in people + phones:
+            first.insert("objects", dict(id=an_id, name=an_id[:2]))
+            await related.insert(subject_id="friend_T", assoc_id="r", object_id=an_id)
+        await related.insert(subject_id="work_T", assoc_id="r", object_id=people[0])
+        await apply(first)
+
+        second = ChangeSet()
+        second.insert("objects", dict(id="p9_C1", name="new"))
+        second.modify("objects", people[0], dict(name="renamed"))
+        second.modify("objects", phones[0], dict(name="redialed"))
+        second.modify("tags", "friend_T", dict(name="pal"))
+        second.delete("objects", people[1])
+        second.delete("objects", phones[1])
+        second.delete("tags", "work_T")
+        await apply(second)
+
+        state = {k: await c.find() for k, c in {**colls, **extensions}.items()}
+        edges = await related.find()
+        state["related"] = {(r["subject_id"], r["object_id"]) for r in edges}
+        return {
+            k: sorted(v, key=repr) if isinstance(v, list) else v
+            for k, v in state.items()
+        }
+
+    return asyncio.run(run())
+
+
+def test_apply_staged_matches_sequential():
+    staged, sequential = staged_state(True), staged_state(False)
+    assert staged == sequential
+    assert len(staged["C1"]) == 4 and len(staged["C2"]) == 1
+    assert {r["name"] for r in staged["C1"]} >= {"renamed", "new"}
+    assert [t["name"] for t in staged["tags"]] == ["pal"]
+    assert len(staged["related"]) == 4  # edges of deleted items cascaded
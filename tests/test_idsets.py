@@ -0,0 +1,112 @@
+__author__ = "samantha"
+
+import asyncio
+import random
+from uop.core import adjacency
+from uop.core.adjacency import AdjacencyIndex
+from uop.core.idsets import Bitmap, IdMap, IdSet
+from uop.core.query import NegatableSet, QueryEvaluator2
+from uop.meta.schemas import meta
+from uop.meta.schemas.predefined import pkm_schema
+
+
+def random_ints(n, top):
+    return {random.randrange(top) for _ in range(n)}
+
+
+def test_bitmap_algebra():
+    random.seed(7)
+    # sparse, dense and mixed chunks
+    cases = [(50, 200000), (9000, 20000), (3000, 70000)]
+    for n, top in cases:
+        a, b = random_ints(n, top), random_ints(n, top)
+        ba, bb = Bitmap(a), Bitmap(b)
+        assert list(ba) == sorted(a) and len(ba) == len(a)
+        assert list(ba & bb) == sorted(a & b)
+        assert list(ba | bb) == sorted(a | b)
+        assert list(ba - bb) == sorted(a - b)
+        probe = next(iter(a))
+        assert probe in ba and top + 1 not in ba
+
+
+def test_idset_negation():
+    ids = IdMap()
+    a = IdSet.of(ids, ["x", "y", "z"])
+    b = IdSet.of(ids, ["y"], negated=True)
+    assert a & b == {"x", "z"}
+    everything = b | a
+    assert everything.negated and not everything
+    assert a - {"x"} == {"y", "z"}
+    assert {"z", "w"} & a == {"z"}
+    assert NegatableSet({"x", "q"}) & a == {"x"}
+    assert set() | a == {"x", "y", "z"}
+
+
+def test_idset_maps_kept_small():
+    ids = IdMap()
+    a = IdSet.of(ids, ["x", "y"])
+    assert a & {"y", "q"} == {"y"} and a - {"r"} == {"x", "y"}
+    assert len(ids) == 2
+    other = IdSet.of(IdMap(), ["y", "z"])
+    assert a & other == {"y"} and a | other == {"x", "y", "z"}
+    assert a != IdSet.of(IdMap(), ["y"]) and a == IdSet.of(IdMap(), ["y", "x"])
+
+
+def test_adjacency_renumbers_dead_ids(monkeypatch):
+    monkeypatch.setattr(adjacency, "renumber_floor", 4)
+    index = AdjacencyIndex()
+    index.load(
+        [dict(subject_id="t", assoc_id="r", object_id=f"o{i}") for i in range(10)]
+    )
+    before = IdSet(index.id_map, index.roleset_bits("t", "r"))
+    for i in range(8):
+        index.remove_node(f"o{i}")
+    assert IdSet(index.id_map, index.roleset_bits("t", "r")) == {"o8", "o9"}
+    assert len(index.id_map) == 2
+    assert before == {f"o{i}" for i in range(10)}
+    assert before & IdSet(index.id_map, index.roleset_bits("t", "r")) == {"o8", "o9"}
+
+
+class BitsDB:
+    """Database interface side of tag queries answered as id bitmaps"""
+
+    def __init__(self, context, edges):
+        self.metacontext = context
+        self.adjacency = AdjacencyIndex()
+        self.adjacency.load(edges)
+
+    def role_id(self, name):
+        return self.metacontext.roles.by_name[name].id
+
+    def get_tagset_bits(self, tag_id):
+        bits = self.adjacency.roleset_bits(tag_id, self.role_id("tag_applies"))
+        return IdSet(self.adjacency.id_map, bits)
+
+
+def test_tag_query_in_bitmap_space():
+    context = meta.MetaContext.from_schema(pkm_schema)
+    for name in ("a", "b"):
+        context.tags.add_item(meta.MetaTag(name=name))
+    role = context.roles.by_name["tag_applies"].id
+    tag = lambda name: context.tags.by_name[name].id
+    edges = [
+        dict(subject_id=tag("a"), assoc_id=role, object_id=f"o{i}") for i in range(6)
+    ]
+    edges += [
+        dict(subject_id=tag("b"), assoc_id=role, object_id=f"o{i}") for i in (4, 5, 9)
+    ]
+    dbi = BitsDB(context, edges)
+
+    def run(application, names):
+        query = meta.TagsComponent(names=names, application=application)
+        return asyncio.run(
+            QueryEvaluator2(meta.MetaQuery(name="q", query=query), dbi)()
+        )
+
+    assert run("all", ["a", "b"]) == {"o4", "o5"}
+    assert type(run("all", ["a", "b"])) is set
+    assert run("any", ["a", "b"]) == {f"o{i}" for i in (0, 1, 2, 3, 4, 5, 9)}
+    none = run("none", ["b"])
+    assert (
+        isinstance(none, NegatableSet) and none._negated and none == {"o4", "o5", "o9"}
+    )
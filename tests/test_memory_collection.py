@@ -0,0 +1,217 @@
+__author__ = "samantha"
+
+import asyncio
+from uop.core import db_collection as base
+from uop.core.memory import async_db_collection as async_memory
+from uop.core.memory import db_collection as memory
+from uop.core.query import Q
+from uop.meta.schemas import meta
+
+
+def related_collection():
+    return memory.DBCollection(memory.Table("uop_related", meta.Related))
+
+
+def related(subject, role, object):
+    return meta.Related(subject_id=subject, assoc_id=role, object_id=object)
+
+
+def test_related_indices():
+    coll = related_collection()
+    assert ("assoc_id", "subject_id") in coll.table.indices
+    assert ("assoc_id", "object_id") in coll.table.indices
+    for i in range(6):
+        coll.insert(**related(f"s{i % 2}", "r", f"o{i}").without_kind())
+    criteria = dict(subject_id="s0", assoc_id="r")
+    assert len(coll.table.candidates(criteria)) == 3
+    assert set(coll.find(criteria, only_cols=["object_id"])) == {"o0", "o2", "o4"}
+    assert coll.distinct("subject_id", dict(object_id="o3")) == {"s1"}
+
+
+def test_related_remove():
+    coll = related_collection()
+    for i in range(4):
+        coll.insert(**related("s", "r", f"o{i}_c{i % 2}").without_kind())
+    assert coll.remove(related("s", "r", "o0_c0").without_kind()) == 1
+    by_class = {"$or": [{"$endswith": {"object_id": "c1"}}, {"subject_id": "c1"}]}
+    assert coll.remove(by_class) == 2
+    assert coll.find(ids_only=False, only_cols=["object_id"]) == ["o2_c0"]
+    assert coll.table.candidates(dict(assoc_id="r")) == set(coll.table.records)
+
+
+def test_find_criteria_forms():
+    coll = memory.DBCollection(memory.Table("things"))
+    coll.insert(id="a", n=3, name="apple")
+    coll.insert(id="b", n=1, name="banana")
+    coll.insert(id="c", name="cherry")
+    ids = lambda criteria, **kw: coll.find(criteria, ids_only=True, **kw)
+    assert ids(Q.gt("n", 2)) == ["a"]
+    assert ids({"n": {"$lte": 1}}) == ["b"]
+    assert ids(Q.all(Q.gte("n", 0), Q.neq("device_id", 0)), order_by=["n"]) == [
+        "b",
+        "a",
+    ]
+    assert ids(Q.any(Q.eq("name", "cherry"), Q.eq("n", 1)), order_by=["-name"]) == [
+        "c",
+        "b",
+    ]
+    assert ids({"name": {"like": "an*a"}}) == ["b"]
+    assert ids(None, order_by=["n"], limit=2) == ["c", "b"]
+    assert coll.count({"n": {"$gt": 0}}) == 2
+
+
+def test_modifications():
+    coll = memory.DBCollection(memory.Table("things"))
+    coll.insert(id="a", n=3)
+    coll.insert(id="b", n=1)
+    assert coll.update_one("a", dict(n=5))
+    assert coll.get("a") == dict(id="a", n=5)
+    assert not coll.update_one("x", dict(n=5))
+    assert coll.update(Q.lt("n", 10), dict(m=1)) == 2
+    coll.replace_one("b", dict(k=2))
+    assert coll.get("b") == dict(id="b", k=2)
+    assert [r["id"] for r in coll.bulk_load(["b", "x", "a"])] == ["b", "a"]
+    returned = coll.get("a")
+    returned["n"] = 99
+    assert coll.get("a")["n"] == 5
+    assert coll.remove("a") == 1
+    assert not coll.contains_id("a")
+
+
+def test_bulk_operations():
+    coll = related_collection()
+    rows = [related("s", "r", f"o{i}").without_kind() for i in range(5)]
+    coll.insert_many(rows)
+    assert coll.count() == 5
+    coll.remove_many(rows[:3])
+    assert set(coll.find(only_cols=["object_id"])) == {"o3", "o4"}
+
+    things = memory.DBCollection(memory.Table("things"))
+    things.insert_many([dict(id="a", n=1), dict(id="b", n=2)])
+    things.update_many({"a": dict(n=10), "b": dict(m=3)})
+    assert things.get("a")["n"] == 10 and things.get("b")["m"] == 3
+    things.remove_many(["a", "b"])
+    assert not things.count()
+
+
+def test_bulk_load_projection():
+    things = memory.DBCollection(memory.Table("things"))
+    things.insert_many([dict(id=f"t{i}", n=i, name=f"n{i}") for i in range(4)])
+    assert things.bulk_load(["t2", "missing", "t0"], only_cols=["n"]) == [
+        dict(id="t2", n=2),
+        dict(id="t0", n=0),
+    ]
+    generic = lambda *args: base.DBCollection.bulk_load(things, *args)
+    assert sorted(r["id"] for r in generic(["t1", "t3", "x"])) == ["t1", "t3"]
+    assert generic(["t1"], ["name"]) == [dict(id="t1", name="n1")]
+    assert generic(["t1"], ["id"]) == [dict(id="t1")]
+    assert set(base.DBCollection.get_all(things)) == {"t0", "t1", "t2", "t3"}
+
+
+def test_get_projection():
+    things = memory.DBCollection(memory.Table("things"))
+    things.insert(id="t1", n=1, name="n1")
+    assert things.get("t1", only_cols=["name"]) == dict(id="t1", name="n1")
+    assert things.get("t2", only_cols=["name"]) is None
+    generic = lambda *args: base.DBCollection.get(things, *args)
+    assert generic("t1", ["n"]) == dict(id="t1", n=1)
+    assert generic("t1", ["id"]) == dict(id="t1")
+    assert generic("t1")["name"] == "n1"
+    cols = ["id"]
+    ids = base.bulk.as_records(things.iter_find(only_cols=cols), cols)
+    assert list(ids) == [dict(id="t1")]
+    stream = async_memory.DBCollection(things.table)
+    assert asyncio.run(stream.get("t1", ["n"])) == dict(id="t1", n=1)
+
+
+class PagedCollection(memory.DBCollection):
+    """Memory collection streamed through the generic keyset paging"""
+
+    def __init__(self, table):
+        super().__init__(table)
+        self.pages = 0
+
+    def find(self, *args, **kwargs):
+        self.pages += 1
+        return super().find(*args, **kwargs)
+
+    iter_find = base.DBCollection.iter_find
+
+
+def test_iter_find_pages():
+    coll = PagedCollection(memory.Table("paged"))
+    coll.insert_many([dict(id=f"r{i:02}", n=i % 4, name=f"n{i}") for i in range(25)])
+    assert [r["id"] for r in coll.iter_find(batch_size=10)] == [
+        f"r{i:02}" for i in range(25)
+    ]
+    assert coll.pages == 3
+    by_n = list(
+        coll.iter_find({"$lt": {"n": 2}}, only_cols=["n"], order_by=["n"], batch_size=3)
+    )
+    assert by_n == sorted(i % 4 for i in range(25) if i % 4 < 2)
+    names = list(coll.iter_find(only_cols=["name", "n"], batch_size=7))
+    assert names[0] == {"name": "n0", "n": 0} and len(names) == 25
+    assert isinstance(coll.instances(), list)
+
+
+def test_iter_find_missing_order_values():
+    coll = PagedCollection(memory.Table("sparse"))
+    coll.insert_many([dict(id=f"r{i}") for i in range(5)])
+    coll.insert_many([dict(id=f"s{i}", n=i) for i in range(3)])
+    found = [r["id"] for r in coll.iter_find(order_by=["n"], batch_size=2)]
+    assert found == [r["id"] for r in coll.find(order_by=["n", "id"])]
+    assert len(found) == 8 and coll.pages == 3
+
+
+def test_iter_find_unkeyed():
+    coll = PagedCollection(memory.Table("edges"))
+    coll.keyed = False
+    coll.insert_many([dict(subject_id=f"s{i}", object_id="o") for i in range(5)])
+    found = list(coll.iter_find(batch_size=2))
+    assert sorted(r["subject_id"] for r in found) == [f"s{i}" for i in range(5)]
+    assert coll.pages == 1
+    colls = base.DatabaseCollections(RoutingDb())
+    colls.ensure_collections(dict(related="uop_related", classes="uop_classes"))
+    assert not colls.related.keyed and colls.classes.keyed
+
+
+def test_async_iter_find():
+    coll = async_memory.DBCollection(memory.Table("stream"))
+    asyncio.run(coll.insert_many([dict(id=f"r{i}") for i in range(5)]))
+
+    async def collect():
+        return [r["id"] async for r in coll.iter_find()]
+
+    assert sorted(asyncio.run(collect())) == [f"r{i}" for i in range(5)]
+
+
+class RoutingDb:
+    def __init__(self):
+        self.tables = {}
+        self.opened = []
+
+    def get_managed_collection(self, name, schema=None):
+        self.opened.append(name)
+        table = self.tables.setdefault(name, memory.Table(name))
+        return memory.DBCollection(table)
+
+
+def test_extension_routing():
+    db = RoutingDb()
+    colls = base.DatabaseCollections(db)
+    colls.extension_cache_size = 2
+    classes = [{"id": f"c{i}", base.cls_extension_field: f"ext{i}"} for i in range(3)]
+    first = colls.get_class_extension(classes[0])
+    assert colls.get_class_extension(classes[0]) is first
+    assert colls.routed_extension("c1") is None
+    colls.get_class_extension(classes[1])
+    colls.routed_extension("c0")
+    colls.get_class_extension(classes[2])
+    assert colls.routed_extension("c1") is None  # least recently used
+    assert colls.routed_extension("c0") is first
+    colls.forget_extensions(["c0"])
+    assert colls.routed_extension("c0") is None
+    assert colls.routed_extension("c2") is not None
+    colls.forget_extensions()
+    assert colls.routed_extension("c2") is None
+    assert db.opened == ["ext0", "ext1", "ext2"]
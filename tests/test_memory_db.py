@@ -0,0 +1,115 @@
+__author__ = "samantha"
+
+import asyncio
+import pytest
+from uop.core.changeset import ChangeSet
+from uop.core.db_interface import Interface
+from uop.core.memory import async_database as async_memory_db
+from uop.core.memory import database as memory_db
+from uop.core.object_cache import ObjectCache
+from uop.core.plugin_testing.harness import Plugin, test_general_db
+from uop.meta.schemas import meta
+from uop.meta.schemas.meta import Related
+from uop.meta.schemas.predefined import pkm_schema
+
+
+@pytest.fixture
+def db_plugin():
+    db = memory_db.Database.make_test_database()
+    db.open_db()
+    db.ensure_schema_installed(pkm_schema)
+    yield db
+    db.drop_database()
+
+
+@pytest.fixture
+def db_harness(db_plugin):
+    harness = Plugin(db_plugin)
+    harness.setup_random_data()
+    return harness
+
+
+def test_registered_adaptor():
+    from uop.core.db_service import DatabaseClass
+
+    memory_db.register()
+    assert DatabaseClass.get_db_class(memory_db.db_type, False) is memory_db.Database
+
+
+def test_shared_by_name(db_plugin):
+    other = memory_db.Database(db_plugin._dbname)
+    other.open_db()
+    assert set(other.metacontext.classes.by_name) == set(
+        db_plugin.metacontext.classes.by_name
+    )
+
+
+def test_interface_caches_misses(db_plugin):
+    dbi = Interface(db_plugin, cache=ObjectCache())
+    extension = dbi.extension
+    reads = []
+
+    def counted(cls_id):
+        reads.append(cls_id)
+        return extension(cls_id)
+
+    dbi.extension = counted
+    missing = f"nope_{db_plugin.metacontext.classes.by_name['Person'].id}"
+    assert dbi.get_object(missing) is None
+    assert len(reads) == 1
+    assert dbi.get_object(missing) is None
+    assert dbi.bulk_load([missing]) == [None]
+    assert len(reads) == 1
+
+
+def applied_state(concurrent):
+    """What two changesets leave in an async memory database, applied in one mode"""
+
+    async def run():
+        db = async_memory_db.Database.make_test_database()
+        db.concurrent_apply = concurrent
+        await db.open_db()
+        await db.ensure_schema_installed(pkm_schema)
+        classes = db.metacontext.classes.by_name
+        role = db.metacontext.roles.by_name["tag_applies"].id
+        tag = meta.MetaTag(name="friend")
+        people = [f"p{i}_{classes['Person'].id}" for i in range(4)]
+        phones = [f"f{i}_{classes['Phone'].id}" for i in range(2)]
+
+        def tagging(an_id):
+            return Related(subject_id=tag.id, assoc_id=role, object_id=an_id)
+
+        first = ChangeSet()
+        first.insert("tags", tag.dict())
+        for an_id in people + phones:
+            first.insert("objects", dict(id=an_id, name=an_id[:2]))
+            first.insert("related", tagging(an_id))
+        await db.apply_changes(first)
+
+        second = ChangeSet()
+        second.insert("objects", dict(id=f"p9_{classes['Person'].id}", name="new"))
+        second.modify("objects", people[0], dict(name="renamed"))
+        second.modify("objects", phones[0], dict(name="redialed"))
+        second.delete("objects", people[1])
+        second.delete("objects", phones[1])
+        await db.apply_changes(second)
+
+        state = {}
+        for name in ("Person", "Phone"):
+            coll = await db.class_collection(name)
+            state[name] = {r["id"]: r for r in await coll.find()}
+        related = await db.collections.related.find()
+        state["related"] = {(r["subject_id"], r["object_id"]) for r in related}
+        state["tags"] = set(db.metacontext.tags.by_name)
+        await db.drop_database()
+        return state
+
+    return asyncio.run(run())
+
+
+def test_concurrent_apply_matches_sequential():
+    concurrent, sequential = applied_state(True), applied_state(False)
+    assert concurrent == sequential
+    assert len(concurrent["Person"]) == 4 and len(concurrent["Phone"]) == 1
+    assert {r["name"] for r in concurrent["Person"].values()} >= {"renamed", "new"}
+    assert len(concurrent["related"]) == 4  # edges of deleted objects cascaded
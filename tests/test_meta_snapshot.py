@@ -0,0 +1,18 @@
+__author__ = "samantha"
+
+from uop.core import meta_snapshot
+from uop.meta.schemas.meta import MetaContext
+from uop.meta.schemas.predefined import pkm_schema
+
+
+def test_round_trip():
+    context = MetaContext.from_schema(pkm_schema)
+    record = meta_snapshot.snapshot_record(context, "g1", {"pkm", "core"})
+    assert record["id"] == meta_snapshot.snapshot_id
+    assert record["schemas"] == ["core", "pkm"]
+    loaded = meta_snapshot.decode_context(record["context"])
+    for kind in ("classes", "attributes", "roles", "tags", "groups"):
+        assert set(getattr(loaded, kind).by_id) == set(getattr(context, kind).by_id)
+    root = context.classes.by_name["PersistentObject"].id
+    assert loaded.subclasses(root) == context.subclasses(root)
+    assert meta_snapshot.new_generation() != meta_snapshot.new_generation()
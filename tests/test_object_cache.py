@@ -0,0 +1,74 @@
+__author__ = "samantha"
+
+from uop.core.changeset import ChangeSet
+from uop.core.object_cache import ObjectCache, absent
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def record(an_id, **fields):
+    return dict(id=an_id, **fields)
+
+
+def test_lru_and_copies():
+    cache = ObjectCache(max_entries=2)
+    assert cache and cache.get("a_c1") is None
+    cache.set("a_c1", record("a_c1", name="a"))
+    cache.set("b_c1", record("b_c1"))
+    cache.get("a_c1")["name"] = "changed"
+    assert cache.get("a_c1")["name"] == "a"
+    cache.set("c_c1", record("c_c1"))
+    assert cache.get("b_c1") is None
+    assert cache.get("a_c1") is not None
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"]) == (2, 1)
+    assert (stats["hits"], stats["misses"]) == (3, 2)
+
+
+def test_byte_bound():
+    cache = ObjectCache(max_bytes=2000)
+    for i in range(20):
+        cache.set(f"{i}_c1", record(f"{i}_c1", text="x" * 100))
+    assert 0 < len(cache) < 20
+    assert cache.bytes <= 2000
+    cache.set("big_c1", record("big_c1", text="x" * 5000))
+    assert cache.get("big_c1") is None
+
+
+def test_negative_lookups_and_ttl():
+    clock = Clock()
+    cache = ObjectCache(ttl=10, negative_ttl=1, clock=clock)
+    cache.set("a_c1", record("a_c1"))
+    cache.set("gone_c1", None)
+    assert cache.lookup("gone_c1") is absent
+    assert cache.get("gone_c1") is None
+    assert cache.stats()["negative_hits"] == 2
+    clock.now = 5
+    assert cache.lookup("gone_c1") is None
+    assert cache.get("a_c1") is not None
+    clock.now = 11
+    assert cache.get("a_c1") is None
+    assert cache.stats()["expirations"] == 2
+
+
+def test_changeset_invalidation():
+    cache = ObjectCache()
+    for an_id in ("a_c1", "b_c1", "c_c1", "d_c2", "e_c3"):
+        cache.set(an_id, record(an_id))
+    cache.set("new_c3", None)
+    changes = ChangeSet()
+    changes.modify("objects", "a_c1", dict(name="x"))
+    changes.objects.deleted.add("d_c2")
+    changes.insert("objects", record("new_c3"))
+    changes.modify("classes", "c1", dict(description="changed"))
+    cache.apply_changes(changes)
+    assert [k for k in ("a_c1", "b_c1", "c_c1", "d_c2", "new_c3") if cache.get(k)] == []
+    assert cache.lookup("new_c3") is None
+    assert cache.get("e_c3") is not None
+    assert cache.stats()["invalidations"] == 5
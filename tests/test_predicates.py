@@ -0,0 +1,80 @@
+__author__ = "samantha"
+
+from uop.core import predicates
+from uop.core.memory import db_collection as memory
+from uop.core.query import Q
+
+records = [
+    dict(id="a", n=3, name="apple"),
+    dict(id="b", n=1, name="banana"),
+    dict(id="c", name="cherry"),
+    dict(id="d", n="x", name=7),
+]
+
+
+def ids(query):
+    return [r["id"] for r in Q.filter_many(query, records)]
+
+
+def test_operator_forms():
+    assert ids(Q.gt("n", 2)) == ["a"]
+    assert ids(Q.eq("n", 1)) == ["b"]
+    assert ids(Q.neq("n", 1)) == ["a", "c", "d"]
+    assert ids({"n": {"$lte": 1}}) == ["b"]
+    assert ids({"n": {">=": 1, "<": 3}}) == ["b"]
+    assert ids({"name": "cherry"}) == ["c"]
+    assert ids({"id": {"$in": ["a", "c", "z"]}}) == ["a", "c"]
+    assert ids({"n": {"$exists": False}}) == ["c"]
+
+
+def test_string_operators_skip_other_types():
+    assert ids({"name": {"like": "an*a"}}) == ["b"]
+    assert ids({"name": {"$regex": "^ch"}}) == ["c"]
+    assert ids({"name": {"endswith": "e"}}) == ["a"]
+    assert ids({"name": {"not_like": "an*a"}}) == ["a", "c", "d"]
+
+
+def test_membership_over_list_values():
+    tagged = [dict(id="a", tags=["x"]), dict(id="b", tags="x"), dict(id="c")]
+    match = lambda criteria: [r["id"] for r in predicates.filter_many(criteria, tagged)]
+    assert match({"$in": {"tags": ["x", "y"]}}) == ["b"]
+    assert match({"$nin": {"tags": ["x"]}}) == ["a", "c"]
+    assert match({"$in": {"tags": [["x"]]}}) == ["a"]
+    assert match({"tags": "x"}) == ["b"]
+
+
+def test_compound():
+    assert ids(Q.all(Q.gte("n", 1), Q.lt("n", 3))) == ["b"]
+    assert ids(Q.any(Q.eq("name", "cherry"), Q.gt("n", 2))) == ["a", "c"]
+    assert ids({"$not": Q.eq("id", "a")}) == ["b", "c", "d"]
+    assert ids(None) == ["a", "b", "c", "d"]
+    test = Q.query_function(Q.all(Q.gt("n", 0), Q.eq("name", "apple")))
+    assert test(records[0]) and not test(records[1]) and not test(records[3])
+
+
+def test_compiled_once_per_canonical_query():
+    first = Q.query_function({"n": 1, "name": "b"})
+    assert Q.query_function({"name": "b", "n": 1}) is first
+    assert Q.query_function({"n": 2, "name": "b"}) is not first
+    assert "lambda" not in first.source
+
+
+def test_rejects_non_record_operators():
+    try:
+        Q.query_function(Q.tagged("foo"))
+    except ValueError:
+        return
+    assert False, "tag queries are not record criteria"
+
+
+def test_bare_operator_names_are_fields_at_top_level():
+    fields = [dict(id="a", like=5, name="x"), dict(id="b", like=6, name="y")]
+    match = lambda criteria: [r["id"] for r in predicates.filter_many(criteria, fields)]
+    assert match({"like": 5}) == ["a"]
+    assert match({"like": {"in": [6, 7]}}) == ["b"]
+    assert match({">": {"like": 5}}) == ["b"]
+    assert match({"$like": {"name": "x*"}}) == ["a"]
+    assert memory.equality_terms({"in": 5, "name": {"$in": ["x"]}}) == {
+        "in": (5,),
+        "name": ("x",),
+    }
@@ -1,4 +1,8 @@
+import asyncio
+from uop.core.adjacency import AdjacencyIndex
+from uop.core.query import ComponentEvaluator, QueryEvaluator2
 from uop.meta.schemas import meta
+from uop.meta.schemas.predefined import pkm_schema
 
 
 def check_persist(qc):
@@ -28,3 +32,79 @@ def test_persist():
     or_m = meta.OrQuery(components=[tags, cls, and2, or1])
     check_persist(and_m)
     check_persist(or_m)
+
+
+class AdjacencyDB:
+    """Just enough of a database interface to run association queries over edges"""
+
+    def __init__(self, context, edges):
+        self.metacontext = context
+        self.adjacency = AdjacencyIndex()
+        self.adjacency.load(edges)
+        self.full_reads = []
+
+    def role_id(self, name):
+        return self.metacontext.roles.by_name[name].id
+
+    def get_roleset_size(self, subject, role_id, reverse=False):
+        return self.adjacency.roleset_size(subject, role_id, reverse)
+
+    def get_roleset(self, subject, role_id, reverse=False):
+        self.full_reads.append(subject)
+        return self.adjacency.roleset(subject, role_id, reverse)
+
+    def get_rolesets(self, subject_ids, role_id, reverse=False):
+        return self.adjacency.rolesets(subject_ids, role_id, reverse)
+
+    def get_tagset(self, tag_id):
+        self.full_reads.append(tag_id)
+        return self.adjacency.roleset(tag_id, self.role_id("tag_applies"))
+
+
+def test_and_runs_most_selective_first():
+    context = meta.MetaContext.from_schema(pkm_schema)
+    huge, small = meta.MetaTag(name="huge"), meta.MetaTag(name="small")
+    context.tags.add_item(huge)
+    context.tags.add_item(small)
+    tag_role = context.roles.by_name["tag_applies"].id
+    edges = [
+        dict(subject_id=huge.id, assoc_id=tag_role, object_id=f"o{i}")
+        for i in range(50)
+    ]
+    edges += [
+        dict(subject_id=small.id, assoc_id=tag_role, object_id=f"o{i}")
+        for i in (1, 2, 99)
+    ]
+    dbi = AdjacencyDB(context, edges)
+    query = meta.AndQuery(
+        components=[
+            meta.TagsComponent(names=["huge"], application="all"),
+            meta.TagsComponent(names=["small"], application="any"),
+        ]
+    )
+    evaluator = ComponentEvaluator(
+        query, in_context=QueryEvaluator2(meta.MetaQuery(name="q", query=query), dbi)
+    )
+    assert asyncio.run(evaluator.estimate(query)) == 3
+    assert asyncio.run(evaluator()) == {"o1", "o2"}
+    assert dbi.full_reads == [small.id]
+
+
+class UnsizedDB(AdjacencyDB):
+    get_roleset_size = None
+
+
+def test_estimate_without_sizer_loads_nothing():
+    context = meta.MetaContext.from_schema(pkm_schema)
+    tag = meta.MetaTag(name="huge")
+    context.tags.add_item(tag)
+    tag_role = context.roles.by_name["tag_applies"].id
+    dbi = UnsizedDB(
+        context, [dict(subject_id=tag.id, assoc_id=tag_role, object_id="o1")]
+    )
+    query = meta.TagsComponent(names=["huge"], application="all")
+    evaluator = ComponentEvaluator(
+        query, in_context=QueryEvaluator2(meta.MetaQuery(name="q", query=query), dbi)
+    )
+    assert asyncio.run(evaluator.estimate(query)) == float("inf")
+    assert dbi.full_reads == []
@@ -0,0 +1,140 @@
+__author__ = "samantha"
+
+import asyncio
+from uop.core.adjacency import AdjacencyIndex
+from uop.core.changeset import ChangeSet
+from uop.core.query_cache import (
+    QueryCache,
+    changed_ids,
+    query_dependencies,
+    query_key,
+)
+from uop.meta.schemas import meta
+from uop.meta.schemas.predefined import pkm_schema
+
+
+class TagDB:
+    """Just enough of a database interface to run tag queries"""
+
+    def __init__(self, context, edges):
+        self.metacontext = context
+        self.adjacency = AdjacencyIndex()
+        self.adjacency.load(edges)
+        self.reads = 0
+
+    def role_id(self, name):
+        return self.metacontext.roles.by_name[name].id
+
+    def get_tagset(self, tag_id):
+        self.reads += 1
+        return self.adjacency.roleset(tag_id, self.role_id("tag_applies"))
+
+    def get_roleset(self, subject, role_id):
+        return self.adjacency.roleset(subject, role_id)
+
+
+def tagged_db():
+    context = meta.MetaContext.from_schema(pkm_schema)
+    for name in ("red", "blue"):
+        context.tags.add_item(meta.MetaTag(name=name))
+    by_name = context.tags.by_name
+    role = context.roles.by_name["tag_applies"].id
+    edges = [
+        dict(subject_id=by_name["red"].id, assoc_id=role, object_id="o1"),
+        dict(subject_id=by_name["blue"].id, assoc_id=role, object_id="o2"),
+    ]
+    return TagDB(context, edges)
+
+
+def tag_query(name):
+    return meta.MetaQuery(
+        name=name, query=meta.TagsComponent(names=[name], application="any")
+    )
+
+
+def tagging(dbi, tag_name, object_id):
+    changes = ChangeSet()
+    changes.related.insert(
+        meta.Related(
+            subject_id=dbi.metacontext.tags.by_name[tag_name].id,
+            assoc_id=dbi.role_id("tag_applies"),
+            object_id=object_id,
+        )
+    )
+    return changes
+
+
+def test_hits_and_invalidation():
+    dbi = tagged_db()
+    cache = QueryCache()
+    run = lambda q: asyncio.run(cache.evaluate(q, dbi))
+    assert run(tag_query("red")) == {"o1"}
+    assert run(tag_query("red")) == {"o1"}
+    assert run(tag_query("blue")) == {"o2"}
+    assert dbi.reads == 2
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+    changes = tagging(dbi, "blue", "o3")
+    cache.invalidate(changed_ids(changes, dbi.metacontext))
+    assert len(cache) == 1 and cache.invalidations == 1
+    assert run(tag_query("red")) == {"o1"}
+    assert dbi.reads == 2
+
+
+def test_cached_result_is_a_copy():
+    dbi = tagged_db()
+    cache = QueryCache()
+    asyncio.run(cache.evaluate(tag_query("red"), dbi)).add("junk")
+    assert asyncio.run(cache.evaluate(tag_query("red"), dbi)) == {"o1"}
+
+
+def test_sync_related_query():
+    dbi = tagged_db()
+    red = dbi.metacontext.tags.by_name["red"].id
+    component = meta.RelatedTo(obj_id=red, role="tag_applies")
+    query = meta.MetaQuery(name="related", query=component)
+    assert asyncio.run(QueryCache().evaluate(query, dbi)) == {"o1"}
+
+
+def test_bounded():
+    cache = QueryCache(max_entries=2)
+    for i in range(3):
+        cache.put(query_key({"tags": {"any": [str(i)]}}), {str(i)}, {str(i)})
+    assert len(cache) == 2 and cache.evictions == 1
+    assert cache.get(query_key({"tags": {"any": ["0"]}})) is None
+    cache.invalidate({"1", "2"})
+    assert len(cache) == 0
+
+
+def test_key_ignores_dict_order():
+    a = lambda: {"and": {"components": [{"tags": {"any": ["x"]}}], "negated": False}}
+    b = {"and": {"negated": False, "components": [{"tags": {"any": ["x"]}}]}}
+    assert query_key(a()) == query_key(b)
+    saved = meta.MetaQuery.from_dict(dict(name="q", query=a()))
+    assert query_key(saved) == query_key(a())
+
+
+def test_object_changes_touch_unscoped_queries():
+    context = tagged_db().metacontext
+    tags = tag_query("red").query
+    titled = meta.AttributeComponent(attr_name="title", operate="==", value="x")
+    tag_deps = query_dependencies(tags, context)
+    attr_deps = query_dependencies(titled, context)
+    changes = ChangeSet()
+    changes.insert("objects", dict(id="o5_c1", title="x"))
+    touched = changed_ids(changes, context)
+    assert not tag_deps & touched and attr_deps & touched
+    changes = ChangeSet()
+    changes.objects.deleted.add("o1_c1")
+    assert tag_deps & changed_ids(changes, context)
+
+
+def test_group_dependencies_include_subgroups():
+    context = meta.MetaContext.from_schema(pkm_schema)
+    outer = meta.MetaGroup(name="outer")
+    inner = meta.MetaGroup(name="inner", contained_in=[outer.id])
+    for group in (outer, inner):
+        context.groups.add_item(group)
+    context.group_children[outer.id] = {inner.id}
+    component = meta.GroupsComponent(names=["outer"], include_subgroups=False)
+    assert {outer.id, inner.id} <= query_dependencies(component, context)
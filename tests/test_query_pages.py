@@ -0,0 +1,129 @@
+__author__ = "samantha"
+
+import asyncio
+import datetime
+import pytest
+from uop.core.memory import db_collection as memory
+from uop.core.query_pages import PageRows, query_page, top_k
+from uop.meta.schemas import meta
+from uop.meta.schemas.predefined import pkm_schema
+
+ages = [30, None, 25, 30, 41, None, 25, 19]
+
+
+class PersonDB:
+    """Just enough of a database interface to page queries over people"""
+
+    def __init__(self):
+        self.metacontext = meta.MetaContext.from_schema(pkm_schema)
+        self.person = self.metacontext.classes.by_name["Person"].id
+        self.people = memory.DBCollection(memory.Table("people"))
+        for i, age in enumerate(ages):
+            # born is left out, not None, where age is unknown
+            born = {} if age is None else dict(born=datetime.date(1950 + age, 1, 1))
+            self.people.insert(id=f"p{i}_{self.person}", age=age, **born)
+        self.evaluations = 0
+        self.finds = 0
+
+    def extension(self, cls_id):
+        self.finds += 1
+        return self.people
+
+    async def query(self, query):
+        self.evaluations += 1
+        return set(self.people.find(ids_only=True))
+
+    def bulk_load(self, uuids, preserve_order=True, only_cols=None):
+        return self.people.bulk_load(uuids, only_cols)
+
+
+def expected(descending=False):
+    key = lambda i: ((ages[i] is not None, ages[i]), i)
+    order = sorted(range(len(ages)), key=key)
+    if descending:
+        order = sorted(range(len(ages)), key=lambda i: (key(i)[0], -i), reverse=True)
+    return [f"p{i}_{PersonDB().person}" for i in order]
+
+
+def pages(dbi, query, order_by, limit, rows=None):
+    res, cursor = [], None
+    while True:
+        page, cursor = asyncio.run(
+            query_page(dbi, query, order_by, limit, cursor, rows)
+        )
+        assert len(page) <= limit
+        res.extend(page)
+        if cursor is None:
+            return res
+
+
+def tag_query():
+    return meta.MetaQuery(
+        name="any", query=meta.TagsComponent(names=["red"], application="any")
+    )
+
+
+def class_query(**criteria):
+    component = meta.ClassComponent(cls_name="Person")
+    if criteria:
+        attributes = [
+            meta.AttributeComponent(attr_name=k, operate=">", value=v)
+            for k, v in criteria.items()
+        ]
+        component = meta.AndQuery(components=[component, *attributes])
+    return meta.MetaQuery(name="people", query=component)
+
+
+def test_top_k():
+    rows = [(3, "a"), (None, "b"), (1, "c"), (3, "d")]
+    assert top_k(rows, 2) == [(None, "b"), (1, "c")]
+    assert top_k(rows, 2, descending=True) == [(3, "a"), (3, "d")]
+    assert top_k(rows, None, after=(1, "c")) == [(3, "a"), (3, "d")]
+    assert top_k(rows, 3, True, after=(3, "a")) == [(3, "d"), (1, "c"), (None, "b")]
+    mixed = rows + [("x", "e"), (b"y", "f")]
+    assert top_k(mixed, 3, after=(1, "c")) == [(3, "a"), (3, "d"), ("x", "e")]
+    assert top_k(mixed, 2, True) == [("x", "e"), (3, "a")]
+
+
+def test_heap_pages_evaluate_once():
+    dbi = PersonDB()
+    rows = PageRows()
+    assert pages(dbi, tag_query(), "age", 3, rows) == expected()
+    assert dbi.evaluations == 1
+    assert pages(dbi, tag_query(), "-age", 3, rows) == expected(True)
+    assert pages(dbi, tag_query(), "age", 3) == expected()
+    assert dbi.evaluations == 5
+
+
+def test_single_class_pushed_down():
+    dbi = PersonDB()
+    assert pages(dbi, class_query(), "age", 3) == expected()
+    assert dbi.evaluations == 0 and dbi.finds == 3
+    assert pages(dbi, class_query(age=20), "age", 2) == [
+        i for i in expected() if i[:2] not in ("p1", "p5", "p7")
+    ]
+    assert pages(dbi, class_query(), "-age", 3) == expected(True)
+    assert pages(dbi, class_query(), "age", 1) == expected()
+    assert pages(dbi, class_query(), "-age", 1) == expected(True)
+    assert dbi.evaluations == 0
+
+
+def test_date_ordered_pages():
+    dbi = PersonDB()
+    rows = PageRows()
+    assert pages(dbi, class_query(), "born", 3) == expected()
+    assert pages(dbi, class_query(), "born", 1) == expected()
+    assert pages(dbi, class_query(), "-born", 2) == expected(True)
+    assert pages(dbi, tag_query(), "born", 3, rows) == expected()
+    assert pages(dbi, tag_query(), "-born", 3, rows) == expected(True)
+
+
+def test_cursor_checked():
+    dbi = PersonDB()
+    _, cursor = asyncio.run(query_page(dbi, class_query(), "age", 2))
+    with pytest.raises(ValueError):
+        asyncio.run(query_page(dbi, class_query(), "-age", 2, cursor))
+    with pytest.raises(ValueError):
+        asyncio.run(query_page(dbi, tag_query(), "age", 2, cursor))
+    with pytest.raises(ValueError):
+        asyncio.run(query_page(dbi, class_query(), "age", 2, "junk"))
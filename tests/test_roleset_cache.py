@@ -0,0 +1,84 @@
+__author__ = "samantha"
+
+from uop.core.changeset import ChangeSet
+from uop.core.roleset_cache import RolesetCache
+from uop.meta.schemas import meta
+
+
+def edge(subject, role, object):
+    return meta.Related(subject_id=subject, assoc_id=role, object_id=object)
+
+
+def filled():
+    cache = RolesetCache()
+    cache.put("r1", "a_c1", False, {"b_c1", "c_c2"})
+    cache.put("r1", "b_c1", True, {"a_c1"})
+    cache.put("r1", "c_c2", True, {"a_c1"})
+    cache.put("r1", "d_c1", False, {"c_c2"})
+    cache.put("r2", "a_c1", False, {"t1"})
+    cache.put("r2", "t1", True, {"a_c1"})
+    return cache
+
+
+def cached(cache):
+    return {k for k in list(cache._entries) if cache.get(*k) is not None}
+
+
+def test_get_and_bound():
+    cache = RolesetCache(max_entries=2)
+    assert cache.get("r1", "a_c1") is None
+    cache.put("r1", "a_c1", False, {"b_c1"})
+    cache.put("r1", "a_c1", True, set())
+    cache.get("r1", "a_c1").add("x")
+    assert cache.get("r1", "a_c1") == {"b_c1"}
+    assert cache.get("r1", "a_c1", reverse=True) == set()
+    cache.put("r1", "b_c1", False, set())
+    assert cache.get("r1", "a_c1") is None
+    found, missing = cache.get_many(["a_c1", "b_c1"], "r1")
+    assert (found, missing) == ({"b_c1": set()}, ["a_c1"])
+    assert cache.stats()["evictions"] == 1
+
+
+def test_edge_invalidation():
+    cache = filled()
+    changes = ChangeSet()
+    changes.related.insert(edge("a_c1", "r1", "e_c1"))
+    changes.related.delete(edge("d_c1", "r1", "c_c2"))
+    cache.apply_changes(changes)
+    assert cached(cache) == {
+        ("r1", "b_c1", True),
+        ("r2", "a_c1", False),
+        ("r2", "t1", True),
+    }
+    assert cache.stats()["invalidations"] == 3
+
+
+def test_deletion_invalidation():
+    cache = filled()
+    changes = ChangeSet()
+    changes.roles.deleted.add("r2")
+    cache.apply_changes(changes)
+    assert ("r2", "a_c1", False) not in cached(cache)
+    assert len(cache) == 4
+
+    changes = ChangeSet()
+    changes.objects.deleted.add("b_c1")
+    changes.classes.deleted.add("c2")
+    cache.apply_changes(changes)
+    # a_c1 held b_c1 and both it and d_c1 held c_c2
+    assert cached(cache) == set()
+
+
+def test_deleted_member_invalidation():
+    cache = RolesetCache()
+    cache.put("tagrole", "T", False, {"x_c1", "y_c1"})
+    cache.put("tagrole", "U", False, {"y_c1"})
+    changes = ChangeSet()
+    changes.objects.deleted.add("x_c1")
+    cache.apply_changes(changes)
+    assert cache.get("tagrole", "T") is None
+    assert cache.get("tagrole", "U") == {"y_c1"}
+    changes = ChangeSet()
+    changes.classes.deleted.add("c1")
+    cache.apply_changes(changes)
+    assert len(cache) == 0 and not cache._by_id
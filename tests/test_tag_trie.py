@@ -0,0 +1,38 @@
+__author__ = "samantha"
+
+from uop.core.changeset import ChangeSet
+from uop.core.tag_trie import TagTrie
+from uop.meta.schemas import meta
+
+
+def make_trie():
+    names = ["projects", "projects.uop", "projects.uop.core", "projects.web", "home"]
+    tags = [dict(id=f"t{i}", name=n) for i, n in enumerate(names)]
+    return TagTrie(tags)
+
+
+def test_lookups():
+    trie = make_trie()
+    assert trie.under("projects") == {"t0", "t1", "t2", "t3"}
+    assert trie.under("projects.uop.") == {"t1", "t2"}
+    assert trie.under("proj") == set()
+    assert trie.subtags("t1") == {"t2"}
+    assert trie.with_subtags("t4") == {"t4"}
+
+
+def test_changes():
+    trie = make_trie()
+    trie.remove("t2")
+    assert trie.under("projects.uop") == {"t1"}
+    trie.add("t1", "archive.uop")
+    assert trie.under("projects") == {"t0", "t3"}
+    assert trie.under("archive") == {"t1"}
+
+    changes = ChangeSet()
+    tag = meta.MetaTag(name="projects.new")
+    changes.insert("tags", tag.dict())
+    changes.modify("tags", "t3", dict(name="home.web"))
+    changes.delete("tags", "t0")
+    trie.apply_delta(changes.meta_delta())
+    assert trie.under("projects") == {tag.id}
+    assert trie.under("home") == {"t4", "t3"}